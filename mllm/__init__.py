@@ -2,8 +2,9 @@ import os
 import warnings
 
 from mllm.chat import Chat
+from mllm.batch import complete_many
 from mllm.cache.cache_service import caching
-from mllm.embedding import get_embeddings
+from mllm.embedding import get_embeddings, aget_embeddings
 from mllm.debug import display_chats
 
 import dotenv
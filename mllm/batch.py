@@ -0,0 +1,70 @@
+from __future__ import annotations
+
+import concurrent.futures
+from typing import List
+
+from mllm.cache.cache_service import caching
+from mllm.chat import Chat
+from mllm.utils.maps import default_parallel_map_config
+
+
+def complete_many(chats: List[Chat], model=None, cache=False, expensive=False, parse=None,
+                  retry=True, options=None, n_workers=None, title=None, pbar_impl=None) -> List:
+    """
+    Complete many chats with one call.
+    The cache of all the chats is probed at once and only the misses are sent to the model.
+    Example usage: `results = complete_many(chats, parse="dict", cache=True)`
+    :param chats: The chats to complete
+    :param model: The name of the model to use. If None, the default model will be used.
+    :param cache: Whether to use cache. If True, the results will be cached.
+    :param expensive: Whether to use the expensive model.
+    :param parse: How to parse the results. See `Chat.complete`.
+    :param retry: Whether to retry if a completion fails.
+    :param options: Additional options for the completion model.
+    :param n_workers: Maximum number of completions in flight
+    :param title: Title of the progress bar
+    :param pbar_impl: Progress bar implementation, default is tqdm
+    :return: The results in the order of chats. A failed chat gets its exception in its place.
+    """
+    if n_workers is None:
+        n_workers = default_parallel_map_config["n_workers"]
+    if pbar_impl is None:
+        pbar_impl = default_parallel_map_config["pbar"]
+    if title is None:
+        title = "complete_many"
+
+    models_and_options = [chat._prepare_completion(model, expensive, parse, options) for chat in chats]
+    if cache:
+        cache_entries = caching.read_kv_cache_many(
+            [chat.get_messages_to_api() for chat in chats],
+            ["chat_" + chat_model for chat_model, _ in models_and_options])
+    else:
+        cache_entries = [None] * len(chats)
+
+    results = [None] * len(chats)
+
+    def complete_one(i):
+        chat_model, chat_options = models_and_options[i]
+        try:
+            results[i] = chats[i]._complete_with_retry(chat_model, cache, parse, retry, chat_options,
+                                                       cache_entry=cache_entries[i])
+        except Exception as e:
+            results[i] = e
+
+    misses = []
+    for i, cache_entry in enumerate(cache_entries):
+        if cache_entry is not None and cache_entry.is_valid():
+            # Cache hits are cheap. Complete them in the current thread.
+            complete_one(i)
+        else:
+            misses.append(i)
+
+    if len(misses) > 0:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(complete_one, i) for i in misses]
+            for _ in pbar_impl(concurrent.futures.as_completed(futures), total=len(futures), desc=title):
+                pass
+
+    # Write all the new results in one transaction
+    caching.write_kv_caches([cache_entry for cache_entry in cache_entries if cache_entry is not None])
+    return results
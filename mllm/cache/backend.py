@@ -0,0 +1,367 @@
+from __future__ import annotations
+
+import math
+import os
+import time
+from datetime import date
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from mllm.cache.conn_pool import ConnPool, write_transaction
+from mllm.cache.eviction import EvictionPolicy, get_type_condition
+from mllm.cache.schema import cache_table_sql, embedding_cache_sql, ensure_last_access, ensure_primary_key
+
+"""
+# Storage backends of the cache tables
+"""
+
+# SQLite limits the number of variables in one statement (999 before 3.32)
+max_sql_variables = 900
+
+# (hash, type). The type is the model name in the embedding cache.
+Key = Tuple[str, str]
+# (hash, type, value, meta). The value is str in the KV cache and bytes in the embedding cache.
+Row = Tuple[str, str, any, Optional[str]]
+# Called with the number of rows processed and the total number of rows
+Progress = Callable[[int, int], None]
+
+
+class ProgressBar:
+    """
+    A `Progress` shown by tqdm. Nothing is shown for the operations on fewer than min_total rows.
+    """
+
+    def __init__(self, desc: str, min_total: int = 100000):
+        self.desc = desc
+        self.min_total = min_total
+        self.pbar = None
+
+    def __call__(self, n_done: int, n_total: int):
+        if n_total < self.min_total:
+            return
+        if self.pbar is None:
+            from tqdm import tqdm
+            self.pbar = tqdm(total=n_total, desc=self.desc)
+        self.pbar.update(n_done - self.pbar.n)
+
+    def close(self):
+        if self.pbar is not None:
+            self.pbar.close()
+
+
+class CacheBackend:
+    """
+    The store of a cache table. `CacheTableKV` and `CacheTableEmbed` keep the pending cache and the in-memory tier,
+    and read and write the rows through a backend, so that the rows can be stored somewhere else than a local file.
+    """
+
+    def get(self, key: Key) -> Optional[Tuple[any, Optional[str]]]:
+        """
+        :return: (value, meta) or None if the key is not stored
+        """
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys: List[Key]) -> Dict[Key, Tuple[any, Optional[str]]]:
+        """
+        :return: the map from the stored keys to (value, meta). The keys not stored are absent.
+        """
+        raise NotImplementedError
+
+    def put_many(self, rows: List[Row]):
+        raise NotImplementedError
+
+    def delete(self, keys: List[Key]):
+        raise NotImplementedError
+
+    def scan(self, after: Optional[Key] = None, limit: int = 1000, with_values=True) -> List[Row]:
+        """
+        Read the rows in the order of keys
+        :param after: only the rows with keys after it are returned. Used for paging.
+        :param with_values: whether to read the values. If False, the values and meta are None.
+        """
+        raise NotImplementedError
+
+    def scan_all(self, with_values=True, page_size: int = 1000) -> Iterable[Row]:
+        after = None
+        while True:
+            rows = self.scan(after, page_size, with_values)
+            yield from rows
+            if len(rows) < page_size:
+                return
+            after = (rows[-1][0], rows[-1][1])
+
+    def delete_unused(self, active_hashes: Set[str], progress: Optional[Progress] = None) -> int:
+        """
+        Delete the rows whose hash is not in active_hashes
+        :param progress: the callback reporting the progress
+        :return: the number of rows deleted
+        """
+        keys = []
+        n_scanned = 0
+        for row in self.scan_all(with_values=False):
+            n_scanned += 1
+            if row[0] not in active_hashes:
+                keys.append((row[0], row[1]))
+        for i in range(0, len(keys), max_sql_variables):
+            self.delete(keys[i:i + max_sql_variables])
+            if progress is not None:
+                progress(min(i + max_sql_variables, len(keys)), len(keys))
+        return len(keys)
+
+    def clear(self):
+        keys = [(row[0], row[1]) for row in self.scan_all(with_values=False)]
+        for i in range(0, len(keys), max_sql_variables):
+            self.delete(keys[i:i + max_sql_variables])
+
+    def touch(self, keys: List[Key]):
+        """
+        Record the access of the keys for eviction. Optional for a backend.
+        """
+        pass
+
+    def evict(self, policy: EvictionPolicy) -> int:
+        """
+        Remove the rows beyond the limits of the policy. Optional for a backend.
+        :return: the number of rows removed
+        """
+        return 0
+
+    def close(self):
+        pass
+
+
+class SQLiteBackend(CacheBackend):
+    """
+    The cache table in a local SQLite file. This is the default backend.
+    """
+
+    def __init__(self, db_path: str, table: str, type_column: str, value_column: str, meta_column: Optional[str],
+                 create_sql: str, write_batch_size: int = 1000):
+        self.db_path = db_path
+        self.table = table
+        self.type_column = type_column
+        self.value_column = value_column
+        self.meta_column = meta_column
+        self.create_sql = create_sql
+        # Number of rows written in one transaction
+        self.write_batch_size = write_batch_size
+        db_dir = os.path.dirname(db_path)
+        # create the directory if not exist
+        if len(db_dir) != 0 and not os.path.exists(db_dir):
+            os.makedirs(db_dir, exist_ok=True)
+        self.conn_pool = ConnPool(db_path)
+        self.create_table()
+
+    def create_table(self):
+        """
+        Create the table, or migrate the table of an older version keyed by hash only
+        """
+        db_conn = self.conn_pool.get_conn()
+        db_conn.execute(self.create_sql.format(table=self.table))
+        db_conn.commit()
+        migrated = ensure_primary_key(db_conn, self.table, self.create_sql, ["hash", self.type_column])
+        ensure_last_access(db_conn, self.table, backfill=migrated)
+
+    def _select_columns(self, with_values=True) -> str:
+        if not with_values:
+            return f"hash, {self.type_column}, NULL, NULL"
+        meta_column = self.meta_column or "NULL"
+        return f"hash, {self.type_column}, {self.value_column}, {meta_column}"
+
+    def get_many(self, keys: List[Key]) -> Dict[Key, Tuple[any, Optional[str]]]:
+        key_set = set(keys)
+        hashes = list(set(key[0] for key in keys))
+        found = {}
+        cursor = self.conn_pool.get_conn().cursor()
+        for i in range(0, len(hashes), max_sql_variables):
+            chunk = hashes[i:i + max_sql_variables]
+            cursor.execute("SELECT {} FROM {} WHERE hash IN ({})".format(
+                self._select_columns(), self.table, ",".join(["?"] * len(chunk))), chunk)
+            for hash, type, value, meta in cursor.fetchall():
+                if (hash, type) in key_set:
+                    found[(hash, type)] = (value, meta)
+        return found
+
+    def get(self, key: Key) -> Optional[Tuple[any, Optional[str]]]:
+        cursor = self.conn_pool.get_conn().cursor()
+        cursor.execute("SELECT {} FROM {} WHERE hash = ? AND {} = ?".format(
+            self._select_columns(), self.table, self.type_column), key)
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return row[2], row[3]
+
+    def write_rows(self, cursor, rows: List[Row]):
+        """
+        Write the rows in the transaction of cursor
+        """
+        today = str(date.today())
+        now = time.time()
+        if self.meta_column is not None:
+            cursor.executemany(
+                f"INSERT OR REPLACE INTO {self.table} (hash, {self.type_column}, {self.value_column}, date, "
+                f"{self.meta_column}, last_access) VALUES (?, ?, ?, ?, ?, ?)",
+                [(hash, type, value, today, meta, now) for hash, type, value, meta in rows])
+        else:
+            cursor.executemany(
+                f"INSERT OR REPLACE INTO {self.table} (hash, {self.type_column}, {self.value_column}, date, "
+                f"last_access) VALUES (?, ?, ?, ?, ?)",
+                [(hash, type, value, today, now) for hash, type, value, meta in rows])
+
+    def put_many(self, rows: List[Row]):
+        db_conn = self.conn_pool.get_conn()
+        for i in range(0, len(rows), self.write_batch_size):
+            batch = rows[i:i + self.write_batch_size]
+            write_transaction(db_conn, lambda cursor: self.write_rows(cursor, batch))
+
+    def delete(self, keys: List[Key]):
+        write_transaction(self.conn_pool.get_conn(), lambda cursor: cursor.executemany(
+            f"DELETE FROM {self.table} WHERE hash = ? AND {self.type_column} = ?", keys))
+
+    def scan(self, after: Optional[Key] = None, limit: int = 1000, with_values=True) -> List[Row]:
+        cursor = self.conn_pool.get_conn().cursor()
+        columns = self._select_columns(with_values)
+        if after is None:
+            cursor.execute(f"SELECT {columns} FROM {self.table} ORDER BY hash, {self.type_column} LIMIT ?",
+                           (limit,))
+        else:
+            cursor.execute(f"SELECT {columns} FROM {self.table} WHERE hash > ? OR (hash = ? AND {self.type_column} > ?) "
+                           f"ORDER BY hash, {self.type_column} LIMIT ?", (after[0], after[0], after[1], limit))
+        return cursor.fetchall()
+
+    def delete_unused(self, active_hashes: Set[str], progress: Optional[Progress] = None) -> int:
+        """
+        The active hashes are put in a temporary table, and the rows are deleted in windows of rowid
+        so that each transaction is short and every row is visited once.
+        """
+        db_conn = self.conn_pool.get_conn()
+        if db_conn.in_transaction:
+            db_conn.commit()
+        db_conn.execute("CREATE TEMP TABLE IF NOT EXISTS active_hash (hash TEXT PRIMARY KEY)")
+        db_conn.execute("DELETE FROM temp.active_hash")
+        active_hashes = list(active_hashes)
+        for i in range(0, len(active_hashes), self.write_batch_size):
+            db_conn.executemany("INSERT OR IGNORE INTO temp.active_hash VALUES (?)",
+                                [(hash,) for hash in active_hashes[i:i + self.write_batch_size]])
+        db_conn.commit()
+        try:
+            min_rowid, max_rowid = db_conn.execute(f"SELECT MIN(rowid), MAX(rowid) FROM {self.table}").fetchone()
+            n_deleted = 0
+            if min_rowid is None:
+                return 0
+            window = self.write_batch_size * 10
+            for start in range(min_rowid, max_rowid + 1, window):
+                n_deleted += write_transaction(db_conn, lambda cursor: cursor.execute(
+                    f"DELETE FROM {self.table} WHERE rowid >= ? AND rowid < ? "
+                    f"AND hash NOT IN (SELECT hash FROM temp.active_hash)", (start, start + window)).rowcount)
+                if progress is not None:
+                    progress(min(start + window, max_rowid + 1) - min_rowid, max_rowid + 1 - min_rowid)
+            return n_deleted
+        finally:
+            db_conn.execute("DROP TABLE IF EXISTS temp.active_hash")
+            db_conn.commit()
+
+    def clear(self):
+        write_transaction(self.conn_pool.get_conn(), lambda cursor: cursor.execute(f"DELETE FROM {self.table}"))
+
+    def touch(self, keys: List[Key]):
+        now = time.time()
+        db_conn = self.conn_pool.get_conn()
+        for i in range(0, len(keys), self.write_batch_size):
+            batch = keys[i:i + self.write_batch_size]
+            write_transaction(db_conn, lambda cursor: cursor.executemany(
+                f"UPDATE {self.table} SET last_access = ? WHERE hash = ? AND {self.type_column} = ?",
+                [(now, hash, type) for hash, type in batch]))
+
+    def _delete_least_recent(self, condition: str, params: tuple, n_rows: int, batch_size: int) -> int:
+        """
+        Delete the n_rows least recently accessed rows matching condition, in transactions of batch_size rows
+        """
+        db_conn = self.conn_pool.get_conn()
+        n_deleted = 0
+        while n_deleted < n_rows:
+            n_batch = min(batch_size, n_rows - n_deleted)
+            n = write_transaction(db_conn, lambda cursor: cursor.execute(
+                f"DELETE FROM {self.table} WHERE rowid IN (SELECT rowid FROM {self.table} WHERE {condition} "
+                f"ORDER BY last_access LIMIT ?)", (*params, n_batch)).rowcount)
+            n_deleted += n
+            if n < n_batch:
+                break
+        return n_deleted
+
+    def _delete_expired(self, condition: str, params: tuple, expire_before: float, batch_size: int) -> int:
+        db_conn = self.conn_pool.get_conn()
+        n_deleted = 0
+        while True:
+            n = write_transaction(db_conn, lambda cursor: cursor.execute(
+                f"DELETE FROM {self.table} WHERE rowid IN (SELECT rowid FROM {self.table} WHERE {condition} "
+                f"AND last_access < ? LIMIT ?)", (*params, expire_before, batch_size)).rowcount)
+            n_deleted += n
+            if n < batch_size:
+                return n_deleted
+
+    def get_size(self) -> int:
+        """
+        :return: the bytes used by the database, not counting the free pages
+        """
+        db_conn = self.conn_pool.get_conn()
+        page_size = db_conn.execute("PRAGMA page_size").fetchone()[0]
+        page_count = db_conn.execute("PRAGMA page_count").fetchone()[0]
+        freelist_count = db_conn.execute("PRAGMA freelist_count").fetchone()[0]
+        return (page_count - freelist_count) * page_size
+
+    def evict(self, policy: EvictionPolicy) -> int:
+        db_conn = self.conn_pool.get_conn()
+        n_deleted = 0
+        now = time.time()
+        for type_key, ttl in policy.ttl.items():
+            condition, params = get_type_condition(self.type_column, type_key)
+            n_deleted += self._delete_expired(condition, params, now - ttl, policy.delete_batch_size)
+        for type_key, max_rows in policy.max_rows.items():
+            condition, params = get_type_condition(self.type_column, type_key)
+            n_rows = db_conn.execute(f"SELECT COUNT(*) FROM {self.table} WHERE {condition}", params).fetchone()[0]
+            if n_rows > max_rows:
+                n_deleted += self._delete_least_recent(condition, params, n_rows - max_rows, policy.delete_batch_size)
+        if policy.max_bytes is not None:
+            # The rows are deleted by the average row size until the table fits
+            for _ in range(8):
+                size = self.get_size()
+                n_rows = db_conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+                if size <= policy.max_bytes or n_rows == 0:
+                    break
+                n_over = math.ceil((size - policy.max_bytes) / (size / n_rows))
+                n_deleted += self._delete_least_recent("1", (), n_over, policy.delete_batch_size)
+        self.incremental_vacuum(policy.vacuum_pages)
+        return n_deleted
+
+    def incremental_vacuum(self, n_pages: int):
+        """
+        Return at most n_pages free pages to the file system. Only works on the databases in incremental
+        auto vacuum mode, which is the default of new databases. See `vacuum` for the older databases.
+        """
+        db_conn = self.conn_pool.get_conn()
+        if db_conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            return
+        db_conn.execute(f"PRAGMA incremental_vacuum({int(n_pages)})").fetchall()
+        db_conn.commit()
+
+    def vacuum(self):
+        """
+        Rebuild the database to return all the free pages, and switch it to incremental auto vacuum.
+        It takes a while and blocks the other connections on large databases.
+        """
+        db_conn = self.conn_pool.get_conn()
+        if db_conn.in_transaction:
+            db_conn.commit()
+        db_conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        db_conn.execute("VACUUM")
+
+    def close(self):
+        self.conn_pool.close_all()
+
+
+def open_kv_backend(db_path: str) -> SQLiteBackend:
+    return SQLiteBackend(db_path, "cache_table", "type", "value", "meta", cache_table_sql)
+
+
+def open_embedding_backend(db_path: str) -> SQLiteBackend:
+    return SQLiteBackend(db_path, "embedding_cache", "model_name", "embedding", None, embedding_cache_sql)
@@ -0,0 +1,384 @@
+from __future__ import annotations
+
+import os
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Set, Tuple
+from urllib.parse import quote, unquote
+
+import numpy as np
+
+from mllm.cache.backend import CacheBackend, Key, Progress, Row
+
+try:
+    import fcntl
+except ImportError:
+    # Only the threads of one process are synchronized without it
+    fcntl = None
+
+"""
+# Flat-file store of the embeddings
+
+Each type (model name) has a matrix file of fixed-stride rows, appended in the order they are written, and
+an index file of the 16-byte hashes of the rows in the same order, after a header recording the stride.
+A whole matrix and its index are mapped by `np.memmap` without reading them, see `FlatFileBackend.get_matrix`.
+Use it by `caching.set_embedding_store("flat")`.
+"""
+
+header_magic = b"MLLMFLT1"
+header_size = 16
+hash_size = 16
+# A hash of the index file as a numpy scalar
+key_dtype = np.dtype(f"V{hash_size}")
+
+
+def to_keys(hashes: List[str]) -> np.ndarray:
+    """
+    :return: the hex digests as an array of key_dtype
+    """
+    return np.frombuffer(bytes.fromhex("".join(hashes)), dtype=key_dtype)
+
+
+def to_hashes(keys: np.ndarray) -> List[str]:
+    hexes = keys.tobytes().hex()
+    return [hexes[i:i + 2 * hash_size] for i in range(0, len(hexes), 2 * hash_size)]
+
+
+class HashIndex:
+    """
+    Find the rows of hashes by binary search, without a Python object per row.
+    The rows are sorted by the first 8 bytes of their hashes, and the candidates are checked on the whole hashes.
+    """
+
+    def __init__(self, keys: np.ndarray):
+        """
+        :param keys: the hashes of the rows as an array of key_dtype, which is not copied
+        """
+        self.keys = keys
+        prefixes = keys.view(">u8")[::2].astype(np.uint64)
+        self.order = np.argsort(prefixes)
+        self.sorted_prefixes = prefixes[self.order]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def find(self, query: np.ndarray) -> np.ndarray:
+        """
+        :param query: the hashes as an array of key_dtype
+        :return: the rows of the hashes. -1 for the hashes not found.
+        """
+        prefixes = query.view(">u8")[::2].astype(np.uint64)
+        left = np.searchsorted(self.sorted_prefixes, prefixes, "left")
+        right = np.searchsorted(self.sorted_prefixes, prefixes, "right")
+        rows = np.full(len(query), -1, dtype=np.int64)
+        single = np.flatnonzero(right - left == 1)
+        candidates = self.order[left[single]]
+        matched = self.keys[candidates] == query[single]
+        rows[single[matched]] = candidates[matched]
+        # Different hashes with the same first 8 bytes
+        for i in np.flatnonzero(right - left > 1):
+            candidates = self.order[left[i]:right[i]]
+            candidates = candidates[self.keys[candidates] == query[i]]
+            if len(candidates) > 0:
+                rows[i] = candidates[0]
+        return rows
+
+
+class FlatMatrix:
+    """
+    The files of one type. A row written again with the same hash is overwritten in place.
+    The index is mapped and searched by a `HashIndex` built on the first lookup. The rows appended after it
+    are kept in a dict until there are too many of them and the `HashIndex` is built again.
+    """
+
+    def __init__(self, data_path: str, index_path: str):
+        self.data_path = data_path
+        self.index_path = index_path
+        self.lock = threading.RLock()
+        # Bytes of each row. None before the first row is written
+        self.stride: Optional[int] = None
+        self.n_rows = 0
+        # The HashIndex of the first rows, and the rows appended after them by hash
+        self.hash_index: Optional[HashIndex] = None
+        self.tail: Dict[str, int] = {}
+        # The inode of the index file, which changes when the files are rewritten
+        self.inode = None
+        self.mapped: Optional[np.memmap] = None
+        self.mapped_index: Optional[np.memmap] = None
+
+    @contextmanager
+    def locked(self):
+        """
+        Lock the files against the other threads and processes
+        """
+        with self.lock, open(self.index_path + ".lock", "ab") as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _reset(self):
+        self.stride = None
+        self.n_rows = 0
+        self.hash_index = None
+        self.tail = {}
+        self.inode = None
+        self.mapped = None
+        self.mapped_index = None
+
+    def _append_rows(self, hashes: List[str]):
+        """
+        Record the rows appended to the end of the files
+        """
+        if self.hash_index is not None:
+            for i, hash in enumerate(hashes):
+                self.tail[hash] = self.n_rows + i
+            if len(self.tail) > max(1024, len(self.hash_index) // 8):
+                self.hash_index = None
+                self.tail = {}
+        self.n_rows += len(hashes)
+        self.mapped = None
+        self.mapped_index = None
+
+    def refresh(self):
+        """
+        Read the size of the files, and the index entries appended by the other processes if a lookup needs them
+        """
+        with self.lock:
+            try:
+                stat = os.stat(self.index_path)
+            except FileNotFoundError:
+                self._reset()
+                return
+            if stat.st_ino != self.inode:
+                self._reset()
+                self.inode = stat.st_ino
+            if stat.st_size < header_size:
+                return
+            with open(self.index_path, "rb") as f:
+                if self.stride is None:
+                    header = f.read(header_size)
+                    if header[:len(header_magic)] != header_magic:
+                        raise ValueError(f"{self.index_path} is not an index of embeddings")
+                    self.stride = int.from_bytes(header[len(header_magic):], "little")
+                n_rows = (stat.st_size - header_size) // hash_size
+                if n_rows <= self.n_rows:
+                    return
+                new_hashes = []
+                if self.hash_index is not None:
+                    f.seek(header_size + self.n_rows * hash_size)
+                    new_hashes = to_hashes(np.frombuffer(f.read((n_rows - self.n_rows) * hash_size), dtype=key_dtype))
+            if self.hash_index is not None:
+                self._append_rows(new_hashes)
+            else:
+                self.n_rows = n_rows
+                self.mapped = None
+                self.mapped_index = None
+
+    def get_map(self) -> Optional[np.memmap]:
+        """
+        :return: the matrix of the rows as uint8, mapped read-only. None if there is no row.
+        """
+        with self.lock:
+            if self.mapped is None and self.n_rows > 0:
+                self.mapped = np.memmap(self.data_path, dtype=np.uint8, mode="r", shape=(self.n_rows, self.stride))
+            return self.mapped
+
+    def get_index(self) -> Optional[np.memmap]:
+        """
+        :return: the hashes of the rows as an array of key_dtype, mapped read-only. None if there is no row.
+        """
+        with self.lock:
+            if self.mapped_index is None and self.n_rows > 0:
+                self.mapped_index = np.memmap(self.index_path, dtype=key_dtype, mode="r", offset=header_size,
+                                              shape=(self.n_rows,))
+            return self.mapped_index
+
+    def get_hashes(self) -> List[str]:
+        """
+        :return: the hashes of all the rows. It creates a string per row, so only use it when all of them are needed.
+        """
+        with self.lock:
+            index = self.get_index()
+            return to_hashes(index) if index is not None else []
+
+    def find(self, hashes: List[str]) -> np.ndarray:
+        """
+        :return: the rows of the hashes. -1 for the hashes not found.
+        """
+        with self.lock:
+            if self.n_rows == 0 or len(hashes) == 0:
+                return np.full(len(hashes), -1, dtype=np.int64)
+            if self.hash_index is None:
+                self.hash_index = HashIndex(self.get_index())
+                self.tail = {}
+            rows = self.hash_index.find(to_keys(hashes))
+            if len(self.tail) > 0:
+                for i in np.flatnonzero(rows < 0):
+                    rows[i] = self.tail.get(hashes[i], -1)
+            return rows
+
+    def read(self, hashes: List[str]) -> Dict[str, bytes]:
+        with self.lock:
+            rows = self.find(hashes)
+            found = np.flatnonzero(rows >= 0)
+            if len(found) == 0:
+                return {}
+            values = self.get_map()[rows[found]]
+            return {hashes[i]: values[j].tobytes() for j, i in enumerate(found)}
+
+    def write(self, items: Dict[str, bytes]):
+        with self.locked():
+            self.refresh()
+            if self.stride is None:
+                self.stride = len(next(iter(items.values())))
+                with open(self.index_path, "wb") as f:
+                    f.write(header_magic + self.stride.to_bytes(header_size - len(header_magic), "little"))
+                self.inode = os.stat(self.index_path).st_ino
+            for value in items.values():
+                if len(value) != self.stride:
+                    raise ValueError(f"The rows of {self.data_path} take {self.stride} bytes, but got {len(value)}. "
+                                     f"All the embeddings of a model must have the same size.")
+            hashes = list(items)
+            rows = self.find(hashes)
+            new_hashes = [hash for hash, row in zip(hashes, rows) if row < 0]
+            fd = os.open(self.data_path, os.O_RDWR | os.O_CREAT, 0o644)
+            with os.fdopen(fd, "r+b") as f:
+                for hash, row in zip(hashes, rows):
+                    if row >= 0:
+                        f.seek(int(row) * self.stride)
+                        f.write(items[hash])
+                # The new rows are written from the end of the index, over any row written before a crash
+                f.seek(self.n_rows * self.stride)
+                f.write(b"".join(items[hash] for hash in new_hashes))
+            # The index is appended after the rows, so that the indexed rows are always complete
+            with open(self.index_path, "ab") as f:
+                f.write(to_keys(new_hashes).tobytes())
+            self._append_rows(new_hashes)
+
+    def rewrite(self, keep: Callable[[str], bool]) -> int:
+        """
+        Rewrite the files with the rows whose hash is kept
+        :return: the number of rows removed
+        """
+        with self.locked():
+            self.refresh()
+            kept = [row for row, hash in enumerate(self.get_hashes()) if keep(hash)]
+            n_removed = self.n_rows - len(kept)
+            if n_removed == 0:
+                return 0
+            mapped = self.get_map()
+            index = self.get_index()
+            with open(self.data_path + ".tmp", "wb") as f:
+                for i in range(0, len(kept), 65536):
+                    f.write(mapped[kept[i:i + 65536]].tobytes())
+            with open(self.index_path + ".tmp", "wb") as f:
+                f.write(header_magic + self.stride.to_bytes(header_size - len(header_magic), "little"))
+                for i in range(0, len(kept), 65536):
+                    f.write(index[kept[i:i + 65536]].tobytes())
+            del mapped, index
+            self._reset()
+            os.replace(self.data_path + ".tmp", self.data_path)
+            os.replace(self.index_path + ".tmp", self.index_path)
+            self.refresh()
+            return n_removed
+
+    def remove(self):
+        with self.lock:
+            for path in [self.index_path, self.data_path, self.index_path + ".lock"]:
+                if os.path.exists(path):
+                    os.remove(path)
+            self._reset()
+
+
+class FlatFileBackend(CacheBackend):
+    """
+    The embeddings in flat files of a directory, with a matrix file and an index file per model.
+    The hashes must be hex digests of 16 bytes, as the ones of the embedding cache.
+    The rows have no access time, so the eviction policies are not applied to them.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.matrices: Dict[str, FlatMatrix] = {}
+
+    def get_flat_matrix(self, type: str) -> FlatMatrix:
+        with self.lock:
+            matrix = self.matrices.get(type)
+            if matrix is None:
+                path = os.path.join(self.directory, quote(type, safe=""))
+                matrix = FlatMatrix(path + ".bin", path + ".index")
+                self.matrices[type] = matrix
+        matrix.refresh()
+        return matrix
+
+    def get_types(self) -> List[str]:
+        return sorted(unquote(name[:-len(".index")]) for name in os.listdir(self.directory)
+                      if name.endswith(".index"))
+
+    def get_matrix(self, type: str) -> Tuple[Optional[np.memmap], Optional[np.memmap]]:
+        """
+        :return: the hashes of the rows as an array of key_dtype, and the rows as a uint8 matrix,
+        both mapped read-only (None if there is no row)
+        """
+        matrix = self.get_flat_matrix(type)
+        with matrix.lock:
+            return matrix.get_index(), matrix.get_map()
+
+    def get_many(self, keys: List[Key]) -> Dict[Key, Tuple[any, Optional[str]]]:
+        hashes_by_type: Dict[str, List[str]] = {}
+        for hash, type in keys:
+            hashes_by_type.setdefault(type, []).append(hash)
+        found = {}
+        for type, hashes in hashes_by_type.items():
+            for hash, value in self.get_flat_matrix(type).read(hashes).items():
+                found[(hash, type)] = (value, None)
+        return found
+
+    def put_many(self, rows: List[Row]):
+        items_by_type: Dict[str, Dict[str, bytes]] = {}
+        for hash, type, value, meta in rows:
+            items_by_type.setdefault(type, {})[hash] = value
+        for type, items in items_by_type.items():
+            self.get_flat_matrix(type).write(items)
+
+    def delete(self, keys: List[Key]):
+        hashes_by_type: Dict[str, Set[str]] = {}
+        for hash, type in keys:
+            hashes_by_type.setdefault(type, set()).add(hash)
+        for type, hashes in hashes_by_type.items():
+            self.get_flat_matrix(type).rewrite(lambda hash: hash not in hashes)
+
+    def scan(self, after: Optional[Key] = None, limit: int = 1000, with_values=True) -> List[Row]:
+        keys = sorted((hash, type) for type in self.get_types() for hash in self.get_flat_matrix(type).get_hashes())
+        if after is not None:
+            keys = [key for key in keys if key > tuple(after)]
+        keys = keys[:limit]
+        if not with_values:
+            return [(hash, type, None, None) for hash, type in keys]
+        found = self.get_many(keys)
+        return [(hash, type, found[(hash, type)][0], None) for hash, type in keys if (hash, type) in found]
+
+    def delete_unused(self, active_hashes: Set[str], progress: Optional[Progress] = None) -> int:
+        types = self.get_types()
+        n_deleted = 0
+        for i, type in enumerate(types):
+            n_deleted += self.get_flat_matrix(type).rewrite(lambda hash: hash in active_hashes)
+            if progress is not None:
+                progress(i + 1, len(types))
+        return n_deleted
+
+    def clear(self):
+        for type in self.get_types():
+            self.get_flat_matrix(type).remove()
+
+    def close(self):
+        with self.lock:
+            for matrix in self.matrices.values():
+                matrix.mapped = None
+            self.matrices = {}
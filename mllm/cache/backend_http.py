@@ -0,0 +1,77 @@
+from __future__ import annotations
+
+import base64
+import warnings
+from typing import Dict, List, Optional, Set, Tuple
+
+from mllm.cache.backend import CacheBackend, Key, Progress, Row
+
+"""
+# Client of the cache server in `mllm.cache.server`
+"""
+
+kinds = ("kv", "embedding")
+
+
+def encode_value(value):
+    if isinstance(value, bytes):
+        return {"base64": base64.b64encode(value).decode("ascii")}
+    return value
+
+
+def decode_value(value):
+    if isinstance(value, dict):
+        return base64.b64decode(value["base64"])
+    return value
+
+
+def encode_rows(rows) -> List[list]:
+    return [[hash, type, encode_value(value), meta] for hash, type, value, meta in rows]
+
+
+def decode_rows(rows) -> List[Row]:
+    return [(hash, type, decode_value(value), meta) for hash, type, value, meta in rows]
+
+
+class HTTPBackend(CacheBackend):
+    """
+    A cache table served by a `CacheServer`
+    """
+
+    def __init__(self, url: str, kind: str, namespace: str, timeout: float = 30.0):
+        import httpx
+        assert kind in kinds
+        self.url = url.rstrip("/")
+        self.kind = kind
+        self.namespace = namespace
+        self.client = httpx.Client(timeout=timeout)
+
+    def _post(self, op: str, body: dict) -> dict:
+        response = self.client.post(f"{self.url}/{self.kind}/{self.namespace}/{op}", json=body)
+        response.raise_for_status()
+        return response.json()
+
+    def get_many(self, keys: List[Key]) -> Dict[Key, Tuple[any, Optional[str]]]:
+        rows = decode_rows(self._post("get_many", {"keys": [list(key) for key in keys]})["rows"])
+        return {(hash, type): (value, meta) for hash, type, value, meta in rows}
+
+    def put_many(self, rows: List[Row]):
+        self._post("put_many", {"rows": encode_rows(rows)})
+
+    def delete(self, keys: List[Key]):
+        self._post("delete", {"keys": [list(key) for key in keys]})
+
+    def scan(self, after: Optional[Key] = None, limit: int = 1000, with_values=True) -> List[Row]:
+        res = self._post("scan", {"after": list(after) if after is not None else None, "limit": limit,
+                                  "with_values": with_values})
+        return decode_rows(res["rows"])
+
+    def delete_unused(self, active_hashes: Set[str], progress: Optional[Progress] = None) -> int:
+        warnings.warn("Unused cache is not removed from a cache server, because it may be used by the other clients")
+        return 0
+
+    def clear(self):
+        self._post("clear", {})
+
+    def close(self):
+        self.client.close()
@@ -1,68 +1,241 @@
+from __future__ import annotations
+
 import hashlib
 import os
+import threading
+from typing import Callable, List, Optional
 
 import numpy as np
-import sqlite3
-from datetime import date
 
-from mllm.cache.conn_pool import ConnPool
+from mllm.cache.backend import CacheBackend, ProgressBar, SQLiteBackend, open_embedding_backend
+from mllm.cache.backend_flat import FlatFileBackend, HashIndex, key_dtype, to_hashes, to_keys
+from mllm.cache.eviction import EvictionPolicy
+from mllm.cache.precision import EmbeddingPrecision, get_precision
+
+
+default_embed_pending_config = {
+    # Bytes of the pending embeddings after which a flush is requested
+    "max_pending_bytes": 64 * 1024 * 1024
+}
 
 
 def get_hash(text: str):
     return hashlib.md5(text.encode()).hexdigest()
 
+
+class EmbeddingMatrix:
+    """
+    The embeddings of a model stacked in a matrix, in the precision of the model.
+    With the flat-file store, the matrix and the hashes of its rows are mapped from the files without copying.
+    """
+
+    def __init__(self, keys: np.ndarray, rows: np.ndarray, precision: EmbeddingPrecision):
+        """
+        :param keys: the hashes of the rows as an array of `key_dtype`
+        :param rows: the encoded embeddings as a uint8 matrix, in the order of keys
+        """
+        self.keys = keys
+        self.precision = precision
+        self.values, self.scales = precision.view(rows)
+        self.hash_index: Optional[HashIndex] = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def hashes(self) -> List[str]:
+        return to_hashes(self.keys)
+
+    def get_rows(self, texts: List[str]) -> np.ndarray:
+        """
+        :return: the rows of the texts. -1 for the texts not in the matrix.
+        """
+        if self.hash_index is None:
+            self.hash_index = HashIndex(self.keys)
+        return self.hash_index.find(to_keys([get_hash(text) for text in texts]))
+
+    def get_embeddings(self, rows: np.ndarray) -> np.ndarray:
+        scales = self.scales[rows] if self.scales is not None else None
+        return self.precision.unpack(self.values[rows], scales)
+
+    def dot(self, query: np.ndarray, chunk_size: int = 65536) -> np.ndarray:
+        """
+        :param query: the query vectors, one per row
+        :return: the inner products of all the embeddings and the queries, computed chunk by chunk
+        """
+        query = np.atleast_2d(query)
+        res = np.empty((len(self), len(query)), dtype=np.float32)
+        for i in range(0, len(self), chunk_size):
+            scales = self.scales[i:i + chunk_size] if self.scales is not None else None
+            res[i:i + chunk_size] = self.precision.dot(self.values[i:i + chunk_size], scales, query)
+        return res
+
+
 class CacheTableEmbed:
-    def __init__(self, cache_dir: str, post_fix=""):
+    def __init__(self, cache_dir: str, post_fix="", backend: Optional[CacheBackend] = None):
+        """
+        :param backend: the store of the embeddings. Default is the SQLite file in cache_dir.
+        """
         self.cache_dir = cache_dir
         self.post_fix = post_fix
+        # The encoded embeddings to write, by (model name, hash)
         self.pending_cache = {}
-        db_path = self.get_db_path()
-        db_exist = os.path.exists(db_path)
-        self.conn_pool = ConnPool(self.get_db_path())
-        if not db_exist:
-            self.create_cache_table()
+        self.pending_lock = threading.Lock()
+        # Bytes of the pending embeddings. A flush is requested when it exceeds max_pending_bytes,
+        # and the thread adding the embedding flushes by itself when it exceeds twice of it
+        self.pending_bytes = 0
+        self.max_pending_bytes = default_embed_pending_config["max_pending_bytes"]
+        # Number of rows written in one transaction
+        self.flush_batch_size = 1000
+        # Called when the pending embeddings exceed max_pending_bytes
+        self.on_pending: Optional[Callable[[], None]] = None
+        # Keys read since the last write. Their last access time is updated for eviction
+        self.accessed_keys = set()
+        # Hashes of the texts used in this run. Used for garbage collection
+        self.active_cache_hash = set()
+        self.backend: CacheBackend = backend if backend is not None else open_embedding_backend(self.get_db_path())
+        # The connections of the SQLite file. None for the other backends
+        self.conn_pool = self.backend.conn_pool if isinstance(self.backend, SQLiteBackend) else None
 
     @property
     def db_conn(self):
         return self.conn_pool.get_conn()
 
-    def create_cache_table(self):
-        cursor = self.db_conn.cursor()
-        cursor.execute('''CREATE TABLE embedding_cache
-                         (hash TEXT PRIMARY KEY, 
-                         model_name text, 
-                         date text,
-                         embedding blob)''')
-        self.db_conn.commit()
+    def add_cache(self, model_name: str, text: str, embedding: np.ndarray) -> np.ndarray:
+        """
+        :return: the embedding in the precision of the model, which is equal to the one read from the cache later
+        """
+        data = get_precision(model_name).encode(embedding)
+        self._add_pending(model_name, get_hash(text), data)
+        return get_precision(model_name).decode(data)
 
-    def add_cache(self, model_name: str, text: str, embedding: np.ndarray):
-        hash_value = get_hash(text)
-        self.pending_cache[(model_name, hash_value)] = embedding
+    def _add_pending(self, model_name: str, hash_value: str, data: bytes):
+        with self.pending_lock:
+            old_data = self.pending_cache.get((model_name, hash_value))
+            if old_data is not None:
+                self.pending_bytes -= len(old_data)
+            self.pending_cache[(model_name, hash_value)] = data
+            self.pending_bytes += len(data)
+            pending_bytes = self.pending_bytes
+        self.active_cache_hash.add(hash_value)
+        if pending_bytes > 2 * self.max_pending_bytes:
+            # The background flush cannot keep up
+            self.save_pending_cache()
+        elif pending_bytes > self.max_pending_bytes and self.on_pending is not None:
+            self.on_pending()
 
     def read_cache(self, model_name: str, text: str) -> np.ndarray:
-        text_hash = get_hash(text)
-        if (model_name, text_hash) in self.pending_cache:
-            return self.pending_cache[(model_name, text_hash)]
-        cursor = self.db_conn.cursor()
-        cursor.execute("SELECT embedding FROM embedding_cache WHERE hash = ? AND model_name = ?", (text_hash, model_name))
-        res = cursor.fetchone()
-        if res is None:
-            return None
-        return np.frombuffer(res[0], dtype=np.float32)
+        return self.read_many(model_name, [text])[0]
+
+    def read_many(self, model_name: str, texts: List[str]) -> List[np.ndarray | None]:
+        """
+        Read the embeddings of many texts with a few queries
+        :return: the embeddings in the order of texts. None for the texts not cached.
+        """
+        precision = get_precision(model_name)
+        storage_name = model_name + precision.get_storage_suffix()
+        hashes = [get_hash(text) for text in texts]
+        found = {}
+        hashes_to_query = set()
+        for text_hash in hashes:
+            data = self.pending_cache.get((model_name, text_hash))
+            if data is not None:
+                found[text_hash] = data
+            else:
+                hashes_to_query.add(text_hash)
+
+        if len(hashes_to_query) > 0:
+            rows = self.backend.get_many([(text_hash, storage_name) for text_hash in hashes_to_query])
+            for (text_hash, _), (data, _) in rows.items():
+                found[text_hash] = data
+            self.accessed_keys.update(rows.keys())
+            hashes_to_query.difference_update(found.keys())
+        if len(hashes_to_query) > 0 and not precision.is_default():
+            # Convert the float32 embeddings stored before the precision was set, instead of embedding the texts again
+            rows = self.backend.get_many([(text_hash, model_name) for text_hash in hashes_to_query])
+            for (text_hash, _), (data, _) in rows.items():
+                found[text_hash] = precision.encode(np.frombuffer(data, dtype=np.float32))
+                self._add_pending(model_name, text_hash, found[text_hash])
+        self.active_cache_hash.update(found.keys())
+        decoded = {text_hash: precision.decode(data) for text_hash, data in found.items()}
+        return [decoded.get(text_hash) for text_hash in hashes]
+
+    def get_matrix(self, model_name: str) -> EmbeddingMatrix:
+        """
+        Stack all the cached embeddings of a model, after writing the pending ones.
+        It is mapped from the files in O(1) with the flat-file store, and read row by row with the other backends.
+        """
+        self.save_pending_cache()
+        precision = get_precision(model_name)
+        storage_name = model_name + precision.get_storage_suffix()
+        if isinstance(self.backend, FlatFileBackend):
+            keys, rows = self.backend.get_matrix(storage_name)
+        else:
+            hashes, data = [], []
+            for hash, type, value, _ in self.backend.scan_all():
+                if type == storage_name:
+                    hashes.append(hash)
+                    data.append(value)
+            keys = to_keys(hashes)
+            rows = np.frombuffer(b"".join(data), dtype=np.uint8).reshape(len(hashes), -1) if len(data) > 0 else None
+        if rows is None:
+            keys = np.zeros(0, dtype=key_dtype)
+            rows = np.zeros((0, 4 if precision.dtype == "int8" else 0), dtype=np.uint8)
+        return EmbeddingMatrix(keys, rows, precision)
 
     def get_db_path(self):
         return os.path.join(self.cache_dir, f"embedding_cache{self.post_fix}.db")
 
     def save_pending_cache(self):
-        for (model_name, hash_value), embedding in self.pending_cache.items():
-            cursor = self.db_conn.cursor()
-            cursor.execute("INSERT OR REPLACE INTO embedding_cache VALUES (?, ?, ?, ?)", (hash_value, model_name, str(date.today()), embedding.tobytes()))
-        self.db_conn.commit()
+        """
+        Write the pending embeddings with one transaction per `flush_batch_size` rows, and drop them from memory.
+        The rows of the models with a precision are stored with the model name suffixed by the precision.
+        It is safe to call this from another thread while the embeddings are being read and added.
+        """
+        with self.pending_lock:
+            accessed_keys = self.accessed_keys
+            self.accessed_keys = set()
+            items = list(self.pending_cache.items())
+        if len(accessed_keys) > 0:
+            self.backend.touch(list(accessed_keys))
+        for i in range(0, len(items), self.flush_batch_size):
+            batch = items[i:i + self.flush_batch_size]
+            self.backend.put_many([(hash_value, model_name + get_precision(model_name).get_storage_suffix(), data, None)
+                                   for (model_name, hash_value), data in batch])
+            # Remove the written embeddings only after they are committed, so that they are always readable
+            with self.pending_lock:
+                for key, data in batch:
+                    if self.pending_cache.get(key) is data:
+                        del self.pending_cache[key]
+                        self.pending_bytes -= len(data)
+
+    def has_pending_update(self) -> bool:
+        return len(self.pending_cache) > 0
+
+    def filter_unused_cache(self) -> int:
+        """
+        Remove the embeddings not used in this run. Note the file is shared by the scripts in the same directory.
+        :return: the number of embeddings removed
+        """
+        progress = ProgressBar("Removing unused embeddings")
+        try:
+            return self.backend.delete_unused(set(self.active_cache_hash), progress)
+        finally:
+            progress.close()
+
+    def evict(self, policy: EvictionPolicy) -> int:
+        """
+        Remove the embeddings beyond the limits of the policy. The types in the policy are model names.
+        :return: the number of embeddings removed
+        """
+        return self.backend.evict(policy)
 
     def clear_cache_table(self):
-        self.pending_cache = {}
-        self.db_conn.execute("DELETE FROM embedding_cache")
-        self.db_conn.commit()
+        with self.pending_lock:
+            self.pending_cache = {}
+            self.pending_bytes = 0
+        self.accessed_keys = set()
+        self.backend.clear()
 
     def close(self):
-        self.conn_pool.close_all()
+        self.backend.close()
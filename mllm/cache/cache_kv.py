@@ -1,16 +1,25 @@
 from __future__ import annotations
 
-import hashlib
+import asyncio
+import functools
 import json
-import os
-from datetime import date
-from typing import Dict, Optional, Set
+import threading
+import warnings
+from typing import Callable, Dict, List, Optional, Set, Tuple
 
-from mllm.cache.conn_pool import ConnPool
+from mllm.cache.backend import CacheBackend, ProgressBar, SQLiteBackend, open_kv_backend
+from mllm.cache.compression import decode_value, encode_value
+from mllm.cache.conn_pool import write_transaction
+from mllm.cache.hashing import check_hash_version, delete_legacy_rows, drop_legacy_table, get_canonical_hash, \
+    get_legacy_hash, read_legacy_rows
+from mllm.cache.eviction import EvictionPolicy
+from mllm.cache.lease import CacheLease
+from mllm.cache.lru import LRUCache
+from mllm.cache.single_flight import SingleFlight, Flight
 
 
 def get_hash(data: any) -> str:
-    return hashlib.sha1(json.dumps(data).encode("utf-8")).hexdigest()
+    return get_canonical_hash(data)
 
 
 class Cache:
@@ -48,42 +57,60 @@ CacheTable = Dict[str, Cache]
 
 
 class CacheTableKV:
-    def __init__(self, cache_path: str):
+    def __init__(self, cache_path: str, backend: Optional[CacheBackend] = None):
+        """
+        :param cache_path: the path of the SQLite file. Also the name of the table in the cache service.
+        :param backend: the store of the rows. Default is the SQLite file at cache_path.
+        """
         self.cache_path = cache_path
         # List of pending cache
-        self.pending_cache: Dict[str, Cache] = {}
+        self.pending_cache: Dict[Tuple[str, str], Cache] = {}
+        self.pending_lock = threading.Lock()
+        # Number of rows written in one transaction
+        self.flush_batch_size = 1000
+        # Called with the number of pending cache when a cache is added
+        self.on_pending: Optional[Callable[[int], None]] = None
         # List of active cache. Used for garbage collection
         self.active_cache_hash: Set[str] = set()
+        # Keys read since the last write. Their last access time is updated for eviction
+        self.accessed_keys: Set[Tuple[str, str]] = set()
         #
         self.types_to_refresh: Set[str] = set()
         #
         self.refresh_all: bool = False
         #
         self.inactive = False
-
-        db_path = cache_path
-        db_exist = os.path.exists(db_path)
-        db_dir = os.path.dirname(db_path)
-        # create the directory if not exist
-        if len(db_dir) != 0:
-            if not os.path.exists(db_dir):
-                os.makedirs(db_dir, exist_ok=True)
-        self.conn_pool = ConnPool(db_path)
-        if not db_exist:
-            self.create_cache_table()
-
-    def create_cache_table(self):
-        db_conn = self.conn_pool.get_conn()
-        cursor = db_conn.cursor()
-        cursor.execute('''CREATE TABLE cache_table
-                         (hash TEXT PRIMARY KEY,
-                         type text,
-                         value text,
-                         date text,
-                         meta text)''')
-        db_conn.commit()
+        # Identical calls in flight. Used for request coalescing
+        self.in_flight = SingleFlight()
+        # In-memory front tier of the database
+        self.lru = LRUCache()
+        # Leases shared with the other processes. Only set in multi-process mode
+        self.lease: Optional[CacheLease] = None
+
+        self.backend: CacheBackend = backend if backend is not None else open_kv_backend(cache_path)
+        # The connections of the SQLite file. None for the other backends
+        self.conn_pool = self.backend.conn_pool if isinstance(self.backend, SQLiteBackend) else None
+        # Whether the database has a legacy table of the rows keyed by the legacy hash.
+        # They are looked up on misses and moved back to the table, and the legacy table is dropped once empty.
+        self.legacy_hash = self.conn_pool is not None and check_hash_version(self.conn_pool.get_conn())
+
+    def set_multi_process(self, enabled=True, lease_ttl: float = None, poll_interval: float = None):
+        """
+        In multi-process mode, identical calls in different processes are deduplicated by leases in the database,
+        and the result of a leased call is written immediately so that the waiting processes can read it.
+        """
+        if not enabled:
+            self.lease = None
+        elif self.conn_pool is None:
+            warnings.warn("The multi-process mode only applies to the SQLite backend")
+        else:
+            self.lease = CacheLease(self.conn_pool, lease_ttl, poll_interval)
 
     def save_all_cache_to_file(self, filter_unused_cache=False):
+        if filter_unused_cache and self.lease is not None:
+            warnings.warn("Unused cache is not removed in multi-process mode, "
+                          "because it may be used by the other processes")
+            filter_unused_cache = False
         if filter_unused_cache:
             n_remove = self.filter_unused_cache()
             if n_remove > 0:
@@ -92,14 +119,19 @@ class CacheTableKV:
 
     def filter_unused_cache(self) -> int:
         # remove all the rows whose hash is not in self.active_cache_hash
-        db_conn = self.conn_pool.get_conn()
-        cursor = db_conn.cursor()
-        n_rows = cursor.execute("SELECT COUNT(*) FROM cache_table").fetchone()[0]
-        cursor.execute("DELETE FROM cache_table WHERE hash NOT IN ({})".format(
-            ",".join(["?"] * len(self.active_cache_hash))), tuple(self.active_cache_hash))
-        n_rows_after = cursor.execute("SELECT COUNT(*) FROM cache_table").fetchone()[0]
-        db_conn.commit()
-        return n_rows - n_rows_after
+        progress = ProgressBar("Removing unused cache")
+        try:
+            n_deleted = self.backend.delete_unused(set(self.active_cache_hash), progress)
+        finally:
+            progress.close()
+        if self.legacy_hash:
+            # The legacy rows not read by now are unused as well
+            n_deleted += write_transaction(self.conn_pool.get_conn(),
+                                           lambda cursor: drop_legacy_table(cursor, self.backend.table))
+            self.legacy_hash = False
+        if n_deleted > 0:
+            self.lru.clear()
+        return n_deleted
 
     def read_cache(self, input: any, type: str, create_cache=True) -> Cache | None:
 
@@ -107,16 +139,109 @@ class CacheTableKV:
             return None
         hash = get_hash(input)
 
+        res = self.lru.get((hash, type))
+        if res is None:
+            res = self.backend.get((hash, type))
+            if res is not None:
+                res = (decode_value(res[0]), res[1])
+                self.lru.put((hash, type), res[0], res[1])
+            elif self.legacy_hash:
+                res = self._read_legacy({(hash, type): input}).get((hash, type))
+        return self._make_cache(hash, input, type, res, create_cache)
+
+    def read_many(self, inputs: List[any], types: List[str], create_cache=True) -> List[Cache | None]:
+        """
+        Read the cache of many inputs with a few queries
+        :param inputs: the inputs to look up
+        :param types: the type of each input
+        :param create_cache: whether to create pending caches for the misses
+        :return: the caches in the order of inputs, with the same semantics as `read_cache`
+        """
+        if self.inactive:
+            return [None] * len(inputs)
+        hashes = [get_hash(input) for input in inputs]
+
+        rows = {}
+        keys_to_query = set()
+        for hash, type in zip(hashes, types):
+            res = self.lru.get((hash, type))
+            if res is not None:
+                rows[(hash, type)] = res
+            else:
+                keys_to_query.add((hash, type))
+
+        if len(keys_to_query) > 0:
+            for key, (value, meta) in self.backend.get_many(list(keys_to_query)).items():
+                value = decode_value(value)
+                rows[key] = (value, meta)
+                self.lru.put(key, value, meta)
+            if self.legacy_hash:
+                missed = {(hash, type): input for input, type, hash in zip(inputs, types, hashes)
+                          if (hash, type) not in rows}
+                rows.update(self._read_legacy(missed))
+
+        caches = []
+        # The same pending cache is shared by the identical inputs
+        created = {}
+        for input, type, hash in zip(inputs, types, hashes):
+            if (hash, type) in created:
+                caches.append(created[(hash, type)])
+                continue
+            cache = self._make_cache(hash, input, type, rows.get((hash, type)), create_cache)
+            if cache is not None and not cache.is_valid():
+                created[(hash, type)] = cache
+            caches.append(cache)
+        return caches
+
+    def _read_legacy(self, inputs: Dict[Tuple[str, str], any]) -> Dict[Tuple[str, str], Tuple[any, str]]:
+        """
+        Read the rows of the inputs in the legacy table, and move them to the table under the current hash
+        :param inputs: the map from the current keys to the inputs
+        :return: the map from the current keys to (value, meta)
+        """
+        if len(inputs) == 0:
+            return {}
+        legacy_keys = {}
+        for (hash, type), input in inputs.items():
+            # The rows written before the migration by the current hash are in the legacy table as well
+            legacy_keys[(hash, type)] = (hash, type)
+            try:
+                legacy_keys[(get_legacy_hash(input), type)] = (hash, type)
+            except TypeError:
+                continue
         db_conn = self.conn_pool.get_conn()
-        cursor = db_conn.cursor()
-        cursor.execute("SELECT value, meta FROM cache_table WHERE hash = ? AND type = ?", (hash, type))
-        db_conn.commit()
-        res = cursor.fetchone()
-
+        rows = read_legacy_rows(db_conn, self.backend.table, list(legacy_keys.keys()))
+        if rows is None:
+            self.legacy_hash = False
+            return {}
+        if len(rows) == 0:
+            return {}
+        found = {}
+        for legacy_key, (value, meta) in rows.items():
+            key = legacy_keys[legacy_key]
+            found[key] = Cache(decode_value(value), key[0], inputs[key], key[1], meta)
+        batch = list(found.values())
+
+        def move(cursor):
+            self.backend.write_rows(cursor, self._get_rows(batch))
+            return delete_legacy_rows(cursor, self.backend.table, list(rows.keys()))
+
+        if write_transaction(db_conn, move):
+            self.legacy_hash = False
+        self._on_written(batch)
+        return {key: (cache.value, cache.meta) for key, cache in found.items()}
+
+    def _make_cache(self, hash: str, input: any, type: str, res, create_cache: bool) -> Cache | None:
         meta = {}
         cache_value = None
+        pending = self.pending_cache.get((hash, type))
         if res is None:
-            un_hit = True
+            # The cache may be set but not saved yet
+            if pending is not None and pending.is_valid():
+                cache_value, meta = pending.value, pending.meta or {}
+                un_hit = False
+            else:
+                un_hit = True
         else:
             cache_value, meta = res
             if meta != "None":
@@ -129,6 +254,9 @@ class CacheTableKV:
             un_hit = True
         if un_hit:
             if create_cache:
+                # Share the pending cache with the identical call in flight so that its result is not lost
+                if pending is not None and not pending.is_valid():
+                    return pending
                 new_cache = Cache(None, hash, input, type, meta)
                 self.add_cache(new_cache)
                 return new_cache
@@ -137,32 +265,145 @@ class CacheTableKV:
 
         cache_hit = Cache(cache_value, hash, input, type, meta)
         self.active_cache_hash.add(hash)
+        self.accessed_keys.add((hash, type))
 
         return cache_hit
 
+    async def aread_cache(self, input: any, type: str, create_cache=True) -> Cache | None:
+        """
+        The asyncio version of `read_cache`. The query to the backend runs in the default executor
+        so that the event loop is not blocked.
+        """
+        if self.inactive:
+            return None
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(self.read_cache, input, type, create_cache))
+
+    def join_flight(self, cache: Cache) -> Flight:
+        """
+        Join the flight computing the value of the cache. See `SingleFlight`.
+        In multi-process mode, the leader in this process also waits for the identical call in the other processes.
+        """
+        key = (cache.hash, cache.type)
+        flight = self.in_flight.join(key)
+        if not flight.is_leader or self.lease is None or cache.type in self.types_to_refresh or self.refresh_all:
+            return flight
+        row = self.lease.wait_or_acquire(cache.hash, cache.type)
+        if row is None:
+            flight.on_finish = functools.partial(self._finish_leased_flight, cache)
+            return flight
+        # Another process has computed the value
+        with self.pending_lock:
+            if self.pending_cache.get(key) is cache:
+                del self.pending_cache[key]
+        value = decode_value(row[0])
+        self.lru.put(key, value, row[1])
+        self.active_cache_hash.add(cache.hash)
+        flight.finish(value)
+        return Flight(self.in_flight, key, flight.future, is_leader=False)
+
+    async def ajoin_flight(self, cache: Cache) -> Flight:
+        """
+        The asyncio version of `join_flight`. Waiting for the other processes runs in the default executor.
+        """
+        if self.lease is None:
+            return self.join_flight(cache)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.join_flight, cache)
+
+    def _finish_leased_flight(self, cache: Cache, result, exception):
+        """
+        Write the result and release the lease in one transaction
+        """
+        batch = [cache] if exception is None and cache.is_valid() else []
+
+        def write(cursor):
+            self.backend.write_rows(cursor, self._get_rows(batch))
+            self.lease.release(cursor, cache.hash, cache.type)
+
+        write_transaction(self.conn_pool.get_conn(), write)
+        self._on_written(batch)
+
     def add_cache(self, cache: Cache):
-        self.pending_cache[cache.hash] = cache
+        with self.pending_lock:
+            self.pending_cache[(cache.hash, cache.type)] = cache
+            n_pending = len(self.pending_cache)
+        if self.on_pending is not None:
+            self.on_pending(n_pending)
 
     def apply_cache_update(self):
-        remaining_cache = {}
-        db_conn = self.conn_pool.get_conn()
-        cursor = db_conn.cursor()
-        for hash, cache in list(self.pending_cache.items()):
-            if cache.is_valid():
+        """
+        Write the valid pending cache to the backend, with one write per `flush_batch_size` rows.
+        It is safe to call this from another thread while the cache is being read and set.
+        """
+        with self.pending_lock:
+            caches_to_write = [cache for cache in self.pending_cache.values() if cache.is_valid()]
+            accessed_keys = self.accessed_keys
+            self.accessed_keys = set()
+        for i in range(0, len(caches_to_write), self.flush_batch_size):
+            batch = caches_to_write[i:i + self.flush_batch_size]
+            self.backend.put_many(self._get_rows(batch))
+            self._on_written(batch)
+        # The written rows already have the current time
+        accessed_keys.difference_update((cache.hash, cache.type) for cache in caches_to_write)
+        if len(accessed_keys) > 0:
+            self.backend.touch(list(accessed_keys))
+
+    def write_caches(self, caches: List[Cache]):
+        """
+        Write the given pending caches now in one transaction, e.g. the results of a batch.
+        The other pending cache is left to `apply_cache_update`.
+        """
+        with self.pending_lock:
+            batch = [cache for cache in caches
+                     if cache.is_valid() and self.pending_cache.get((cache.hash, cache.type)) is cache]
+        if len(batch) == 0:
+            return
+        rows = self._get_rows(batch)
+        if isinstance(self.backend, SQLiteBackend):
+            write_transaction(self.conn_pool.get_conn(), lambda cursor: self.backend.write_rows(cursor, rows))
+        else:
+            self.backend.put_many(rows)
+        self._on_written(batch)
+
+    def evict(self, policy: EvictionPolicy) -> int:
+        """
+        Remove the rows beyond the limits of the policy from the backend and the memory
+        :return: the number of rows removed
+        """
+        n_deleted = self.backend.evict(policy)
+        if self.legacy_hash:
+            # The legacy rows not read by now are unused as well
+            n_deleted += write_transaction(self.conn_pool.get_conn(),
+                                           lambda cursor: drop_legacy_table(cursor, self.backend.table))
+            self.legacy_hash = False
+        if n_deleted > 0:
+            self.lru.clear()
+        return n_deleted
+
+    @staticmethod
+    def _get_rows(batch: List[Cache]):
+        return [(cache.hash, cache.type, encode_value(cache.value), str(cache.meta)) for cache in batch]
+
+    def _on_written(self, batch: List[Cache]):
+        # Remove the written caches only after they are committed, so that they are always readable
+        with self.pending_lock:
+            for cache in batch:
                 self.active_cache_hash.add(cache.hash)
-                cursor.execute("INSERT OR REPLACE INTO cache_table VALUES (?, ?, ?, ?, ?)",
-                               (cache.hash, cache.type, cache.value, str(date.today()), str(cache.meta)))
+                self.lru.put((cache.hash, cache.type), cache.value, str(cache.meta))
+                if self.pending_cache.get((cache.hash, cache.type)) is cache:
+                    del self.pending_cache[(cache.hash, cache.type)]
 
-            else:
-                remaining_cache[hash] = cache
-        db_conn.commit()
-        self.pending_cache = remaining_cache
+    def has_pending_update(self) -> bool:
+        with self.pending_lock:
+            return any(cache.is_valid() for cache in self.pending_cache.values())
 
     def discard_cache_update(self):
-        self.pending_cache = {}
+        with self.pending_lock:
+            self.pending_cache = {}
 
     def close(self):
-        self.conn_pool.close_all()
+        self.backend.close()
 
 
 
@@ -3,10 +3,21 @@ from __future__ import annotations
 import os
 import atexit
 import sys
-from typing import List
-
-from mllm.cache.cache_embedding import CacheTableEmbed
-from mllm.cache.cache_kv import CacheTableKV
+import threading
+import time
+import warnings
+from typing import List, Optional
+
+from mllm.cache.cache_embedding import CacheTableEmbed, default_embed_pending_config
+from mllm.cache.cache_kv import CacheTableKV, Cache
+from mllm.cache.conn_pool import sqlite_options
+from mllm.cache.eviction import EvictionPolicy
+from mllm.cache.flusher import CacheFlusher
+from mllm.cache.lru import default_lru_config
+from mllm.cache.precision import EmbeddingPrecision, embedding_precisions
+from mllm.cache.backend_flat import FlatFileBackend
+from mllm.cache.backend_http import HTTPBackend
+from mllm.cache.single_flight import Flight
 
 def get_main_path():
     return os.path.abspath(sys.argv[0])
@@ -25,48 +36,281 @@ class CacheService:
         main_path = get_main_path()
         self.postfix_stack = [os.path.basename(main_path)]
         self.base_path = os.path.dirname(main_path)
+        # Writes the pending cache in the background
+        self.flusher = CacheFlusher(self)
+        self.save_lock = threading.Lock()
+        # The arguments of set_multi_process of the KV caches. None if not in multi-process mode
+        self.multi_process_config = None
+        # The URL of the cache server. None if the caches are local files
+        self.server_url: Optional[str] = None
+        # "sqlite" or "flat", the store of the local embedding caches
+        self.embedding_store = "sqlite"
+        # The eviction policies of the KV and embedding caches, applied by the flusher every eviction_interval seconds
+        self.kv_eviction: Optional[EvictionPolicy] = None
+        self.embedding_eviction: Optional[EvictionPolicy] = None
+        self.eviction_interval = 3600.0
+        self.last_eviction = 0.0
+        self.evict_lock = threading.Lock()
         cache_path = get_cache_path(self.base_path, self.postfix_stack)
-        self._cache_kv: CacheTableKV = CacheTableKV(cache_path)
-        self.cache_embed: CacheTableEmbed = CacheTableEmbed(os.path.dirname(cache_path))
+        self._cache_kv: CacheTableKV = self._new_cache_kv(cache_path)
+        self.cache_embed: CacheTableEmbed = self._new_cache_embed(os.path.dirname(cache_path), "")
         self.cache_kv_other = {self._cache_kv.cache_path: self._cache_kv}
-        self.cache_embed_other = {self._cache_kv.cache_path: self.cache_embed}
+        self.cache_embed_other = {(os.path.dirname(cache_path), ""): self.cache_embed}
         self.cache_kv_disabled = False
 
     def read_kv_cache(self, key: str, type: str):
         if self.cache_kv_disabled:
             return None
         return self._cache_kv.read_cache(key, type)
-    
+
+    def read_kv_cache_many(self, keys: List[any], types: List[str]):
+        if self.cache_kv_disabled:
+            return [None] * len(keys)
+        return self._cache_kv.read_many(keys, types)
+
+    def write_kv_caches(self, caches: List[Cache]):
+        """
+        Write the given pending KV caches now in one transaction. See `CacheTableKV.write_caches`.
+        """
+        self._cache_kv.write_caches(caches)
+
+    def join_kv_flight(self, cache: Cache) -> Flight:
+        """
+        Join the flight of the identical calls that are computing the cache
+        """
+        return self._cache_kv.join_flight(cache)
+
+    async def ajoin_kv_flight(self, cache: Cache) -> Flight:
+        return await self._cache_kv.ajoin_flight(cache)
+
+    async def aread_kv_cache(self, key: str, type: str):
+        if self.cache_kv_disabled:
+            return None
+        return await self._cache_kv.aread_cache(key, type)
+
+    def set_memory_cache(self, max_entries: int = None, max_bytes: int = None):
+        """
+        Set the bounds of the in-memory LRU in front of the KV cache databases. Set max_entries to 0 to disable it.
+        """
+        if max_entries is not None:
+            default_lru_config["max_entries"] = max_entries
+        if max_bytes is not None:
+            default_lru_config["max_bytes"] = max_bytes
+        for cache_kv in self._all_cache_kv():
+            cache_kv.lru.resize(max_entries, max_bytes)
+
+    def enable_multi_process(self, lease_ttl: float = None, poll_interval: float = None, shared_volume=False):
+        """
+        Enable the multi-process mode, for the processes sharing the same cache files.
+        Identical calls in different processes are made only once, the writes are retried when the database is busy,
+        and `save_used` does not remove the cache that may be used by the other processes.
+        The default WAL journal of SQLite only works for the processes on the same machine.
+        Set shared_volume when the cache files are on a network file system shared by several machines.
+        :param lease_ttl: the seconds after which a call of a crashed process is taken over
+        :param poll_interval: the seconds between two checks of the call in another process
+        :param shared_volume: whether to switch the databases to the rollback journal, which does not need
+        the memory shared by the processes. It should be set by all the processes before they use the cache.
+        """
+        self.multi_process_config = {"lease_ttl": lease_ttl, "poll_interval": poll_interval}
+        if shared_volume:
+            sqlite_options["journal_mode"] = "DELETE"
+            with self.save_lock:
+                # The new connections switch the databases to the new journal mode
+                for cache in [*self._all_cache_kv(), *self._all_cache_embed()]:
+                    if cache.conn_pool is not None:
+                        cache.conn_pool.close_all()
+        for cache_kv in self._all_cache_kv():
+            cache_kv.set_multi_process(True, **self.multi_process_config)
+
+    def disable_multi_process(self):
+        self.multi_process_config = None
+        for cache_kv in self._all_cache_kv():
+            cache_kv.set_multi_process(False)
+
+    def set_eviction(self, kv: EvictionPolicy = None, embedding: EvictionPolicy = None, interval: float = None):
+        """
+        Set the limits of the caches. The rows beyond them are removed in the background every interval seconds.
+        :param kv: the policy of the KV caches, with the cache types like "chat_gpt-4o" as keys
+        :param embedding: the policy of the embedding caches, with the model names as keys
+        :param interval: the seconds between two evictions
+        """
+        self.kv_eviction = kv
+        self.embedding_eviction = embedding
+        if interval is not None:
+            self.eviction_interval = interval
+        self.flusher.start()
+
+    def evict(self) -> int:
+        """
+        Apply the eviction policies now
+        :return: the number of rows removed
+        """
+        with self.evict_lock:
+            self.last_eviction = time.time()
+            n_deleted = 0
+            if self.kv_eviction is not None:
+                for cache_kv in self._all_cache_kv():
+                    n_deleted += cache_kv.evict(self.kv_eviction)
+            if self.embedding_eviction is not None:
+                for cache_embed in self._all_cache_embed():
+                    n_deleted += cache_embed.evict(self.embedding_eviction)
+            return n_deleted
+
+    def evict_if_due(self):
+        if self.kv_eviction is None and self.embedding_eviction is None:
+            return
+        if time.time() - self.last_eviction >= self.eviction_interval:
+            self.evict()
+
+    def set_embedding_budget(self, max_pending_bytes: int):
+        """
+        Set the bytes of the new embeddings kept in memory before they are flushed to the database
+        """
+        default_embed_pending_config["max_pending_bytes"] = max_pending_bytes
+        for cache_embed in self._all_cache_embed():
+            cache_embed.max_pending_bytes = max_pending_bytes
+
+    def set_embedding_precision(self, model: str, dtype: str = "float32", dim: Optional[int] = None):
+        """
+        Set the precision of the embeddings of a model in the cache, `get_embeddings` and `VectorStore`
+        :param dtype: "float32", "float16", or "int8" with a scale per vector
+        :param dim: the number of dimensions kept from the start of the embeddings. None to keep all
+        """
+        precision = EmbeddingPrecision(dtype, dim)
+        with self.save_lock:
+            # The pending embeddings are encoded in the previous precision
+            for cache_embed in self._all_cache_embed():
+                cache_embed.save_pending_cache()
+            if precision.is_default():
+                embedding_precisions.pop(model, None)
+            else:
+                embedding_precisions[model] = precision
+
     def disable_cache_kv(self):
         self.cache_kv_disabled = True
 
     def enable_cache_kv(self):
         self.cache_kv_disabled = False
 
+    def use_cache_server(self, url: Optional[str]):
+        """
+        Serve the caches by a cache server, which is started by `python -m mllm.cache.server`.
+        The caches of the same script name are shared by all the machines using the server.
+        :param url: the URL of the server. None to use the local files again.
+        """
+        with self.save_lock:
+            for cache_kv in self._all_cache_kv():
+                cache_kv.apply_cache_update()
+            for cache_embed in self._all_cache_embed():
+                cache_embed.save_pending_cache()
+            self.close()
+            self.server_url = url
+            self.cache_kv_other = {}
+            self.cache_embed_other = {}
+            self._load_cache_on_path(self.postfix_stack)
+
+    def set_embedding_store(self, store: str):
+        """
+        Set the store of the local embedding caches. The embeddings in the previous store are not moved.
+        :param store: "sqlite" for a SQLite file per cache, or "flat" for the flat files of each model,
+        which are mapped into memory without reading them. See `mllm.cache.backend_flat`.
+        """
+        if store not in ("sqlite", "flat"):
+            raise ValueError(f"Unknown embedding store {store}")
+        with self.save_lock:
+            for cache_embed in self._all_cache_embed():
+                cache_embed.save_pending_cache()
+                cache_embed.close()
+            self.embedding_store = store
+            self.cache_embed_other = {key: self._new_cache_embed(*key) for key in list(self.cache_embed_other)}
+            cache_dir = os.path.dirname(get_cache_path(self.base_path, self.postfix_stack))
+            self.cache_embed = self.cache_embed_other[(cache_dir, "".join(["." + p for p in self.postfix_stack[1:]]))]
+
+    def _new_cache_kv(self, cache_path: str) -> CacheTableKV:
+        backend = None
+        if self.server_url is not None:
+            # The name of the file is the name of the table on the server
+            namespace = os.path.basename(cache_path)[:-len(".db")]
+            backend = HTTPBackend(self.server_url, "kv", namespace)
+        cache_kv = CacheTableKV(cache_path, backend)
+        cache_kv.on_pending = self.flusher.on_pending
+        if self.multi_process_config is not None:
+            cache_kv.set_multi_process(True, **self.multi_process_config)
+        return cache_kv
+
+    def _new_cache_embed(self, cache_dir: str, postfix: str) -> CacheTableEmbed:
+        backend = None
+        if self.server_url is not None:
+            backend = HTTPBackend(self.server_url, "embedding", "embedding" + postfix)
+        elif self.embedding_store == "flat":
+            backend = FlatFileBackend(os.path.join(cache_dir, f"embedding_flat{postfix}"))
+        cache_embed = CacheTableEmbed(cache_dir, postfix, backend)
+        cache_embed.on_pending = self.flusher.on_over_budget
+        return cache_embed
+
+    def _all_cache_kv(self) -> List[CacheTableKV]:
+        """
+        A snapshot of the loaded KV caches, which can be iterated while another thread switches the postfix
+        """
+        return list({id(c): c for c in [self._cache_kv, *self.cache_kv_other.values()]}.values())
+
+    def _all_cache_embed(self) -> List[CacheTableEmbed]:
+        return list({id(c): c for c in [self.cache_embed, *self.cache_embed_other.values()]}.values())
+
     def save(self):
-        self._cache_kv.save_all_cache_to_file()
-        for cache_kv in self.cache_kv_other.values():
-            cache_kv.save_all_cache_to_file()
-        self.cache_embed.save_pending_cache()
-        for cache_embed in self.cache_embed_other.values():
-            cache_embed.save_pending_cache()
-
-    def save_used(self):
-        self._cache_kv.save_all_cache_to_file(filter_unused_cache=True)
-        for cache_kv in self.cache_kv_other.values():
-            cache_kv.save_all_cache_to_file(filter_unused_cache=True)
-        # TODO: save only used embedding cache
-        self.cache_embed.save_pending_cache()
+        with self.save_lock:
+            for cache_kv in self._all_cache_kv():
+                cache_kv.save_all_cache_to_file()
+            for cache_embed in self._all_cache_embed():
+                cache_embed.save_pending_cache()
+
+    def flush(self):
+        """
+        Write the pending cache now and wait until it is written
+        """
+        self.flusher.flush()
+
+    def wait(self):
+        """
+        Wait until all the cache that is set is written
+        """
+        self.flusher.wait()
+
+    def has_pending_update(self) -> bool:
+        if any(cache_kv.has_pending_update() for cache_kv in self._all_cache_kv()):
+            return True
+        return any(cache_embed.has_pending_update() for cache_embed in self._all_cache_embed())
+
+    def save_used(self, filter_embedding=False):
+        """
+        Save the cache and remove the cache not used in this run
+        :param filter_embedding: whether to also remove the unused embeddings.
+        They are shared by the scripts in the same directory, so the embeddings of the other scripts are removed too.
+        """
+        filter_kv = True
+        if self.multi_process_config is not None:
+            warnings.warn("Unused cache is not removed in multi-process mode, "
+                          "because it may be used by the other processes")
+            filter_kv = False
+            filter_embedding = False
+        with self.save_lock:
+            for cache_kv in self._all_cache_kv():
+                cache_kv.save_all_cache_to_file(filter_unused_cache=filter_kv)
+            for cache_embed in self._all_cache_embed():
+                if filter_embedding:
+                    n_remove = cache_embed.filter_unused_cache()
+                    if n_remove > 0:
+                        print(f"Removed {n_remove} unused embeddings")
+                cache_embed.save_pending_cache()
 
     def close(self):
-        self.cache_embed.close()
-        for cache_embed in self.cache_embed_other.values():
+        for cache_embed in self._all_cache_embed():
             cache_embed.close()
-        self._cache_kv.close()
-        for cache_kv in self.cache_kv_other.values():
+        for cache_kv in self._all_cache_kv():
             cache_kv.close()
 
     def at_exit(self):
+        self.flusher.stop()
         self.save()
         self.close()
 
@@ -94,15 +338,15 @@ class CacheService:
         if kv_cache_path in self.cache_kv_other:
             self._cache_kv = self.cache_kv_other[kv_cache_path]
         else:
-            self._cache_kv = CacheTableKV(kv_cache_path)
+            self._cache_kv = self._new_cache_kv(kv_cache_path)
             self.cache_kv_other[kv_cache_path] = self._cache_kv
 
         embed_cache_postfix = "".join(["."+p for p in postfix[1:]])
 
-        if cache_dir in self.cache_embed_other:
+        if (cache_dir, embed_cache_postfix) in self.cache_embed_other:
             self.cache_embed = self.cache_embed_other[(cache_dir, embed_cache_postfix)]
         else:
-            self.cache_embed = CacheTableEmbed(cache_dir, embed_cache_postfix)
+            self.cache_embed = self._new_cache_embed(cache_dir, embed_cache_postfix)
             self.cache_embed_other[(cache_dir, embed_cache_postfix)] = self.cache_embed
 
     def push_postfix(self, postfix):
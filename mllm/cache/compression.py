@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+import lzma
+import zlib
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+"""
+# Compression of the KV cache values
+
+Values shorter than `min_size` are stored as text as before. Longer values are stored as a blob of
+a marker byte, a codec byte and the compressed UTF-8 text, so that each row records its own codec.
+"""
+
+marker = b"\x00"
+codec_ids: Dict[str, bytes] = {"zlib": b"\x01", "lzma": b"\x02", "zstd": b"\x03"}
+codec_names: Dict[bytes, str] = {v: k for k, v in codec_ids.items()}
+
+
+@dataclass
+class CompressionOptions:
+    """
+    The compression of the values written to the KV cache. Set codec to None to write raw text.
+    """
+    # "zlib", "lzma", or "zstd" if the zstandard package is installed
+    codec: Optional[str] = "zlib"
+    # Values shorter than this number of characters are not compressed
+    min_size: int = 1024
+    # Compression level. None for the default of the codec
+    level: Optional[int] = None
+
+    def __getitem__(self, item):
+        return getattr(self, item)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def get_dict(self):
+        return {k: v for k, v in self.__dict__.items() if v is not None}
+
+
+compression_options = CompressionOptions()
+
+
+def _import_zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("Please install the `zstandard` package to use the zstd codec")
+    return zstandard
+
+
+def compress(data: bytes, codec: str, level: Optional[int] = None) -> bytes:
+    if codec == "zlib":
+        return zlib.compress(data, level if level is not None else 6)
+    if codec == "lzma":
+        return lzma.compress(data, preset=level if level is not None else 6)
+    if codec == "zstd":
+        return _import_zstd().ZstdCompressor(level=level if level is not None else 3).compress(data)
+    raise ValueError(f"Unknown codec {codec}")
+
+
+def decompress(data: bytes, codec: str) -> bytes:
+    if codec == "zlib":
+        return zlib.decompress(data)
+    if codec == "lzma":
+        return lzma.decompress(data)
+    if codec == "zstd":
+        return _import_zstd().ZstdDecompressor().decompress(data)
+    raise ValueError(f"Unknown codec {codec}")
+
+
+def encode_value(value: any, options: CompressionOptions = None) -> any:
+    """
+    :return: the value to store. It is the value itself if it is not compressed.
+    """
+    if options is None:
+        options = compression_options
+    if options.codec is None or not isinstance(value, str) or len(value) < options.min_size:
+        return value
+    data = value.encode("utf-8")
+    payload = compress(data, options.codec, options.level)
+    compressed = marker + codec_ids[options.codec] + payload
+    # Incompressible values are kept as text
+    if len(compressed) >= len(data):
+        return value
+    return compressed
+
+
+def decode_value(stored: any) -> any:
+    """
+    :return: the value of a stored value, which may be compressed or not
+    """
+    if not isinstance(stored, bytes) or len(stored) < 2 or stored[:1] != marker:
+        return stored
+    codec = codec_names.get(stored[1:2])
+    if codec is None:
+        return stored
+    return decompress(stored[2:], codec).decode("utf-8")
+
+
+def get_codec(stored: any) -> Optional[str]:
+    """
+    :return: the codec of a stored value, or None if it is not compressed
+    """
+    if not isinstance(stored, bytes) or len(stored) < 2 or stored[:1] != marker:
+        return None
+    return codec_names.get(stored[1:2])
@@ -1,12 +1,57 @@
 from __future__ import annotations
 
+import random
 import sqlite3
 import threading
+import time
+from dataclasses import dataclass
+from typing import Callable
+
+
+@dataclass
+class SQLiteOptions:
+    """
+    The pragmas applied when a connection to a cache database is opened. Set an option to None to keep the default.
+    """
+    # Only applies to new databases. Lets the eviction return the free pages to the file system.
+    auto_vacuum: str = "INCREMENTAL"
+    journal_mode: str = "WAL"
+    synchronous: str = "NORMAL"
+    mmap_size: int = 256 * 1024 * 1024
+    # Negative values are in KiB
+    cache_size: int = -64 * 1024
+    # In milliseconds
+    busy_timeout: int = 10000
+    temp_store: str = "MEMORY"
+
+    def __getitem__(self, item):
+        return getattr(self, item)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def get_dict(self):
+        return {k: v for k, v in self.__dict__.items() if v is not None}
+
+
+sqlite_options = SQLiteOptions()
+
+
+def connect(db_path: str, options: SQLiteOptions = None) -> sqlite3.Connection:
+    if options is None:
+        options = sqlite_options
+    pragmas = options.get_dict()
+    timeout = pragmas.get("busy_timeout", 5000) / 1000
+    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=timeout)
+    for name, value in pragmas.items():
+        conn.execute(f"PRAGMA {name}={value}")
+    return conn
 
 
 class ConnPool:
-    def __init__(self, db_path: str):
+    def __init__(self, db_path: str, options: SQLiteOptions = None):
         self.db_path = db_path
+        self.options = options
         self.conn_pool = {}
         self.threads = {}
         self.max_conn = 50
@@ -22,7 +67,7 @@ class ConnPool:
         with self.lock_for_closing:
             # Add a new connection if the thread does not have one
             if thread_id not in self.conn_pool:
-                self.conn_pool[thread_id] = sqlite3.connect(self.db_path, check_same_thread=False)
+                self.conn_pool[thread_id] = connect(self.db_path, self.options)
                 self.threads[thread_id] = current_thread
             if len(self.conn_pool) >= self.max_conn:
                 # remove the connections that is not running
@@ -46,3 +91,32 @@ class ConnPool:
                 conn.close()
             self.conn_pool = {}
             self.threads = {}
+
+
+def is_busy_error(e: Exception) -> bool:
+    message = str(e).lower()
+    return isinstance(e, sqlite3.OperationalError) and ("locked" in message or "busy" in message)
+
+
+def write_transaction(conn: sqlite3.Connection, write: Callable[[sqlite3.Cursor], any], max_retries=8,
+                      retry_wait=0.05):
+    """
+    Run write in an immediate transaction and commit it. The transaction is retried when the database
+    is locked by another process for longer than the busy timeout.
+    :param write: the function doing the writes with the cursor
+    :return: the return value of write
+    """
+    if conn.in_transaction:
+        conn.commit()
+    for attempt in range(max_retries + 1):
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            res = write(conn.cursor())
+            conn.commit()
+            return res
+        except sqlite3.OperationalError as e:
+            if conn.in_transaction:
+                conn.rollback()
+            if not is_busy_error(e) or attempt == max_retries:
+                raise e
+            time.sleep(retry_wait * (2 ** attempt) * (1 + random.random()))
@@ -0,0 +1,39 @@
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Tuple
+
+"""
+# Eviction of the cache tables
+"""
+
+day = 24 * 3600
+
+
+@dataclass
+class EvictionPolicy:
+    """
+    The limits of a cache table. The rows are evicted by their last access time, the least recent first.
+    The keys of ttl and max_rows are cache types (model names in the embedding cache). A key matches the types
+    starting with it, e.g. "chat_" matches all the chat caches, and "*" matches all the rows of the table.
+    Usage: `caching.set_eviction(kv=EvictionPolicy(ttl={"chat_": 30 * day}, max_bytes=2 * 1024 ** 3))`
+    """
+    # Seconds since the last access after which a row is removed
+    ttl: Dict[str, float] = field(default_factory=dict)
+    # Maximum number of rows of the types
+    max_rows: Dict[str, int] = field(default_factory=dict)
+    # Maximum size of the database file in bytes
+    max_bytes: Optional[int] = None
+    # Maximum free pages returned to the file system in one eviction
+    vacuum_pages: int = 10000
+    # Maximum rows deleted in one transaction, so that the readers and writers are not blocked for long
+    delete_batch_size: int = 10000
+
+
+def get_type_condition(type_column: str, type_key: str) -> Tuple[str, tuple]:
+    """
+    :return: the SQL condition matching type_key and its parameters
+    """
+    if type_key == "*":
+        return "1", ()
+    return f"substr({type_column}, 1, ?) = ?", (len(type_key), type_key)
@@ -0,0 +1,117 @@
+from __future__ import annotations
+
+import threading
+import traceback
+
+
+class CacheFlusher:
+    """
+    Write the pending cache of a `CacheService` to the databases in a background thread.
+    A flush happens every `interval` seconds, or earlier when `batch_size` caches are pending,
+    so that the threads setting the cache never wait for SQLite commits.
+    The eviction of the caches also runs in this thread after a flush when it is due.
+    """
+
+    def __init__(self, cache_service, interval=10.0, batch_size=1000):
+        self.cache_service = cache_service
+        self.interval = interval
+        self.batch_size = batch_size
+        self.cond = threading.Condition()
+        self.thread = None
+        self.stopped = False
+        self.flush_requested = False
+        # Number of flushes started and done. Used for waiting for a flush
+        self.n_started = 0
+        self.n_done = 0
+
+    def start(self):
+        with self.cond:
+            if self.stopped or (self.thread is not None and self.thread.is_alive()):
+                return
+            self.thread = threading.Thread(target=self._run, name="mllm-cache-flusher", daemon=True)
+            self.thread.start()
+
+    def is_running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def on_pending(self, n_pending: int):
+        """
+        Called when a cache is added. Start the thread and flush earlier if there are many pending caches.
+        """
+        if not self.is_running():
+            self.start()
+        if n_pending >= self.batch_size:
+            self.request()
+
+    def on_over_budget(self):
+        """
+        Called when the pending embeddings exceed their memory budget. Start the thread and flush now.
+        """
+        if not self.is_running():
+            self.start()
+        self.request()
+
+    def request(self):
+        """
+        Request a flush without waiting for it
+        """
+        with self.cond:
+            self.flush_requested = True
+            self.cond.notify_all()
+
+    def flush(self):
+        """
+        Flush the pending cache and wait until it is written
+        """
+        if not self.is_running():
+            self.cache_service.save()
+            return
+        with self.cond:
+            # Wait for a flush that starts after now
+            target = self.n_started + 1
+            self.flush_requested = True
+            self.cond.notify_all()
+            while self.n_done < target and self.is_running():
+                self.cond.wait(1.0)
+
+    def wait(self):
+        """
+        Wait until all the pending caches that are set are written
+        """
+        while self.cache_service.has_pending_update():
+            self.flush()
+
+    def stop(self):
+        """
+        Stop the thread after writing the pending cache
+        """
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                if not self.flush_requested and not self.stopped:
+                    self.cond.wait(self.interval)
+                self.flush_requested = False
+                self.n_started += 1
+                generation = self.n_started
+                stopped = self.stopped
+            try:
+                self.cache_service.save()
+            except Exception:
+                print("Failed to flush the cache")
+                print(traceback.format_exc())
+            with self.cond:
+                self.n_done = generation
+                self.cond.notify_all()
+            if stopped:
+                return
+            try:
+                self.cache_service.evict_if_due()
+            except Exception:
+                print("Failed to evict the cache")
+                print(traceback.format_exc())
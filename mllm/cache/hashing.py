@@ -0,0 +1,168 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import sqlite3
+from typing import Dict, List, Optional, Tuple
+
+from mllm.cache.conn_pool import write_transaction
+from mllm.cache.lru import LRUCache
+from mllm.cache.schema import cache_table_sql
+
+"""
+# Hashing of the KV cache keys
+
+The keys are hashed by blake2b over a canonical encoding of the data: dicts are hashed in the order
+of sorted keys, and the base64 images in messages are hashed once and referred to by their digest.
+The version of the format is recorded in the databases, and the rows of an older format are kept in a legacy
+table until they are read, see `check_hash_version`.
+"""
+
+hash_format_version = 2
+# Domain of the hashes, so that they never collide with another format
+hash_person = b"mllm-kv-v2"
+digest_size = 20
+
+# Digests of the recent images. The keys are the data URL strings, which are the same objects when
+# the same chat is looked up again, so the lookup is cheap. The keys are counted toward max_bytes,
+# since the cache keeps them alive.
+image_digests = LRUCache(max_entries=64, max_bytes=64 * 1024 * 1024)
+
+
+def get_legacy_hash(data: any) -> str:
+    """
+    The hash of the format 1, used before the canonical hash
+    """
+    return hashlib.sha1(json.dumps(data).encode("utf-8")).hexdigest()
+
+
+def is_image_data(value: str) -> bool:
+    return value.startswith("data:") and ";base64," in value[:100]
+
+
+def get_image_digest(value: str) -> bytes:
+    res = image_digests.get(value)
+    if res is not None:
+        return res[0]
+    digest = hashlib.blake2b(value.encode("utf-8"), digest_size=digest_size).digest()
+    image_digests.put(value, digest, size=len(value) + digest_size)
+    return digest
+
+
+def _feed(hasher, data: any):
+    # Each value is prefixed by a type tag and the containers by their lengths, so that the encoding is unambiguous
+    if data is None:
+        hasher.update(b"n")
+    elif data is True:
+        hasher.update(b"t")
+    elif data is False:
+        hasher.update(b"f")
+    elif isinstance(data, str):
+        if is_image_data(data):
+            hasher.update(b"b")
+            hasher.update(get_image_digest(data))
+        else:
+            encoded = data.encode("utf-8")
+            hasher.update(b"s%d:" % len(encoded))
+            hasher.update(encoded)
+    elif isinstance(data, int):
+        hasher.update(b"i%d;" % data)
+    elif isinstance(data, float):
+        hasher.update(b"d" + repr(data).encode("ascii") + b";")
+    elif isinstance(data, (list, tuple)):
+        hasher.update(b"l%d:" % len(data))
+        for item in data:
+            _feed(hasher, item)
+    elif isinstance(data, dict):
+        hasher.update(b"m%d:" % len(data))
+        for key in sorted(data.keys(), key=str):
+            _feed(hasher, str(key))
+            _feed(hasher, data[key])
+    else:
+        raise TypeError(f"Object of type {type(data).__name__} cannot be used as a cache key")
+
+
+def get_canonical_hash(data: any) -> str:
+    """
+    :return: the hash of the format `hash_format_version`, which does not depend on the order of dict keys
+    """
+    hasher = hashlib.blake2b(digest_size=digest_size, person=hash_person)
+    _feed(hasher, data)
+    return hasher.hexdigest()
+
+
+def get_legacy_table(table: str) -> str:
+    return table + "_legacy"
+
+
+def has_legacy_table(conn: sqlite3.Connection | sqlite3.Cursor, table: str) -> bool:
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                        (get_legacy_table(table),)).fetchone() is not None
+
+
+def check_hash_version(conn: sqlite3.Connection, table: str = "cache_table", create_sql: str = cache_table_sql) -> bool:
+    """
+    Migrate a database of an older hash format once: its table is renamed to the legacy table, whose rows are
+    moved back under the current hash when they are read, and the current format is recorded in the database.
+    :param create_sql: the CREATE TABLE statement of the table, with `{table}` in place of the table name
+    :return: whether the database still has rows of the legacy hash format
+    """
+    if conn.execute("PRAGMA user_version").fetchone()[0] < hash_format_version:
+        def migrate(cursor):
+            # Another process may have migrated the database
+            if cursor.execute("PRAGMA user_version").fetchone()[0] >= hash_format_version:
+                return
+            if cursor.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone() is not None:
+                cursor.execute(f"ALTER TABLE {table} RENAME TO {get_legacy_table(table)}")
+                cursor.execute(f"DROP INDEX IF EXISTS {table}_last_access")
+                cursor.execute(create_sql.format(table=table))
+                cursor.execute(f"CREATE INDEX IF NOT EXISTS {table}_last_access ON {table} (last_access)")
+            cursor.execute(f"PRAGMA user_version = {hash_format_version}")
+
+        write_transaction(conn, migrate)
+    return has_legacy_table(conn, table)
+
+
+def read_legacy_rows(conn: sqlite3.Connection, table: str, keys: List[Tuple[str, str]]) \
+        -> Optional[Dict[Tuple[str, str], Tuple[str, str]]]:
+    """
+    :return: the map from the keys found in the legacy table to (value, meta),
+    or None if another process has dropped the legacy table
+    """
+    if not has_legacy_table(conn, table):
+        return None
+    found = {}
+    cursor = conn.cursor()
+    for key in keys:
+        row = cursor.execute(f"SELECT value, meta FROM {get_legacy_table(table)} WHERE hash = ? AND type = ?",
+                             key).fetchone()
+        if row is not None:
+            found[key] = row
+    return found
+
+
+def delete_legacy_rows(cursor: sqlite3.Cursor, table: str, keys: List[Tuple[str, str]]) -> bool:
+    """
+    Delete the rows that have been moved to the table, and drop the legacy table once it is empty
+    :return: whether the legacy table is dropped
+    """
+    if not has_legacy_table(cursor, table):
+        return True
+    legacy_table = get_legacy_table(table)
+    cursor.executemany(f"DELETE FROM {legacy_table} WHERE hash = ? AND type = ?", keys)
+    if cursor.execute(f"SELECT 1 FROM {legacy_table} LIMIT 1").fetchone() is not None:
+        return False
+    cursor.execute(f"DROP TABLE {legacy_table}")
+    return True
+
+
+def drop_legacy_table(cursor: sqlite3.Cursor, table: str) -> int:
+    """
+    :return: the number of the legacy rows dropped
+    """
+    if not has_legacy_table(cursor, table):
+        return 0
+    legacy_table = get_legacy_table(table)
+    n_rows = cursor.execute(f"SELECT COUNT(*) FROM {legacy_table}").fetchone()[0]
+    cursor.execute(f"DROP TABLE {legacy_table}")
+    return n_rows
@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+import os
+import socket
+import time
+import uuid
+from typing import Optional, Tuple
+
+from mllm.cache.conn_pool import ConnPool, write_transaction
+
+default_lease_config = {
+    # Seconds before the lease of a crashed process can be taken over
+    "ttl": 600.0,
+    # Seconds between two checks of the lease held by another process
+    "poll_interval": 0.2
+}
+
+
+def get_owner_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class CacheLease:
+    """
+    Leases of the cache keys being computed, stored in the cache database so that they are shared by
+    all the processes using it. It extends the single flight of one process to many processes:
+    only the process holding the lease of a key makes the call, and the others wait for its row.
+    """
+
+    def __init__(self, conn_pool: ConnPool, ttl: float = None, poll_interval: float = None):
+        self.conn_pool = conn_pool
+        self.ttl = ttl if ttl is not None else default_lease_config["ttl"]
+        self.poll_interval = poll_interval if poll_interval is not None else default_lease_config["poll_interval"]
+        self.owner = get_owner_id()
+        db_conn = self.conn_pool.get_conn()
+        db_conn.execute('''CREATE TABLE IF NOT EXISTS cache_lease
+                           (hash TEXT,
+                           type text,
+                           owner text,
+                           expires_at real,
+                           PRIMARY KEY (hash, type))''')
+        db_conn.commit()
+
+    def try_acquire(self, hash: str, type: str) -> bool:
+        now = time.time()
+
+        def write(cursor):
+            cursor.execute("DELETE FROM cache_lease WHERE hash = ? AND type = ? AND expires_at < ?",
+                           (hash, type, now))
+            cursor.execute("INSERT OR IGNORE INTO cache_lease (hash, type, owner, expires_at) VALUES (?, ?, ?, ?)",
+                           (hash, type, self.owner, now + self.ttl))
+            return cursor.rowcount == 1
+
+        return write_transaction(self.conn_pool.get_conn(), write)
+
+    def release(self, cursor, hash: str, type: str):
+        """
+        Release the lease in the transaction of cursor, so that it can be done with writing the row
+        """
+        cursor.execute("DELETE FROM cache_lease WHERE hash = ? AND type = ? AND owner = ?",
+                       (hash, type, self.owner))
+
+    def read_row(self, hash: str, type: str) -> Optional[Tuple[str, str]]:
+        cursor = self.conn_pool.get_conn().cursor()
+        cursor.execute("SELECT value, meta FROM cache_table WHERE hash = ? AND type = ?", (hash, type))
+        return cursor.fetchone()
+
+    def wait_or_acquire(self, hash: str, type: str) -> Optional[Tuple[str, str]]:
+        """
+        Wait until the key is computed by another process, or acquire its lease
+        :return: the row (value, meta) written by another process, or None if the lease is acquired
+        """
+        while True:
+            row = self.read_row(hash, type)
+            if row is not None:
+                return row
+            if self.try_acquire(hash, type):
+                # The holder may have written the row just before releasing the lease
+                row = self.read_row(hash, type)
+                if row is not None:
+                    write_transaction(self.conn_pool.get_conn(), lambda cursor: self.release(cursor, hash, type))
+                return row
+            time.sleep(self.poll_interval)
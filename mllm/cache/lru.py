@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+import sys
+import threading
+from collections import OrderedDict
+from typing import Hashable, Optional, Tuple
+
+default_lru_config = {
+    "max_entries": 10000,
+    "max_bytes": 64 * 1024 * 1024
+}
+
+
+def get_size(value: any) -> int:
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    return sys.getsizeof(value)
+
+
+class LRUCache:
+    """
+    A thread-safe least-recently-used cache bounded by the number of entries and the size of the values.
+    Used in front of the SQLite cache tables so that hot entries are served from memory.
+    """
+
+    def __init__(self, max_entries: int = None, max_bytes: int = None):
+        self.max_entries = max_entries if max_entries is not None else default_lru_config["max_entries"]
+        self.max_bytes = max_bytes if max_bytes is not None else default_lru_config["max_bytes"]
+        # key -> (value, meta, size)
+        self.entries: OrderedDict = OrderedDict()
+        self.n_bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Tuple[any, any]]:
+        """
+        :return: (value, meta) or None if the key is not cached
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            return entry[0], entry[1]
+
+    def put(self, key: Hashable, value: any, meta: any = None, size: int = None):
+        """
+        :param size: the bytes counted for the entry. Default is the size of value.
+        """
+        if size is None:
+            size = get_size(value)
+        with self.lock:
+            old_entry = self.entries.pop(key, None)
+            if old_entry is not None:
+                self.n_bytes -= old_entry[2]
+            if self.max_entries <= 0 or size > self.max_bytes:
+                return
+            self.entries[key] = (value, meta, size)
+            self.n_bytes += size
+            self._evict()
+
+    def remove(self, key: Hashable):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.n_bytes -= entry[2]
+
+    def resize(self, max_entries: int = None, max_bytes: int = None):
+        with self.lock:
+            if max_entries is not None:
+                self.max_entries = max_entries
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()
+            self.n_bytes = 0
+
+    def _evict(self):
+        while len(self.entries) > 0 and (len(self.entries) > self.max_entries or self.n_bytes > self.max_bytes):
+            _, entry = self.entries.popitem(last=False)
+            self.n_bytes -= entry[2]
+
+    def __len__(self):
+        return len(self.entries)
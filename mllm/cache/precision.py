@@ -0,0 +1,126 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+"""
+# Precision of the embeddings
+
+The embeddings of a model can be kept in float16, or in int8 with one float32 scale per vector, and can be
+truncated to their first dimensions (Matryoshka embeddings). The same precision is applied to the embedding
+cache, the values returned by `get_embeddings` and the scoring of `VectorStore`, so a fresh embedding and a
+cached one are always equal.
+Usage: `caching.set_embedding_precision("text-embedding-3-large", dtype="int8", dim=1024)`
+"""
+
+dtypes = ("float32", "float16", "int8")
+
+
+@dataclass
+class EmbeddingPrecision:
+    # "float32", "float16", or "int8" with a scale per vector
+    dtype: str = "float32"
+    # Keep only the first dim dimensions and normalize the vector again. None to keep all
+    dim: Optional[int] = None
+
+    def __post_init__(self):
+        if self.dtype not in dtypes:
+            raise ValueError(f"Unknown dtype {self.dtype}. Use one of {dtypes}")
+        if self.dim is not None and self.dim <= 0:
+            raise ValueError("dim must be positive")
+
+    def __getitem__(self, item):
+        return getattr(self, item)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def get_dict(self):
+        return {k: v for k, v in self.__dict__.items() if v is not None}
+
+    def is_default(self) -> bool:
+        return self.dtype == "float32" and self.dim is None
+
+    def get_storage_suffix(self) -> str:
+        """
+        :return: the suffix of the model name in the embedding cache, so that the vectors of each precision
+        are stored apart
+        """
+        if self.is_default():
+            return ""
+        return f"#{self.dtype}" + (f"-{self.dim}" if self.dim is not None else "")
+
+    def truncate(self, embedding: np.ndarray) -> np.ndarray:
+        embedding = np.asarray(embedding, dtype=np.float32)
+        if self.dim is None or embedding.shape[-1] <= self.dim:
+            return embedding
+        embedding = embedding[..., :self.dim]
+        norm = np.linalg.norm(embedding, axis=-1, keepdims=True)
+        return embedding / np.where(norm > 0, norm, 1)
+
+    def pack(self, embeddings: np.ndarray) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        """
+        :param embeddings: a vector or a matrix with a vector per row
+        :return: the values in the storage dtype, and the scales of the vectors for int8 (None otherwise)
+        """
+        embeddings = self.truncate(embeddings)
+        if self.dtype == "float16":
+            return embeddings.astype(np.float16), None
+        if self.dtype == "int8":
+            scales = np.max(np.abs(embeddings), axis=-1, keepdims=True) / 127
+            scales = np.where(scales > 0, scales, 1).astype(np.float32)
+            return np.round(embeddings / scales).astype(np.int8), scales
+        return embeddings, None
+
+    def unpack(self, values: np.ndarray, scales: Optional[np.ndarray]) -> np.ndarray:
+        """
+        :return: the embeddings of the values of `pack`. int8 vectors are scaled back to float32.
+        """
+        if scales is not None:
+            return values.astype(np.float32) * scales
+        return values
+
+    def encode(self, embedding: np.ndarray) -> bytes:
+        values, scales = self.pack(embedding)
+        if scales is not None:
+            return scales.tobytes() + values.tobytes()
+        return values.tobytes()
+
+    def decode(self, data: bytes) -> np.ndarray:
+        if self.dtype == "int8":
+            scale = np.frombuffer(data, dtype=np.float32, count=1)
+            return np.frombuffer(data, dtype=np.int8, offset=4).astype(np.float32) * scale
+        return np.frombuffer(data, dtype=np.float16 if self.dtype == "float16" else np.float32)
+
+    def view(self, rows: np.ndarray) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        """
+        :param rows: the encoded embeddings as a uint8 matrix with a row per embedding, e.g. mapped from a file
+        :return: the values and the scales of the rows as the ones of `pack`, viewing rows without copying
+        """
+        if self.dtype == "int8":
+            return rows[:, 4:].view(np.int8), rows[:, :4].view(np.float32)
+        return rows.view(np.float16 if self.dtype == "float16" else np.float32), None
+
+    def dot(self, values: np.ndarray, scales: Optional[np.ndarray], query: np.ndarray) -> np.ndarray:
+        """
+        :param values: the packed vectors, one per row
+        :param query: the query vectors, one per row
+        :return: the inner products of the vectors and the queries, in float32
+        """
+        query = self.truncate(query)
+        res = values.astype(np.float32, copy=False).dot(query.T)
+        if scales is not None:
+            res *= scales
+        return res
+
+
+default_precision = EmbeddingPrecision()
+
+# The precision of each model. The models not in it are kept in float32
+embedding_precisions: Dict[str, EmbeddingPrecision] = {}
+
+
+def get_precision(model: str) -> EmbeddingPrecision:
+    return embedding_precisions.get(model, default_precision)
@@ -0,0 +1,70 @@
+from __future__ import annotations
+
+import argparse
+
+from mllm.cache.backend import ProgressBar, open_kv_backend
+from mllm.cache.compression import CompressionOptions, compression_options, decode_value, encode_value
+from mllm.cache.conn_pool import write_transaction
+
+"""
+# Recompress the KV cache files
+Usage: `python -m mllm.cache.recompress .llm_cache/*.db --codec lzma --vacuum`
+"""
+
+
+def recompress(db_path: str, options: CompressionOptions = None, batch_size: int = 1000, vacuum=False) -> int:
+    """
+    Rewrite the values of a KV cache database with the compression options.
+    Values already in the target form are not rewritten.
+    :param vacuum: whether to rebuild the file afterwards so that it shrinks
+    :return: the number of rows rewritten
+    """
+    if options is None:
+        options = compression_options
+    backend = open_kv_backend(db_path)
+    db_conn = backend.conn_pool.get_conn()
+    progress = ProgressBar(f"Recompressing {db_path}", min_total=0)
+    n_rewritten = 0
+    try:
+        min_rowid, max_rowid = db_conn.execute("SELECT MIN(rowid), MAX(rowid) FROM cache_table").fetchone()
+        if min_rowid is None:
+            return 0
+        for start in range(min_rowid, max_rowid + 1, batch_size):
+            rows = db_conn.execute("SELECT rowid, value FROM cache_table WHERE rowid >= ? AND rowid < ?",
+                                   (start, start + batch_size)).fetchall()
+            updates = []
+            for rowid, stored in rows:
+                value = decode_value(stored)
+                new_stored = encode_value(value, options)
+                if new_stored != stored:
+                    updates.append((new_stored, rowid))
+            if len(updates) > 0:
+                write_transaction(db_conn, lambda cursor: cursor.executemany(
+                    "UPDATE cache_table SET value = ? WHERE rowid = ?", updates))
+                n_rewritten += len(updates)
+            progress(min(start + batch_size, max_rowid + 1) - min_rowid, max_rowid + 1 - min_rowid)
+        if vacuum:
+            backend.vacuum()
+        return n_rewritten
+    finally:
+        progress.close()
+        backend.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recompress the values of MinimalLLM KV cache files")
+    parser.add_argument("db_paths", nargs="+", help="the .db files in .llm_cache")
+    parser.add_argument("--codec", default="zlib", help="zlib, lzma, zstd or none")
+    parser.add_argument("--min-size", type=int, default=compression_options.min_size)
+    parser.add_argument("--level", type=int, default=None)
+    parser.add_argument("--vacuum", action="store_true", help="rebuild the files so that they shrink")
+    args = parser.parse_args()
+    codec = None if args.codec.lower() == "none" else args.codec
+    options = CompressionOptions(codec=codec, min_size=args.min_size, level=args.level)
+    for db_path in args.db_paths:
+        n_rewritten = recompress(db_path, options, vacuum=args.vacuum)
+        print(f"Rewrote {n_rewritten} values in {db_path}")
+
+
+if __name__ == "__main__":
+    main()
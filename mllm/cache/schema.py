@@ -0,0 +1,95 @@
+from __future__ import annotations
+
+import sqlite3
+from typing import List
+
+"""
+# Schema migration of the cache databases
+"""
+
+
+def get_primary_key(conn: sqlite3.Connection, table: str) -> List[str]:
+    info = conn.execute(f"PRAGMA table_info({table})").fetchall()
+    # Each row is (cid, name, type, notnull, dflt_value, pk). pk is the 1-based position in the key.
+    return [row[1] for row in sorted(info, key=lambda row: row[5]) if row[5] > 0]
+
+
+def get_columns(conn: sqlite3.Connection, table: str) -> List[str]:
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})").fetchall()]
+
+
+def ensure_primary_key(conn: sqlite3.Connection, table: str, create_sql: str, primary_key: List[str]) -> bool:
+    """
+    Rebuild the table with create_sql if its primary key is not primary_key. The rows are kept.
+    It runs in one immediate transaction, so other connections see either the old or the new table.
+    :param create_sql: the CREATE TABLE statement of the table, with `{table}` in place of the table name
+    :return: whether the table is migrated
+    """
+    if get_primary_key(conn, table) == primary_key:
+        return False
+    conn.commit()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # Another connection may have migrated the table
+        if get_primary_key(conn, table) == primary_key:
+            conn.rollback()
+            return False
+        old_columns = get_columns(conn, table)
+        new_table = table + "_migrating"
+        conn.execute(f"DROP TABLE IF EXISTS {new_table}")
+        conn.execute(create_sql.format(table=new_table))
+        new_columns = [column for column in get_columns(conn, new_table) if column in old_columns]
+        columns = ", ".join(new_columns)
+        conn.execute(f"INSERT OR REPLACE INTO {new_table} ({columns}) SELECT {columns} FROM {table}")
+        conn.execute(f"DROP TABLE {table}")
+        conn.execute(f"ALTER TABLE {new_table} RENAME TO {table}")
+        conn.commit()
+    except BaseException as e:
+        conn.rollback()
+        raise e
+    return True
+
+
+def ensure_last_access(conn: sqlite3.Connection, table: str, backfill=False):
+    """
+    Add the last_access column and its index to the table of an older version.
+    Like `ensure_primary_key`, the column is checked again in an immediate transaction before it is added.
+    The rows without last access time are given the time of the date they were written.
+    :param backfill: whether to fill the last access time even if the column exists, e.g. after a migration
+    """
+    if backfill or "last_access" not in get_columns(conn, table):
+        conn.commit()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Another connection may have added the column
+            if "last_access" not in get_columns(conn, table):
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN last_access real")
+                backfill = True
+            if backfill:
+                conn.execute(f"UPDATE {table} SET last_access = (julianday(date) - 2440587.5) * 86400.0 "
+                             f"WHERE last_access IS NULL")
+            conn.commit()
+        except BaseException as e:
+            conn.rollback()
+            raise e
+    conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_last_access ON {table} (last_access)")
+    conn.commit()
+
+
+# The primary keys match the queries, which look up by hash and type (or model name)
+cache_table_sql = '''CREATE TABLE IF NOT EXISTS {table}
+                     (hash TEXT,
+                     type text,
+                     value text,
+                     date text,
+                     meta text,
+                     last_access real,
+                     PRIMARY KEY (hash, type))'''
+
+embedding_cache_sql = '''CREATE TABLE IF NOT EXISTS {table}
+                         (hash TEXT,
+                         model_name text,
+                         date text,
+                         embedding blob,
+                         last_access real,
+                         PRIMARY KEY (hash, model_name))'''
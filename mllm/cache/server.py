@@ -0,0 +1,149 @@
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import re
+import threading
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Tuple
+
+from mllm.cache.backend import SQLiteBackend, open_embedding_backend, open_kv_backend
+from mllm.cache.backend_http import decode_rows, encode_rows, kinds
+
+"""
+# Cache server
+
+A small HTTP server holding the cache tables in SQLite files, so that many machines can share one cache.
+Start it by `python -m mllm.cache.server --dir ./shared_cache --port 8765`
+and use it by `caching.use_cache_server("http://host:8765")`.
+"""
+
+ops = ("get_many", "put_many", "delete", "scan", "clear")
+namespace_pattern = re.compile(r"^[\w.\-]+$")
+
+
+class CacheServer:
+    """
+    Serve the cache tables in cache_dir over HTTP. Each namespace is a SQLite file.
+    All the requests are POST /{kind}/{namespace}/{op} with a JSON body, where kind is "kv" or "embedding".
+    """
+
+    def __init__(self, cache_dir: str, host: str = "127.0.0.1", port: int = 8765):
+        self.cache_dir = cache_dir
+        self.backends: Dict[Tuple[str, str], SQLiteBackend] = {}
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def get_backend(self, kind: str, namespace: str) -> SQLiteBackend:
+        with self.lock:
+            backend = self.backends.get((kind, namespace))
+            if backend is None:
+                if kind == "kv":
+                    backend = open_kv_backend(os.path.join(self.cache_dir, namespace + ".db"))
+                else:
+                    backend = open_embedding_backend(os.path.join(self.cache_dir, f"embedding_cache.{namespace}.db"))
+                self.backends[(kind, namespace)] = backend
+            return backend
+
+    def handle(self, kind: str, namespace: str, op: str, body: dict) -> dict:
+        backend = self.get_backend(kind, namespace)
+        if op == "get_many":
+            keys = [tuple(key) for key in body["keys"]]
+            found = backend.get_many(keys)
+            return {"rows": encode_rows((key[0], key[1], value, meta) for key, (value, meta) in found.items())}
+        if op == "put_many":
+            backend.put_many(decode_rows(body["rows"]))
+            return {}
+        if op == "delete":
+            backend.delete([tuple(key) for key in body["keys"]])
+            return {}
+        if op == "scan":
+            after = tuple(body["after"]) if body.get("after") is not None else None
+            rows = backend.scan(after, body.get("limit", 1000), body.get("with_values", True))
+            return {"rows": encode_rows(rows)}
+        if op == "clear":
+            backend.clear()
+            return {}
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                parts = self.path.strip("/").split("/")
+                if len(parts) != 3 or parts[0] not in kinds or parts[2] not in ops:
+                    self.reply(404, {"error": f"Unknown path {self.path}"})
+                    return
+                kind, namespace, op = parts
+                if namespace_pattern.match(namespace) is None or namespace.startswith("."):
+                    self.reply(400, {"error": f"Invalid namespace {namespace}"})
+                    return
+                try:
+                    length = int(self.headers.get("Content-Length", 0))
+                    body = json.loads(self.rfile.read(length) or b"{}")
+                    res = server.handle(kind, namespace, op, body)
+                except Exception as e:
+                    traceback.print_exc()
+                    self.reply(500, {"error": str(e)})
+                    return
+                self.reply(200, res)
+
+            def reply(self, status: int, res: dict):
+                data = json.dumps(res).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+    def start(self) -> threading.Thread:
+        """
+        Serve in a daemon thread
+        """
+        thread = threading.Thread(target=self.serve_forever, name="mllm-cache-server", daemon=True)
+        thread.start()
+        return thread
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        with self.lock:
+            for backend in self.backends.values():
+                backend.close()
+            self.backends = {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the MinimalLLM cache over HTTP")
+    parser.add_argument("--dir", default="./llm_cache_server", help="the directory of the cache files")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+    server = CacheServer(args.dir, args.host, args.port)
+    print(f"Serving the cache in {os.path.abspath(args.dir)} at {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+import threading
+from typing import Callable, Dict, Hashable, Optional
+
+
+class FlightAbandoned(Exception):
+    """
+    Raised to the others when the leader stops without a result, e.g. it is cancelled.
+    The others should join the flight again so that one of them takes over.
+    """
+
+class Flight:
+    """
+    A call in flight. Only the leader makes the call and the others wait for its result.
+    """
+
+    def __init__(self, single_flight: SingleFlight, key: Hashable, future: concurrent.futures.Future,
+                 is_leader: bool):
+        self.single_flight = single_flight
+        self.key = key
+        self.future = future
+        self.is_leader = is_leader
+        # Called by the leader with (result, exception) before the others get the result
+        self.on_finish: Optional[Callable[[any, Exception], None]] = None
+
+    def wait(self, timeout=None):
+        """
+        :return: the result of the leader. Raise the exception of the leader if it failed.
+        """
+        return self.future.result(timeout)
+
+    async def await_result(self):
+        # Shielded so that cancelling one waiter does not cancel the future shared by the others
+        return await asyncio.shield(asyncio.wrap_future(self.future))
+
+    def finish(self, result=None, exception: Exception = None):
+        """
+        Should be called by the leader exactly once, no matter the call succeeded or not
+        """
+        try:
+            if self.on_finish is not None:
+                self.on_finish(result, exception)
+        finally:
+            self.single_flight.remove(self.key)
+            # The future may have been cancelled by a waiter
+            if not self.future.done():
+                if exception is not None:
+                    self.future.set_exception(exception)
+                else:
+                    self.future.set_result(result)
+
+    def fail(self, exception: BaseException):
+        """
+        Should be called by the leader when the call raises. A cancellation or an interrupt of the leader
+        is not passed to the others, which get `FlightAbandoned` instead.
+        """
+        if isinstance(exception, Exception) and not isinstance(exception, asyncio.CancelledError):
+            self.finish(exception=exception)
+        else:
+            self.finish(exception=FlightAbandoned())
+
+
+class SingleFlight:
+    """
+    Deduplicate the identical calls in flight, for both threads and asyncio tasks.
+    Usage:
+    flight = single_flight.join(key)
+    if flight.is_leader: make the call and then flight.finish(result), or flight.fail(e) if it raises
+    else: result = flight.wait(), and join again if it raises FlightAbandoned
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights: Dict[Hashable, concurrent.futures.Future] = {}
+
+    def join(self, key: Hashable) -> Flight:
+        with self.lock:
+            future = self.flights.get(key)
+            if future is not None:
+                return Flight(self, key, future, is_leader=False)
+            future = concurrent.futures.Future()
+            self.flights[key] = future
+            return Flight(self, key, future, is_leader=True)
+
+    def remove(self, key: Hashable):
+        with self.lock:
+            self.flights.pop(key, None)
+
+    def __len__(self):
+        return len(self.flights)
@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import asyncio
 import base64
 import copy
 import time
@@ -7,15 +8,18 @@ from io import BytesIO
 
 import httpx
 from PIL.Image import Image
-from litellm import completion, get_llm_provider
+from litellm import completion, acompletion, get_llm_provider, RateLimitError
 
 from mllm.cache.cache_service import caching
+from mllm.cache.single_flight import FlightAbandoned
 from mllm.chat_logger import ChatLogger
 from mllm.special_models import get_special_model_handler
 from mllm.config import default_models, default_options
-from mllm.utils.parser import Parse
+from mllm.utils.parser import Parse, IncrementalJsonParser
+from mllm.utils.rate_limit import rate_limiter, estimate_tokens
 
 n_chat_retry = 3
+chat_retry_wait = 2.0
 
 
 def encode_image(image_file: BytesIO):
@@ -36,6 +40,149 @@ def parse_res(parse, res):
     return res
 
 
+def read_response(response, additional_res: dict):
+    """
+    Read the content and the usage from a litellm response
+    """
+    res = response.choices[0].message.content
+    usage = response.model_extra["usage"]
+    additional_res["prompt_tokens"] = usage.prompt_tokens
+    additional_res["completion_tokens"] = usage.completion_tokens
+    additional_res["full_message"] = response.choices[0].message
+    return res
+
+
+def read_stream_usage(part, additional_res: dict):
+    """
+    Read the usage from a chunk of a litellm stream. Only the last chunk may contain it.
+    """
+    usage = getattr(part, "usage", None)
+    if usage is not None:
+        additional_res["prompt_tokens"] = usage.prompt_tokens
+        additional_res["completion_tokens"] = usage.completion_tokens
+
+
+def get_stream_options(options: dict) -> dict:
+    """
+    Ask the provider to send the usage in the last chunk of the stream, unless the caller sets stream_options
+    """
+    return {"stream_options": {"include_usage": True}, **options}
+
+
+def acquire_rate_limit(model: str, messages: list, options: dict) -> int:
+    """
+    Wait until the call is allowed by `rate_limiter`
+    :return: the estimated tokens reserved for the call
+    """
+    if not rate_limiter.is_limited(model):
+        return 0
+    n_tokens = estimate_tokens(model, messages, options) if rate_limiter.needs_tokens(model) else 0
+    rate_limiter.acquire(model, n_tokens)
+    return n_tokens
+
+
+async def aacquire_rate_limit(model: str, messages: list, options: dict) -> int:
+    if not rate_limiter.is_limited(model):
+        return 0
+    n_tokens = estimate_tokens(model, messages, options) if rate_limiter.needs_tokens(model) else 0
+    await rate_limiter.aacquire(model, n_tokens)
+    return n_tokens
+
+
+def correct_rate_limit(model: str, n_tokens: int, additional_res: dict):
+    """
+    Correct the reserved tokens by the usage in additional_res
+    """
+    if n_tokens == 0 or additional_res.get("prompt_tokens") is None:
+        return
+    actual_tokens = additional_res["prompt_tokens"] + (additional_res.get("completion_tokens") or 0)
+    rate_limiter.correct(model, n_tokens, actual_tokens)
+
+
+def print_retry(e: Exception):
+    print(e)
+    # print stack here
+    import traceback
+    print(traceback.format_exc())
+    print("Retrying...")
+
+
+def get_retry_wait(e: Exception, model: str, n_tries: int) -> float:
+    """
+    :return: the seconds to wait before retrying the completion that failed by e
+    """
+    # Back off exponentially if the provider limits the rate
+    if isinstance(e, RateLimitError):
+        rate_limiter.on_rate_limited(model)
+        print(f"Rate limited by {model}. Retrying...")
+        return chat_retry_wait * 2 ** n_tries
+    # Retry if the completion fails on TimeoutError or ParseError
+    print_retry(e)
+    return chat_retry_wait
+
+
+class CompletionCall:
+    """
+    The steps of one completion shared by the sync and the async paths: the cache lookup,
+    the coalescing of identical calls, the correction of the rate limit and the cache writing.
+    """
+
+    def __init__(self, model: str, messages: list, options: dict):
+        self.model = model
+        self.messages = messages
+        self.options = options or {}
+        self.cache_type = "chat_" + model
+        self.special_handler = get_special_model_handler(model)
+        self.cache = None
+        self.flight = None
+        # The result from the cache or the identical call. The model is not called if it is set
+        self.mock_response = None
+        # The estimated tokens reserved by the rate limiter
+        self.n_tokens = 0
+        self.additional_res = {}
+
+    def on_cache_read(self, cache) -> bool:
+        """
+        :return: whether the cache is missed, and the call should join the flight of the identical calls
+        """
+        if cache is not None and cache.is_valid():
+            self.mock_response = cache.value
+            self.additional_res["cache_hit"] = True
+            # Avoid unnecessary cache rewriting
+            return False
+        self.cache = cache
+        return cache is not None
+
+    def on_flight_joined(self, flight) -> bool:
+        """
+        :return: whether the call is the leader of the flight, which makes the call
+        """
+        self.flight = flight
+        return flight.is_leader
+
+    def on_coalesced(self, result):
+        self.mock_response = result
+        self.additional_res["cache_hit"] = True
+        self.additional_res["coalesced"] = True
+        self.cache = None
+
+    def read_response(self, response) -> str:
+        res = read_response(response, self.additional_res)
+        if self.mock_response is None:
+            correct_rate_limit(self.model, self.n_tokens, self.additional_res)
+        return res
+
+    def fail(self, e: BaseException):
+        if self.flight is not None and self.flight.is_leader:
+            self.flight.fail(e)
+
+    def finish(self, res):
+        if self.cache is not None:
+            self.cache.set_cache(res)
+        if self.flight is not None and self.flight.is_leader:
+            self.flight.finish(res)
+
+
 class Chat:
     """
     Class for chat completion
@@ -186,7 +333,7 @@ class Chat:
     """
 
     def complete(self, model=None, cache=False, expensive=False, parse=None, retry=True,
-                 options=None):
+                 options=None, stream=False):
         """
         :param model: The name of the model to use. If None, the default model will be used.
         :param cache: Whether to use cache. If True, the result will be cached.
@@ -194,8 +341,140 @@ class Chat:
         :param parse: How to parse the result. Options: "dict", "list", "obj", "quotes", "colon". See http://mllm.evoevo.org/parsing for details.
         :param retry: Whether to retry if the completion fails.
         :param options: Additional options for the completion model.
+        :param stream: Whether to stream the result. If True, a generator of text chunks will be returned.
+        The full text is added to the chat and the cache when the generator is exhausted.
+        With parse "dict" or "list", the generator yields the (key, value) pairs or the elements as soon as they are closed.
         :return: The completion result from the model. If parse is set, a parsed result will be returned.
         """
+        if stream and parse not in [None, "dict", "list"]:
+            raise ValueError("Only dict and list can be parsed when stream is True")
+        model, options = self._prepare_completion(model, expensive, parse, options)
+        if stream:
+            if parse is not None:
+                return self._complete_stream_parsed(model, cache, retry, parse, options)
+            return self._complete_stream(model, cache, retry, options)
+        return self._complete_with_retry(model, cache, parse, retry, options, stack_depth=1)
+
+    async def acomplete(self, model=None, cache=False, expensive=False, parse=None, retry=True,
+                        options=None, stream=False):
+        """
+        The asyncio version of `complete`. The arguments and the returned value are the same.
+        Many calls can be awaited concurrently on one event loop, e.g. by `asyncio.gather`.
+        If stream is True, an async iterator of text chunks will be returned:
+        `async for chunk in await chat.acomplete(stream=True): ...`
+        """
+        if stream and parse not in [None, "dict", "list"]:
+            raise ValueError("Only dict and list can be parsed when stream is True")
+        model, options = self._prepare_completion(model, expensive, parse, options)
+        if stream:
+            if parse is not None:
+                return self._acomplete_stream_parsed(model, cache, retry, parse, options)
+            return self._acomplete_stream(model, cache, retry, options)
+
+        for n_tries in range(n_chat_retry):
+            try:
+                res, additional_res = await self._acomplete_chat_impl(model, cache, options)
+                return self._finish_completion(res, additional_res, parse, stack_depth=1)
+            except (TimeoutError, asyncio.TimeoutError, ParseError, RateLimitError) as e:
+                if not retry:
+                    raise e
+                if not isinstance(e, RateLimitError):
+                    # Disable cache for retry
+                    cache = False
+                await asyncio.sleep(get_retry_wait(e, model, n_tries))
+        raise Exception(
+            "Failed to complete chat. Did you set the correct API key? Did you prompt the model to output the expected parsing format?")
+
+    def _complete_with_retry(self, model, cache, parse, retry, options, cache_entry=None, stack_depth=0):
+        """
+        :param cache_entry: the cache read in advance, e.g. by a bulk cache probe
+        """
+        for n_tries in range(n_chat_retry):
+            try:
+                res, additional_res = self._complete_chat_impl(model, cache, options, cache_entry)
+                return self._finish_completion(res, additional_res, parse, stack_depth=stack_depth + 1)
+            except (TimeoutError, ParseError, RateLimitError) as e:
+                if not retry:
+                    raise e
+                if not isinstance(e, RateLimitError):
+                    # Disable cache for retry
+                    cache = False
+                    cache_entry = None
+                time.sleep(get_retry_wait(e, model, n_tries))
+        raise Exception(
+            "Failed to complete chat. Did you set the correct API key? Did you prompt the model to output the expected parsing format?")
+
+    def _complete_stream(self, model, cache, retry, options):
+        for n_tries in range(n_chat_retry):
+            n_chunks = 0
+            try:
+                for chunk in self._stream_chat_impl(model, cache, options):
+                    n_chunks += 1
+                    yield chunk
+                return
+            # Retry only if nothing has been yielded
+            except (TimeoutError, RateLimitError) as e:
+                if not retry or n_chunks > 0:
+                    raise e
+                if not isinstance(e, RateLimitError):
+                    # Disable cache for retry
+                    cache = False
+                time.sleep(get_retry_wait(e, model, n_tries))
+        raise Exception(
+            "Failed to complete chat. Did you set the correct API key?")
+
+    async def _acomplete_stream(self, model, cache, retry, options):
+        for n_tries in range(n_chat_retry):
+            n_chunks = 0
+            try:
+                async for chunk in self._astream_chat_impl(model, cache, options):
+                    n_chunks += 1
+                    yield chunk
+                return
+            # Retry only if nothing has been yielded
+            except (TimeoutError, asyncio.TimeoutError, RateLimitError) as e:
+                if not retry or n_chunks > 0:
+                    raise e
+                if not isinstance(e, RateLimitError):
+                    # Disable cache for retry
+                    cache = False
+                await asyncio.sleep(get_retry_wait(e, model, n_tries))
+        raise Exception(
+            "Failed to complete chat. Did you set the correct API key?")
+
+    def _complete_stream_parsed(self, model, cache, retry, parse, options):
+        parser = IncrementalJsonParser(parse)
+        for chunk in self._complete_stream(model, cache, retry, options):
+            yield from parser.feed(chunk)
+        yield from self._close_stream_parser(parser)
+
+    async def _acomplete_stream_parsed(self, model, cache, retry, parse, options):
+        parser = IncrementalJsonParser(parse)
+        async for chunk in self._acomplete_stream(model, cache, retry, options):
+            for item in parser.feed(chunk):
+                yield item
+        for item in self._close_stream_parser(parser):
+            yield item
+
+    def _close_stream_parser(self, parser: IncrementalJsonParser):
+        """
+        :return: the items that are only found by parsing the whole text
+        """
+        try:
+            res = parser.close()
+        except Exception as e:
+            self._pop_message()
+            raise ParseError(f"Failed to parse the result: {e}\nInput to parse: {parser.get_text()}")
+        if res is parser.items:
+            return []
+        if parser.parse == "dict":
+            return [(key, value) for key, value in res.items() if key not in parser.items]
+        return res[len(parser.items):]
+
+    def _prepare_completion(self, model, expensive, parse, options):
+        """
+        :return: the model to use and the options for the completion
+        """
         if options is None:
             options = {}
         options = {**default_options.get_dict(), **options}
@@ -213,64 +492,167 @@ class Chat:
             if parse == "dict":
                 if not contains_image or model == "gpt-4o":
                     options["response_format"] = {"type": "json_object"}
+        return model, options
 
-        for n_tries in range(n_chat_retry):
-            try:
-                res, additional_res = self._complete_chat_impl(model, cache, options)
-                self.add_assistant_message(res)
-                ChatLogger.add_log_to_all((self.get_messages_to_api(), additional_res), stack_depth=1)
-                try:
-                    if parse is not None:
-                        final_res = parse_res(parse, res)
-                    else:
-                        final_res = res
-                except ParseError as e:
-                    self._pop_message()
-                    raise e
-                self.additional_res = additional_res
-                return final_res
-            # Retry if the completion fails on TimeoutError or ParseError
-            except (TimeoutError, ParseError) as e:
-                if not retry:
-                    raise e
-                # Disable cache for retry
-                cache = False
-                print(e)
-                # print stack here
-                import traceback
-                print(traceback.format_exc())
-                print("Retrying...")
-                time.sleep(2.0)
-        raise Exception(
-            "Failed to complete chat. Did you set the correct API key? Did you prompt the model to output the expected parsing format?")
-
-    def _complete_chat_impl(self, model: str, use_cache: bool, options):
+    def _finish_completion(self, res, additional_res, parse, stack_depth=0):
+        """
+        Add the result to the chat, log it and parse it
+        """
+        self.add_assistant_message(res)
+        ChatLogger.add_log_to_all((self.get_messages_to_api(), additional_res), stack_depth=stack_depth + 1)
+        try:
+            if parse is not None:
+                final_res = parse_res(parse, res)
+            else:
+                final_res = res
+        except ParseError as e:
+            self._pop_message()
+            raise e
+        self.additional_res = additional_res
+        return final_res
+
+    def _complete_chat_impl(self, model: str, use_cache: bool, options, cache_entry=None):
+        call = CompletionCall(model, self.get_messages_to_api(), options)
+        if use_cache:
+            cache = cache_entry if cache_entry is not None else caching.read_kv_cache(call.messages, call.cache_type)
+            if call.on_cache_read(cache):
+                while True:
+                    flight = caching.join_kv_flight(cache)
+                    if call.on_flight_joined(flight):
+                        break
+                    # An identical call is in flight. Wait for its result.
+                    try:
+                        call.on_coalesced(flight.wait())
+                        break
+                    except FlightAbandoned:
+                        # The leader is cancelled. Join again to take over.
+                        continue
+
+        try:
+            if call.mock_response is None:
+                call.n_tokens = acquire_rate_limit(model, call.messages, call.options)
+            if call.special_handler is None:
+                response = completion(model, messages=call.messages, mock_response=call.mock_response, **call.options)
+                res = call.read_response(response)
+            elif call.mock_response is not None:
+                res = call.mock_response
+            else:
+                res = call.special_handler(call.messages, call.options)
+        except BaseException as e:
+            call.fail(e)
+            raise e
+        call.finish(res)
+        return res, call.additional_res
+
+    async def _acomplete_chat_impl(self, model: str, use_cache: bool, options):
+        call = CompletionCall(model, self.get_messages_to_api(), options)
+        if use_cache:
+            cache = await caching.aread_kv_cache(call.messages, call.cache_type)
+            if call.on_cache_read(cache):
+                while True:
+                    flight = await caching.ajoin_kv_flight(cache)
+                    if call.on_flight_joined(flight):
+                        break
+                    # An identical call is in flight. Wait for its result.
+                    try:
+                        call.on_coalesced(await flight.await_result())
+                        break
+                    except FlightAbandoned:
+                        # The leader is cancelled. Join again to take over.
+                        continue
+
+        try:
+            if call.mock_response is None:
+                call.n_tokens = await aacquire_rate_limit(model, call.messages, call.options)
+            if call.special_handler is None:
+                response = await acompletion(model, messages=call.messages, mock_response=call.mock_response,
+                                             **call.options)
+                res = call.read_response(response)
+            elif call.mock_response is not None:
+                res = call.mock_response
+            else:
+                # Special handlers are blocking. Run them in the default executor.
+                loop = asyncio.get_running_loop()
+                res = await loop.run_in_executor(None, call.special_handler, call.messages, call.options)
+        except BaseException as e:
+            call.fail(e)
+            raise e
+        call.finish(res)
+        return res, call.additional_res
+
+    def _stream_chat_impl(self, model: str, use_cache: bool, options):
         messages = self.get_messages_to_api()
-        mock_response = None
         cache = None
         additional_res = {}
         if use_cache:
             cache = caching.read_kv_cache(messages, "chat_"+model)
             if cache is not None and cache.is_valid():
-                mock_response = cache.value
                 additional_res["cache_hit"] = True
-                # Avoid unnecessary cache rewriting
-                use_cache = False
+                # Replay the cache hit as a single chunk
+                yield cache.value
+                self._finish_completion(cache.value, additional_res, None, stack_depth=2)
+                return
 
         options = options or {}
         special_handler = get_special_model_handler(model)
+        n_tokens = acquire_rate_limit(model, messages, options)
         if special_handler is None:
-            response = completion(model, messages=messages, mock_response=mock_response, **options)
-            res = response.choices[0].message.content
-            usage = response.model_extra["usage"]
-            additional_res["prompt_tokens"] = usage.prompt_tokens
-            additional_res["completion_tokens"] = usage.completion_tokens
-            additional_res["full_message"] = response.choices[0].message
+            chunks = []
+            response = completion(model, messages=messages, stream=True, **get_stream_options(options))
+            for part in response:
+                read_stream_usage(part, additional_res)
+                if len(part.choices) == 0:
+                    continue
+                delta = part.choices[0].delta.content
+                if delta:
+                    chunks.append(delta)
+                    yield delta
+            res = "".join(chunks)
+            correct_rate_limit(model, n_tokens, additional_res)
         else:
             res = special_handler(messages, options)
+            yield res
+        if use_cache and cache is not None:
+            cache.set_cache(res)
+        self._finish_completion(res, additional_res, None, stack_depth=2)
+
+    async def _astream_chat_impl(self, model: str, use_cache: bool, options):
+        messages = self.get_messages_to_api()
+        cache = None
+        additional_res = {}
+        if use_cache:
+            cache = await caching.aread_kv_cache(messages, "chat_"+model)
+            if cache is not None and cache.is_valid():
+                additional_res["cache_hit"] = True
+                # Replay the cache hit as a single chunk
+                yield cache.value
+                self._finish_completion(cache.value, additional_res, None, stack_depth=2)
+                return
+
+        options = options or {}
+        special_handler = get_special_model_handler(model)
+        n_tokens = await aacquire_rate_limit(model, messages, options)
+        if special_handler is None:
+            chunks = []
+            response = await acompletion(model, messages=messages, stream=True, **get_stream_options(options))
+            async for part in response:
+                read_stream_usage(part, additional_res)
+                if len(part.choices) == 0:
+                    continue
+                delta = part.choices[0].delta.content
+                if delta:
+                    chunks.append(delta)
+                    yield delta
+            res = "".join(chunks)
+            correct_rate_limit(model, n_tokens, additional_res)
+        else:
+            # Special handlers are blocking. Run them in the default executor.
+            loop = asyncio.get_running_loop()
+            res = await loop.run_in_executor(None, special_handler, messages, options)
+            yield res
         if use_cache and cache is not None:
             cache.set_cache(res)
-        return res, additional_res
+        self._finish_completion(res, additional_res, None, stack_depth=2)
 
     """
     ## Magic methods
@@ -1,3 +1,2 @@
-
-from mllm.embedding.get import get_embeddings
-from mllm.embedding.vector_store import get_vector_store, get_vector_store_from_str
\ No newline at end of file
+from mllm.embedding.get import get_embeddings, aget_embeddings, EmbeddingBatcher
+from mllm.embedding.vector_store import get_vector_store, get_vector_store_from_str
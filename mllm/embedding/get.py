@@ -1,32 +1,51 @@
 from __future__ import annotations
 
-from typing import List, Dict
+import asyncio
+import concurrent.futures
+import threading
+import time
+from contextvars import ContextVar
+from typing import List, Dict, Optional, Tuple
 
 import numpy as np
-from litellm import embedding
+from litellm import embedding, aembedding, RateLimitError, APIConnectionError, InternalServerError, \
+    ServiceUnavailableError, Timeout
 
 from mllm.cache.cache_embedding import CacheTableEmbed
 from mllm.cache.cache_service import caching
 from mllm.config import default_models
+from mllm.utils.rate_limit import rate_limiter
+
+default_embedding_batch_config = {
+    # Maximum texts in one request
+    "max_batch_size": 2000,
+    # Maximum estimated tokens in one request
+    "max_batch_tokens": 200000,
+    # Maximum requests in flight
+    "n_workers": 8,
+}
+
+n_embedding_retry = 3
+embedding_retry_wait = 2.0
 
 
 class LazyEmbedding:
-    lazy_embeddings: Dict[str, List[LazyEmbedding]] = {}
+    """
+    An embedding computed when it is read. It is collected by an `EmbeddingBatcher` to be embedded with the others.
+    """
 
-    def __init__(self, src: str, model: str, cache_embed: CacheTableEmbed):
+    def __init__(self, src: str, model: str, cache_embed: CacheTableEmbed, batcher: EmbeddingBatcher):
         self.src = src
         self.model = model
         self.cache_embed: CacheTableEmbed = cache_embed
+        self.batcher = batcher
         self.embedding = None
-        if model not in LazyEmbedding.lazy_embeddings:
-            LazyEmbedding.lazy_embeddings[model] = [self]
-        else:
-            LazyEmbedding.lazy_embeddings[model].append(self)
-
+        # The future of the batch embedding it. None if it is not sent
+        self.future: Optional[concurrent.futures.Future] = None
 
     def __array__(self, *array_args, **array_kwargs):
         if self.embedding is None:
-            self.flush()
+            self.batcher.wait(self)
         if len(array_args) > 0:
             return np.array(self.embedding, *array_args, **array_kwargs)
         return self.embedding
@@ -35,12 +54,7 @@ class LazyEmbedding:
         return list(self.__array__())
 
     def flush(self):
-        lazy_embeddings = LazyEmbedding.lazy_embeddings[self.model]
-        embeddings = _get_embeddings(self.model, [le.src for le in lazy_embeddings])
-        for i, lazy_embedding in enumerate(lazy_embeddings):
-            lazy_embedding.embedding = embeddings[i]
-            self.cache_embed.add_cache(self.model, lazy_embedding.src, lazy_embedding.embedding)
-        LazyEmbedding.lazy_embeddings[self.model] = []
+        self.batcher.flush(self.model)
 
     def __str__(self):
         return str(self.__array__())
@@ -52,20 +66,172 @@ class LazyEmbedding:
         return self.__array__() * other
 
 
+class EmbeddingBatcher:
+    """
+    Collect the texts embedded lazily and embed them in one call per model, when one of the embeddings is read,
+    when max_pending texts are collected, or max_delay seconds after a text is collected.
+    It is shared by threads: the texts of all the threads are embedded together, and each text is sent once
+    even if it is requested again while it is in flight.
+    The default batcher is shared by the process. Use a batcher in a scope by
+    `with EmbeddingBatcher(max_pending=1000, max_delay=1.0): embeddings = get_embeddings(texts)`,
+    which flushes when the scope ends. The threads started in the scope use the default batcher.
+    """
+
+    def __init__(self, max_pending: Optional[int] = None, max_delay: Optional[float] = None):
+        """
+        :param max_pending: the number of texts of a model after which they are embedded by the thread adding them
+        :param max_delay: the seconds after which the collected texts are embedded by a background thread
+        """
+        self.max_pending = max_pending
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        # The lazy embeddings not sent yet, and the ones in flight, by model and then by (text, cache)
+        self.pending: Dict[str, Dict[Tuple[str, int], LazyEmbedding]] = {}
+        self.in_flight: Dict[str, Dict[Tuple[str, int], LazyEmbedding]] = {}
+        self.timer: Optional[threading.Timer] = None
+        self.context_tokens = []
+
+    def __enter__(self):
+        self.context_tokens.append(current_batcher.set(self))
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        current_batcher.reset(self.context_tokens.pop())
+        if exc_type is None:
+            self.flush()
+
+    def add_many(self, model: str, texts: List[str], cache_embed: CacheTableEmbed) -> List[LazyEmbedding]:
+        """
+        :return: the lazy embeddings of the texts. The same text gets the same lazy embedding until it is embedded.
+        """
+        res = []
+        batch = None
+        with self.lock:
+            pending = self.pending.setdefault(model, {})
+            in_flight = self.in_flight.get(model, {})
+            for text in texts:
+                key = (text, id(cache_embed))
+                lazy = pending.get(key)
+                if lazy is None:
+                    lazy = in_flight.get(key)
+                if lazy is None:
+                    lazy = LazyEmbedding(text, model, cache_embed, self)
+                    pending[key] = lazy
+                res.append(lazy)
+            if self.max_pending is not None and len(pending) >= self.max_pending:
+                batch = self._take(model)
+            elif self.max_delay is not None and self.timer is None and len(pending) > 0:
+                self.timer = threading.Timer(self.max_delay, self._on_deadline)
+                self.timer.daemon = True
+                self.timer.start()
+        if batch is not None:
+            self._embed(model, batch)
+        return res
+
+    def _take(self, model: str, lazy: LazyEmbedding = None) -> List[LazyEmbedding]:
+        """
+        Move the pending embeddings of the model in flight. Should be called with the lock.
+        :param lazy: a lazy embedding to embed even if it is not pending, e.g. after its batch failed
+        """
+        batch = self.pending.pop(model, {})
+        if lazy is not None:
+            batch.setdefault((lazy.src, id(lazy.cache_embed)), lazy)
+        future = concurrent.futures.Future()
+        for lazy_embedding in batch.values():
+            lazy_embedding.future = future
+        self.in_flight.setdefault(model, {}).update(batch)
+        return list(batch.values())
+
+    def _embed(self, model: str, batch: List[LazyEmbedding]):
+        future = batch[0].future
+        try:
+            embeddings = _get_embeddings(model, [lazy.src for lazy in batch])
+            for lazy, embedding in zip(batch, embeddings):
+                lazy.embedding = lazy.cache_embed.add_cache(model, lazy.src, embedding)
+        except BaseException as e:
+            # Collect them again, so that they are sent when they are read next time
+            with self.lock:
+                self._remove_in_flight(model, batch)
+                pending = self.pending.setdefault(model, {})
+                for lazy in batch:
+                    lazy.future = None
+                    if lazy.embedding is None:
+                        pending.setdefault((lazy.src, id(lazy.cache_embed)), lazy)
+            future.set_exception(e)
+            raise
+        with self.lock:
+            self._remove_in_flight(model, batch)
+        future.set_result(None)
+
+    def _remove_in_flight(self, model: str, batch: List[LazyEmbedding]):
+        in_flight = self.in_flight.get(model, {})
+        for lazy in batch:
+            key = (lazy.src, id(lazy.cache_embed))
+            if in_flight.get(key) is lazy:
+                del in_flight[key]
+
+    def wait(self, lazy: LazyEmbedding):
+        """
+        Wait until the lazy embedding is embedded. It is embedded with the pending ones if it is not in flight.
+        """
+        while lazy.embedding is None:
+            batch = None
+            with self.lock:
+                future = lazy.future
+                if future is None:
+                    batch = self._take(lazy.model, lazy)
+            if batch is not None:
+                self._embed(lazy.model, batch)
+            else:
+                future.result()
+
+    def flush(self, model: str = None):
+        """
+        Embed the pending texts of the model, or of all the models if it is None
+        """
+        with self.lock:
+            models = [model] if model is not None else list(self.pending.keys())
+            batches = [(model, self._take(model)) for model in models if len(self.pending.get(model, {})) > 0]
+        for model, batch in batches:
+            self._embed(model, batch)
+
+    def _on_deadline(self):
+        with self.lock:
+            self.timer = None
+        try:
+            self.flush()
+        except Exception as e:
+            # The texts are collected again and the readers get the exception
+            print(f"Failed to embed the pending texts: {e}")
+
+
+current_batcher: ContextVar[Optional[EmbeddingBatcher]] = ContextVar("current_batcher", default=None)
+default_batcher = EmbeddingBatcher()
+
+
+def get_batcher() -> EmbeddingBatcher:
+    """
+    :return: the batcher of the current scope, or the default batcher
+    """
+    batcher = current_batcher.get()
+    return batcher if batcher is not None else default_batcher
+
+
 def get_embeddings(texts: list[str], model=None, lazy=True) -> list[list[float]]:
     if model is None:
         model = default_models["embedding"]
     cache_embed = caching.cache_embed
 
+    for text in texts:
+        if len(text) == 0:
+            raise ValueError("Text cannot be empty")
+
     embeddings = []
     index_for_eval = []
     texts_without_cache = []
+    embeddings_from_cache = cache_embed.read_many(model, texts)
     for i, text in enumerate(texts):
-        if len(text) == 0:
-            raise ValueError("Text cannot be empty")
-            embeddings.append(0)
-            continue
-        embedding_from_cache = cache_embed.read_cache(model, text)
+        embedding_from_cache = embeddings_from_cache[i]
         if embedding_from_cache is None:
             texts_without_cache.append(text)
             embeddings.append(None)
@@ -76,31 +242,180 @@ def get_embeddings(texts: list[str], model=None, lazy=True) -> list[list[float]]
         if not lazy:
             res = _get_embeddings(model, texts_without_cache)
             for i, r in zip(index_for_eval, res):
-                cache_embed.add_cache(model, texts[i], r)
-                embeddings[i] = r
+                # The embedding in the precision of the model
+                embeddings[i] = cache_embed.add_cache(model, texts[i], r)
         else:
-            for i in index_for_eval:
-                le = LazyEmbedding(texts[i], model, cache_embed)
+            lazy_embeddings = get_batcher().add_many(model, texts_without_cache, cache_embed)
+            for i, le in zip(index_for_eval, lazy_embeddings):
                 embeddings[i] = le
 
     return embeddings
 
+def estimate_text_tokens(text: str) -> int:
+    """
+    Estimate the tokens of a text without a tokenizer. It counts 3 bytes of UTF-8 as a token,
+    which is more than the actual tokens of most texts, so that the batches stay within the limits.
+    """
+    return len(text.encode("utf-8")) // 3 + 1
+
+
+def get_embedding_batches(texts: List[str], max_batch_size: int, max_batch_tokens: int) -> List[Tuple[int, int]]:
+    """
+    Split the texts into consecutive batches within both limits. A text beyond max_batch_tokens is sent alone.
+    :return: the start and end of each batch
+    """
+    batches = []
+    start = 0
+    n_tokens = 0
+    for i, text in enumerate(texts):
+        text_tokens = estimate_text_tokens(text)
+        if i > start and (i - start >= max_batch_size or n_tokens + text_tokens > max_batch_tokens):
+            batches.append((start, i))
+            start = i
+            n_tokens = 0
+        n_tokens += text_tokens
+    if start < len(texts):
+        batches.append((start, len(texts)))
+    return batches
+
+
 def _get_embeddings(model, texts_without_cache):
+    """
+    Embed the texts. The repeated texts are sent once, and the batches are sent concurrently.
+    """
+    config = default_embedding_batch_config
+    unique_texts = list(dict.fromkeys(texts_without_cache))
+    batches = get_embedding_batches(unique_texts, config["max_batch_size"], config["max_batch_tokens"])
+    if len(batches) <= 1:
+        batch_results = [_embed_batch(model, unique_texts)]
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(config["n_workers"], len(batches))) as executor:
+            futures = [executor.submit(_embed_batch, model, unique_texts[start:end]) for start, end in batches]
+            try:
+                batch_results = [future.result() for future in futures]
+            except Exception:
+                # Do not send the batches not started yet
+                for future in futures:
+                    future.cancel()
+                raise
+    embeddings = {}
+    for (start, end), res in zip(batches, batch_results):
+        embeddings.update(zip(unique_texts[start:end], res))
+    return [embeddings[text] for text in texts_without_cache]
 
-    extra_arguments= {}
+
+def get_embedding_arguments(model) -> Dict:
+    extra_arguments = {}
     if 'nvidia' in model:
         # NVIDIA embedding models requires to specify the input type.
-        extra_arguments['input_type']='passage'
+        extra_arguments['input_type'] = 'passage'
+    return extra_arguments
 
-    if len(texts_without_cache) > 2000:
-        res = []
-        for i in range(0, len(texts_without_cache), 2000):
-            raw_res = embedding(model, input=texts_without_cache[i:i + 2000],**extra_arguments)
-            res += [np.array(r['embedding'], dtype=np.float32) for r in raw_res.data]
-        return res
-    else:
-        raw_res = embedding(model, input=texts_without_cache,**extra_arguments)
-        res = [np.array(r['embedding'], dtype=np.float32) for r in raw_res.data]
-        return res
+
+def _embed_batch(model, texts):
+    """
+    Send one request. Only this batch is retried if it fails.
+    """
+    extra_arguments = get_embedding_arguments(model)
+    n_tokens = sum(estimate_text_tokens(text) for text in texts) if rate_limiter.needs_tokens(model) else 0
+    for n_tries in range(n_embedding_retry):
+        if rate_limiter.is_limited(model):
+            rate_limiter.acquire(model, n_tokens)
+        try:
+            raw_res = embedding(model, input=texts, **extra_arguments)
+            return [np.array(r['embedding'], dtype=np.float32) for r in raw_res.data]
+        # Back off exponentially if the provider limits the rate
+        except RateLimitError as e:
+            rate_limiter.on_rate_limited(model)
+            if n_tries == n_embedding_retry - 1:
+                raise e
+            print(f"Rate limited by {model}. Retrying...")
+            time.sleep(embedding_retry_wait * 2 ** n_tries)
+        except (APIConnectionError, Timeout, InternalServerError, ServiceUnavailableError) as e:
+            if n_tries == n_embedding_retry - 1:
+                raise e
+            print(f"Failed to embed {len(texts)} texts by {model}: {e}. Retrying...")
+            time.sleep(embedding_retry_wait)
+
+
+async def aget_embeddings(texts: List[str], model=None) -> List[np.ndarray]:
+    """
+    The async version of `get_embeddings`, sharing its cache and its batches.
+    The cache is probed at once and the misses are embedded by concurrent requests on the event loop.
+    The embeddings of each request are cached as soon as it finishes, so they are kept if the call is cancelled.
+    Reading and writing the cache run in the default executor so that the event loop is not blocked.
+    :return: the embeddings in the order of texts
+    """
+    if model is None:
+        model = default_models["embedding"]
+    cache_embed = caching.cache_embed
+
+    for text in texts:
+        if len(text) == 0:
+            raise ValueError("Text cannot be empty")
+
+    loop = asyncio.get_running_loop()
+    embeddings = await loop.run_in_executor(None, cache_embed.read_many, model, texts)
+    texts_without_cache = [text for text, embedding in zip(texts, embeddings) if embedding is None]
+    if len(texts_without_cache) == 0:
+        return embeddings
+    new_embeddings = await _aget_embeddings(model, texts_without_cache, cache_embed)
+    return [embedding if embedding is not None else new_embeddings[text] for text, embedding in zip(texts, embeddings)]
+
+
+async def _aget_embeddings(model, texts_without_cache, cache_embed: CacheTableEmbed) -> Dict[str, np.ndarray]:
+    """
+    :return: the embeddings in the precision of the model, by text
+    """
+    config = default_embedding_batch_config
+    unique_texts = list(dict.fromkeys(texts_without_cache))
+    batches = get_embedding_batches(unique_texts, config["max_batch_size"], config["max_batch_tokens"])
+    semaphore = asyncio.Semaphore(config["n_workers"])
+    loop = asyncio.get_running_loop()
+    embeddings = {}
+
+    def add_cache(batch_texts, res):
+        # It may write the pending embeddings when they are over the budget
+        return [cache_embed.add_cache(model, text, embedding) for text, embedding in zip(batch_texts, res)]
+
+    async def embed_batch(batch_texts):
+        async with semaphore:
+            res = await _aembed_batch(model, batch_texts)
+        cached = await loop.run_in_executor(None, add_cache, batch_texts, res)
+        embeddings.update(zip(batch_texts, cached))
+
+    tasks = [asyncio.ensure_future(embed_batch(unique_texts[start:end])) for start, end in batches]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        # Do not send the other batches if one fails. They are cancelled by gather if the call is cancelled.
+        for task in tasks:
+            task.cancel()
+        raise
+    return embeddings
 
 
+async def _aembed_batch(model, texts):
+    """
+    Send one request. Only this batch is retried if it fails.
+    """
+    extra_arguments = get_embedding_arguments(model)
+    n_tokens = sum(estimate_text_tokens(text) for text in texts) if rate_limiter.needs_tokens(model) else 0
+    for n_tries in range(n_embedding_retry):
+        if rate_limiter.is_limited(model):
+            await rate_limiter.aacquire(model, n_tokens)
+        try:
+            raw_res = await aembedding(model, input=texts, **extra_arguments)
+            return [np.array(r['embedding'], dtype=np.float32) for r in raw_res.data]
+        # Back off exponentially if the provider limits the rate
+        except RateLimitError as e:
+            rate_limiter.on_rate_limited(model)
+            if n_tries == n_embedding_retry - 1:
+                raise e
+            print(f"Rate limited by {model}. Retrying...")
+            await asyncio.sleep(embedding_retry_wait * 2 ** n_tries)
+        except (APIConnectionError, Timeout, InternalServerError, ServiceUnavailableError) as e:
+            if n_tries == n_embedding_retry - 1:
+                raise e
+            print(f"Failed to embed {len(texts)} texts by {model}: {e}. Retrying...")
+            await asyncio.sleep(embedding_retry_wait)
@@ -4,6 +4,8 @@ from typing import List, Callable
 
 import numpy as np
 
+from mllm.cache.precision import EmbeddingPrecision, get_precision
+from mllm.config import default_models
 from mllm.display.show_html import show_json_table
 from mllm.embedding.get import get_embeddings
 from mllm.utils.logger import Logger
@@ -27,20 +29,31 @@ class EmbedSearchLogger(Logger):
 class VectorStoreItem:
     def __init__(self, item):
         self.vectors = None
+        # The scales of the vectors in int8. None for the other precisions
+        self.scales = None
         self.srcs = []
         self.weights = []
         self.item = item
 
-    def set_vectors(self, vector_list: List, start):
-        self.vectors = np.array(vector_list[start:start + len(self.srcs)])
+    def set_vectors(self, vector_list: List, start, precision: EmbeddingPrecision = None):
+        if precision is None:
+            precision = get_precision(default_models["embedding"])
+        self.vectors, self.scales = precision.pack(np.array(vector_list[start:start + len(self.srcs)]))
         return start + len(self.srcs)
 
-    def set_single_vectors(self):
-        self.vectors = np.array(get_embeddings(self.srcs))
+    def set_single_vectors(self, model=None):
+        if model is None:
+            model = default_models["embedding"]
+        self.vectors, self.scales = get_precision(model).pack(np.array(get_embeddings(self.srcs, model)))
 
 
 class VectorStore:
-    def __init__(self, score_function=None):
+    def __init__(self, score_function=None, model=None):
+        """
+        :param model: the embedding model. Default is the embedding model in default_models.
+        The vectors are kept and scored in the precision of the model, see `caching.set_embedding_precision`
+        """
+        self.model = model
         self.stored_items = []
         self.item_to_index = {}
         if score_function is not None:
@@ -65,7 +78,9 @@ class VectorStore:
     def get_similarities(self, query: str | List[str], items_to_search: List = None, log_stack=1) -> [np.ndarray, List]:
         if isinstance(query, str):
             query = [query]
-        query_vecs = np.array(get_embeddings(query))
+        model = self.model if self.model is not None else default_models["embedding"]
+        precision = get_precision(model)
+        query_vecs = np.array(get_embeddings(query, model))
 
 
         if items_to_search is None:
@@ -78,14 +93,14 @@ class VectorStore:
         srcs = []
         for stored_item in no_vector_items:
             srcs.extend(stored_item.srcs)
-        vectors = get_embeddings(srcs)
+        vectors = get_embeddings(srcs, model)
         start = 0
         for stored_item in no_vector_items:
-            start = stored_item.set_vectors(vectors, start)
+            start = stored_item.set_vectors(vectors, start, precision)
 
         inner_prod_list = []
         for stored_item in stored_items:
-            inner_prod_list.append(stored_item.vectors.dot(query_vecs.T))
+            inner_prod_list.append(precision.dot(stored_item.vectors, stored_item.scales, query_vecs))
 
         scores = self.score_function(inner_prod_list)
 
@@ -136,8 +151,8 @@ def similarity_by_exp(inner_prod_list):
 
 
 
-def get_vector_store(items: List, get_srcs: Callable[[str], List[str]]) -> VectorStore:
-    vector_store = VectorStore()
+def get_vector_store(items: List, get_srcs: Callable[[str], List[str]], model=None) -> VectorStore:
+    vector_store = VectorStore(model=model)
     src_list = []
     item_list = []
     for i, item in enumerate(items):
@@ -148,5 +163,5 @@ def get_vector_store(items: List, get_srcs: Callable[[str], List[str]]) -> Vecto
     return vector_store
 
 
-def get_vector_store_from_str(str_list: List[str]) -> VectorStore:
-    return get_vector_store(str_list, lambda x: [x])
\ No newline at end of file
+def get_vector_store_from_str(str_list: List[str], model=None) -> VectorStore:
+    return get_vector_store(str_list, lambda x: [x], model)
\ No newline at end of file
@@ -19,6 +19,9 @@ class JsonSpec:
             }
         )
 
+    def get_keys(self):
+        return [key_item["key"] for key_item in self.keys]
+
     def in_prompt(self):
         keys = []
         for key_item in self.keys:
@@ -75,7 +78,47 @@ class SChat:
         chat += self.output_requirement.in_prompt()
         return chat
 
-    def complete(self, model=None, cache=False, expensive=False, options=None) -> Dict:
+    def complete(self, model=None, cache=False, expensive=False, options=None, stream=False) -> Dict:
+        """
+        :param stream: If True, a generator of (key, value) will be returned. The keys are yielded as soon as
+        they are closed and the stream is cancelled once all the output keys are present.
+        The result is not cached when the stream is cancelled early.
+        """
+        if stream:
+            return self._complete_stream(model, cache, expensive, options)
         res = self.get_chat().complete(model=model, cache=cache, expensive=expensive,
                                        parse="dict", retry=True, options=options)
         return res
+
+    async def acomplete(self, model=None, cache=False, expensive=False, options=None, stream=False) -> Dict:
+        if stream:
+            return self._acomplete_stream(model, cache, expensive, options)
+        res = await self.get_chat().acomplete(model=model, cache=cache, expensive=expensive,
+                                              parse="dict", retry=True, options=options)
+        return res
+
+    def _complete_stream(self, model, cache, expensive, options):
+        keys_left = set(self.output_requirement.get_keys())
+        items = self.get_chat().complete(model=model, cache=cache, expensive=expensive,
+                                         parse="dict", retry=True, options=options, stream=True)
+        try:
+            for key, value in items:
+                yield key, value
+                keys_left.discard(key)
+                if len(keys_left) == 0:
+                    break
+        finally:
+            items.close()
+
+    async def _acomplete_stream(self, model, cache, expensive, options):
+        keys_left = set(self.output_requirement.get_keys())
+        items = await self.get_chat().acomplete(model=model, cache=cache, expensive=expensive,
+                                                parse="dict", retry=True, options=options, stream=True)
+        try:
+            async for key, value in items:
+                yield key, value
+                keys_left.discard(key)
+                if len(keys_left) == 0:
+                    break
+        finally:
+            await items.aclose()
@@ -5,4 +5,4 @@ def debugger_is_active() -> bool:
     """Return if the debugger is currently active"""
     return hasattr(sys, 'gettrace') and sys.gettrace() is not None
 
-from .maps import parallel_map, p_map
\ No newline at end of file
+from .maps import parallel_map, p_map, p_imap, a_map
\ No newline at end of file
@@ -0,0 +1,103 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import pickle
+import sqlite3
+import time
+import warnings
+from typing import Callable, Optional
+
+"""
+# Checkpoint of parallel map
+"""
+
+
+def _canonical_arg(arg: any) -> any:
+    """
+    Sort the sets in arg, whose pickle depends on the string hash seed of the process
+    """
+    if isinstance(arg, (set, frozenset)):
+        return type(arg).__name__, sorted((_canonical_arg(item) for item in arg), key=repr)
+    if type(arg) in (list, tuple):
+        return type(arg)(_canonical_arg(item) for item in arg)
+    if type(arg) is dict:
+        return {key: _canonical_arg(value) for key, value in arg.items()}
+    return arg
+
+
+def get_arg_key(arg: any) -> str:
+    """
+    The default key of an argument: the hash of its pickle, which is the same in a restarted process.
+    :raise TypeError: if arg cannot be pickled. Pass a key function to the map in this case.
+    """
+    try:
+        data = pickle.dumps(_canonical_arg(arg), protocol=4)
+    except Exception as e:
+        raise TypeError(f"Cannot get a stable checkpoint key of {type(arg).__name__}: {e}. "
+                        f"Pass checkpoint_key to the map to get the key of an argument.") from e
+    return hashlib.sha1(data).hexdigest()
+
+
+class MapCheckpoint:
+    """
+    Durable record of the finished items of a parallel map in a SQLite file.
+    A restarted map skips the items recorded here and only runs the remaining ones.
+    Usage: `p_map(func, args, checkpoint="job.db")`
+    """
+
+    def __init__(self, path: str, key_func: Optional[Callable[[any], str]] = None, commit_interval=2.0):
+        """
+        :param path: the path of the checkpoint file
+        :param key_func: the function to get the key of an argument. Default is the hash of its pickle.
+        :param commit_interval: the seconds between two commits
+        """
+        self.path = path
+        self.key_func = key_func or get_arg_key
+        self.commit_interval = commit_interval
+        db_dir = os.path.dirname(path)
+        if len(db_dir) != 0 and not os.path.exists(db_dir):
+            os.makedirs(db_dir, exist_ok=True)
+        # The checkpoint is only used by the thread that consumes the results
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS checkpoint (key TEXT PRIMARY KEY, result BLOB)")
+        self.conn.commit()
+        self.finished_keys = set(row[0] for row in self.conn.execute("SELECT key FROM checkpoint"))
+        self.last_commit = time.time()
+        self.unpicklable_warned = False
+
+    def get_key(self, arg: any) -> str:
+        return self.key_func(arg)
+
+    def is_finished(self, key: str) -> bool:
+        return key in self.finished_keys
+
+    def get_result(self, key: str):
+        row = self.conn.execute("SELECT result FROM checkpoint WHERE key = ?", (key,)).fetchone()
+        return pickle.loads(row[0])
+
+    def add_result(self, key: str, result: any):
+        try:
+            data = pickle.dumps(result, protocol=4)
+        except Exception as e:
+            if not self.unpicklable_warned:
+                warnings.warn(f"Results that cannot be pickled are not checkpointed: {e}")
+                self.unpicklable_warned = True
+            return
+        self.conn.execute("INSERT OR REPLACE INTO checkpoint VALUES (?, ?)", (key, data))
+        self.finished_keys.add(key)
+        if time.time() - self.last_commit > self.commit_interval:
+            self.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self.last_commit = time.time()
+
+    def __len__(self):
+        return len(self.finished_keys)
+
+    def close(self):
+        self.commit()
+        self.conn.close()
@@ -1,9 +1,16 @@
+from __future__ import annotations
+
+import asyncio
 import concurrent.futures
+import threading
 import time
+from collections import deque
 from dataclasses import dataclass
 from typing import List
 
+from mllm.utils.checkpoint import MapCheckpoint
 from mllm.utils.ipython import is_in_notebook
+from mllm.utils.rate_limit import rate_limiter
 
 if is_in_notebook:
     from tqdm.notebook import tqdm
@@ -18,10 +25,159 @@ else:
 
 default_parallel_map_config = {
     "n_workers": 8,
+    # The maximum concurrency of the adaptive mode if n_workers is not set
+    "max_adaptive_workers": 64,
     "pbar": tqdm
 }
 
 
+"""
+# Adaptive concurrency
+"""
+
+
+class AdaptiveConcurrency:
+    """
+    Control the number of calls in flight by AIMD.
+    The limit grows by one per `limit` finished calls while the latency is stable,
+    and is halved on a rate limit error or when the latency rises above `latency_tolerance` times the lowest latency.
+    It works for both threads (`acquire`) and asyncio tasks (`aacquire`).
+    """
+
+    def __init__(self, initial=4, min_limit=1, max_limit=64, latency_tolerance=2.0):
+        self.rate_limiter = rate_limiter
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_tolerance = latency_tolerance
+        self.in_flight = 0
+        self.min_latency = None
+        self.avg_latency = None
+        self.last_decrease = 0.0
+        self.n_rate_limited = rate_limiter.n_rate_limited
+        self.cond = threading.Condition()
+        self.async_waiters = deque()
+
+    @property
+    def concurrency(self) -> int:
+        return max(self.min_limit, int(self.limit))
+
+    def acquire(self):
+        with self.cond:
+            while self.in_flight >= self.concurrency:
+                self.cond.wait()
+            self.in_flight += 1
+
+    async def aacquire(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.cond:
+                if self.in_flight < self.concurrency:
+                    self.in_flight += 1
+                    return
+                waiter = loop.create_future()
+                self.async_waiters.append((loop, waiter))
+            try:
+                await waiter
+            except asyncio.CancelledError as e:
+                with self.cond:
+                    if (loop, waiter) in self.async_waiters:
+                        self.async_waiters.remove((loop, waiter))
+                    else:
+                        # Already woken by release. Pass the free slot on to the next waiter.
+                        self._wake_async_waiters(1)
+                raise e
+
+    def release(self, latency: float, rate_limited=False):
+        """
+        :param latency: the seconds the call took
+        :param rate_limited: whether the call failed by a rate limit error
+        """
+        with self.cond:
+            self.in_flight -= 1
+            self._update(latency, rate_limited)
+            n_free = self.concurrency - self.in_flight
+            self.cond.notify(max(n_free, 0))
+            self._wake_async_waiters(n_free)
+
+    def _wake_async_waiters(self, n: int):
+        """
+        Should be called with self.cond held
+        """
+        while n > 0 and len(self.async_waiters) > 0:
+            loop, waiter = self.async_waiters.popleft()
+            loop.call_soon_threadsafe(_wake_waiter, waiter)
+            n -= 1
+
+    def _update(self, latency: float, rate_limited: bool):
+        n_rate_limited = self.rate_limiter.n_rate_limited
+        if n_rate_limited > self.n_rate_limited:
+            # Retries on rate limit errors inside the calls are also counted
+            rate_limited = True
+            self.n_rate_limited = n_rate_limited
+        if self.avg_latency is None:
+            self.avg_latency = latency
+        else:
+            self.avg_latency = 0.8 * self.avg_latency + 0.2 * latency
+        if self.min_latency is None or latency < self.min_latency:
+            self.min_latency = latency
+
+        latency_rising = self.avg_latency > self.latency_tolerance * max(self.min_latency, 1e-3)
+        if rate_limited or latency_rising:
+            # Decrease at most once per round trip, so that one burst is not punished many times
+            now = time.monotonic()
+            if now - self.last_decrease > self.avg_latency:
+                self.limit = max(self.min_limit, self.limit / 2)
+                self.last_decrease = now
+                if latency_rising:
+                    # Let the baseline follow the latency so that it can grow again
+                    self.min_latency = self.avg_latency / self.latency_tolerance * 1.2
+        else:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def wrap(self, func):
+        """
+        :return: func that runs under the concurrency limit
+        """
+        from litellm import RateLimitError
+
+        def wrapped(*args):
+            self.acquire()
+            start = time.monotonic()
+            rate_limited = False
+            try:
+                return func(*args)
+            except RateLimitError as e:
+                rate_limited = True
+                raise e
+            finally:
+                self.release(time.monotonic() - start, rate_limited)
+
+        return wrapped
+
+    def wrap_async(self, func):
+        from litellm import RateLimitError
+
+        async def wrapped(*args):
+            await self.aacquire()
+            start = time.monotonic()
+            rate_limited = False
+            try:
+                return await func(*args)
+            except RateLimitError as e:
+                rate_limited = True
+                raise e
+            finally:
+                self.release(time.monotonic() - start, rate_limited)
+
+        return wrapped
+
+
+def _wake_waiter(waiter: asyncio.Future):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
 def parallel_map(func, *args, n_workers=None, title=None):
     """
     Example usage: `for i, res in parallel_map(lambda x: x + 1, [1, 2, 3, 4, 5], n_workers=4): do_something`
@@ -37,64 +193,214 @@ def parallel_map(func, *args, n_workers=None, title=None):
         n_workers = default_parallel_map_config["n_workers"]
 
     arg_lists = [list(arg) for arg in args]
-    start_time = time.time()
     title = title
     if title is None:
         if hasattr(func, "__name__"):
             title = func.__name__
+    # The cache is written by the background flusher of caching while the map is running
+    caching.flusher.start()
     with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
         results = []
         for result in tqdm(executor.map(func, *arg_lists, timeout=None), total=len(arg_lists[0]),
                            desc=title):
             results.append(result)
-            time_now = time.time()
-            if time_now - start_time > 10:
-                caching.save()
-                start_time = time_now
     caching.save()
     return enumerate(results)
 
 
-def p_map(func, args, n_workers=None, title=None, pbar_impl=None):
+def p_map(func, args, n_workers=None, title=None, pbar_impl=None, adaptive=False, checkpoint=None,
+          checkpoint_key=None):
     """
     Example usage: `for arg, res in parallel_map(lambda x: x + 1, [1, 2, 3, 4, 5], n_workers=4): do_something`
     :param func: The function to apply on each element of args
     :param args: The arguments to apply func
-    :param n_workers: Number of workers
+    :param n_workers: Number of workers. It is the maximum concurrency if adaptive is set.
     :param title: Title of the progress bar
     :param pbar_impl: Progress bar implementation, default is tqdm
+    :param adaptive: Whether to adapt the concurrency to the latency and the rate limit errors.
+    An `AdaptiveConcurrency` can also be passed.
+    :param checkpoint: The path of a file recording the finished items, or a `MapCheckpoint`.
+    When the map is restarted, the recorded items are not run again.
+    :param checkpoint_key: The function to get the checkpoint key of an argument, which must be the same
+    in a restarted process. Default is the hash of its pickle.
     :yield: (arg, res) for each arg in args
     """
-    from mllm.cache.cache_service import caching
-    if n_workers is None:
-        n_workers = default_parallel_map_config["n_workers"]
     if not isinstance(args, list):
         args = list(args)
     if len(args) == 0:
         return None, None
-    start_time = time.time()
-    title = title
+    results = [None] * len(args)
+    # Collect in the order of completion so that a slow item does not hold the others
+    for i, arg, result in _p_imap(func, args, n_workers, title, pbar_impl, adaptive, ordered=False,
+                                  max_pending=len(args), checkpoint=checkpoint, checkpoint_key=checkpoint_key):
+        results[i] = result
+    return zip(args, results)
+
+
+def p_imap(func, args, n_workers=None, title=None, pbar_impl=None, adaptive=False, ordered=False,
+           max_pending=None, checkpoint=None, checkpoint_key=None):
+    """
+    The streaming version of `p_map`. The results are yielded as soon as they are ready and
+    args is consumed lazily, so it can be a generator of unknown length.
+    Example usage: `for arg, res in p_imap(lambda x: x + 1, range(1000000), n_workers=4): do_something`
+    :param ordered: Whether to yield in the order of args. If False, yield in the order of completion.
+    :param max_pending: Maximum number of submitted items that are not yielded yet. Default is 2 * n_workers.
+    Other parameters are the same as `p_map`.
+    :yield: (arg, res) for each arg in args
+    """
+    for i, arg, result in _p_imap(func, args, n_workers, title, pbar_impl, adaptive, ordered, max_pending,
+                                  checkpoint, checkpoint_key):
+        yield arg, result
+
+
+def _p_imap(func, args, n_workers, title, pbar_impl, adaptive, ordered, max_pending, checkpoint=None,
+            checkpoint_key=None):
+    """
+    :yield: (index, arg, res) for each arg in args
+    """
+    from mllm.cache.cache_service import caching
+    controller = get_adaptive_concurrency(adaptive, n_workers)
+    if n_workers is None:
+        n_workers = default_parallel_map_config["n_workers"]
     if title is None:
         if hasattr(func, "__name__"):
             title = func.__name__
+    if pbar_impl is None:
+        pbar_impl = default_parallel_map_config["pbar"]
+    if controller is not None:
+        func = controller.wrap(func)
+        n_workers = controller.max_limit
+    if max_pending is None:
+        max_pending = 2 * n_workers
+    total = len(args) if hasattr(args, "__len__") else None
+    close_checkpoint = False
+    if isinstance(checkpoint, str):
+        checkpoint = MapCheckpoint(checkpoint, key_func=checkpoint_key)
+        close_checkpoint = True
 
+    # The cache is written by the background flusher of caching while the map is running
+    caching.flusher.start()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
+            pbar = pbar_impl(_imap_in_executor(executor, func, args, ordered, max_pending, checkpoint),
+                             total=total, desc=title)
+            for i, arg, result in pbar:
+                yield i, arg, result
+                if controller is not None and hasattr(pbar, "set_postfix"):
+                    pbar.set_postfix(concurrency=controller.concurrency, refresh=False)
+    finally:
+        if checkpoint is not None:
+            if close_checkpoint:
+                checkpoint.close()
+            else:
+                checkpoint.commit()
+    caching.save()
+
+
+def _imap_in_executor(executor: concurrent.futures.Executor, func, args, ordered: bool, max_pending: int,
+                      checkpoint: MapCheckpoint = None):
+    """
+    Submit args to the executor while keeping at most max_pending items not yielded
+    :yield: (index, arg, res) for each arg in args
+    """
+    args_iter = enumerate(args)
+    # future -> (index, arg, key), in the order of submission
+    pending = {}
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and len(pending) < max_pending:
+                next_arg = next(args_iter, None)
+                if next_arg is None:
+                    exhausted = True
+                    break
+                i, arg = next_arg
+                key = None
+                if checkpoint is not None:
+                    key = checkpoint.get_key(arg)
+                    if checkpoint.is_finished(key):
+                        # Restore the result without running func
+                        future = concurrent.futures.Future()
+                        future.set_result(checkpoint.get_result(key))
+                        pending[future] = (i, arg, None)
+                        continue
+                pending[executor.submit(func, arg)] = (i, arg, key)
+            if len(pending) == 0:
+                return
+            if ordered:
+                done = [next(iter(pending))]
+            else:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                # Yield the successful results before raising an exception
+                done = sorted(done, key=lambda f: f.exception() is not None)
+            for future in done:
+                i, arg, key = pending.pop(future)
+                result = future.result()
+                if key is not None:
+                    checkpoint.add_result(key, result)
+                yield i, arg, result
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+async def a_map(func, args, n_workers=None, title=None, pbar_impl=None, adaptive=False):
+    """
+    The asyncio version of `p_map`. func should be an async function.
+    Example usage: `for arg, res in await a_map(lambda chat: chat.acomplete(), chats, n_workers=100): do_something`
+    :param n_workers: Maximum number of calls in flight
+    :param adaptive: Whether to adapt the concurrency to the latency and the rate limit errors.
+    :return: (arg, res) for each arg in args
+    """
+    from mllm.cache.cache_service import caching
+    controller = get_adaptive_concurrency(adaptive, n_workers)
+    if n_workers is None:
+        n_workers = default_parallel_map_config["n_workers"]
+    if not isinstance(args, list):
+        args = list(args)
+    if title is None:
+        if hasattr(func, "__name__"):
+            title = func.__name__
     if pbar_impl is None:
         pbar_impl = default_parallel_map_config["pbar"]
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
-        results = []
-        for result in pbar_impl(executor.map(func, args, timeout=None), total=len(args),
-                           desc=title):
-            results.append(result)
-            time_now = time.time()
-            # save cache every 10 seconds
-            if time_now - start_time > 10:
-                caching.save()
-                start_time = time_now
+    if controller is not None:
+        run = controller.wrap_async(func)
+    else:
+        semaphore = asyncio.Semaphore(n_workers)
+
+        async def run(arg):
+            async with semaphore:
+                return await func(arg)
+
+    async def run_indexed(i):
+        return i, await run(args[i])
+
+    results = [None] * len(args)
+    tasks = [asyncio.ensure_future(run_indexed(i)) for i in range(len(args))]
+    try:
+        pbar = pbar_impl(asyncio.as_completed(tasks), total=len(args), desc=title)
+        for next_result in pbar:
+            i, result = await next_result
+            results[i] = result
+            if controller is not None and hasattr(pbar, "set_postfix"):
+                pbar.set_postfix(concurrency=controller.concurrency, refresh=False)
+    finally:
+        for task in tasks:
+            task.cancel()
     caching.save()
     return zip(args, results)
 
 
+def get_adaptive_concurrency(adaptive, n_workers) -> AdaptiveConcurrency | None:
+    if isinstance(adaptive, AdaptiveConcurrency):
+        return adaptive
+    if not adaptive:
+        return None
+    if n_workers is None:
+        n_workers = default_parallel_map_config["max_adaptive_workers"]
+    return AdaptiveConcurrency(initial=min(4, n_workers), max_limit=n_workers)
+
 
 """
 # Nested map
@@ -37,22 +37,8 @@ class Parse:
         json_src = src[start:end + 1]
 
         try:
-            res = json.loads(json_src)
-            return res
-        except:
-            pass
-
-        try:
-            res = ast.literal_eval(json_src)
-            return res
-        except:
-            pass
-
-        json_src_replaced = json_src.replace("\n", " ")
-        try:
-            res = json.loads(json_src_replaced)
-            return res
-        except:
+            return load_json_like(json_src)
+        except ValueError:
             pass
 
         if parse_options.correct_json_by_model:
@@ -118,6 +104,130 @@ class Parse:
         return contents
 
 
+def load_json_like(json_src: str):
+    """
+    Load a JSON by `json.loads`, and then by `ast.literal_eval` and `json.loads` with newlines removed
+    """
+    try:
+        return json.loads(json_src)
+    except:
+        pass
+
+    try:
+        return ast.literal_eval(json_src)
+    except:
+        pass
+
+    try:
+        return json.loads(json_src.replace("\n", " "))
+    except:
+        pass
+
+    raise ValueError(f"Invalid json: {json_src}")
+
+
+class IncrementalJsonParser:
+    """
+    Parse a JSON dict or list from the text chunks of a stream.
+    The top-level items are emitted as soon as they are closed, which are (key, value) for a dict
+    and the elements for a list.
+    Example usage:
+    `parser = IncrementalJsonParser("dict")`
+    `for chunk in chunks: for key, value in parser.feed(chunk): do_something`
+    `res = parser.close()`
+    """
+
+    def __init__(self, parse: str):
+        if parse not in ["dict", "list"]:
+            raise ValueError("Only dict and list can be parsed incrementally")
+        self.parse = parse
+        self.open_char, self.close_char = ("{", "}") if parse == "dict" else ("[", "]")
+        self.chunks = []
+        # The parsed top-level items
+        self.items = {} if parse == "dict" else []
+        # Whether all the items are parsed without falling back to the full text
+        self.items_complete = True
+        self.started = False
+        self.finished = False
+        self.depth = 0
+        self.quote = None
+        self.escaped = False
+        self.item_chars = []
+
+    def feed(self, chunk: str) -> list:
+        """
+        :param chunk: a new chunk of the text
+        :return: the items closed in this chunk
+        """
+        self.chunks.append(chunk)
+        new_items = []
+        for c in chunk:
+            if self.finished:
+                break
+            if not self.started:
+                if c == self.open_char:
+                    self.started = True
+                    self.depth = 1
+                continue
+            if self.quote is not None:
+                self.item_chars.append(c)
+                if self.escaped:
+                    self.escaped = False
+                elif c == "\\":
+                    self.escaped = True
+                elif c == self.quote:
+                    self.quote = None
+                continue
+            if c in "\"'":
+                self.quote = c
+            elif c in "{[":
+                self.depth += 1
+            elif c in "}]":
+                self.depth -= 1
+                if self.depth == 0:
+                    self.finished = True
+                    self._end_item(new_items)
+                    continue
+            elif c == "," and self.depth == 1:
+                self._end_item(new_items)
+                continue
+            self.item_chars.append(c)
+        return new_items
+
+    def _end_item(self, new_items: list):
+        item_src = "".join(self.item_chars).strip()
+        self.item_chars = []
+        if len(item_src) == 0:
+            return
+        try:
+            item = load_json_like(self.open_char + item_src + self.close_char)
+        except ValueError:
+            self.items_complete = False
+            return
+        if self.parse == "dict":
+            for key, value in item.items():
+                self.items[key] = value
+                new_items.append((key, value))
+        else:
+            for value in item:
+                self.items.append(value)
+                new_items.append(value)
+
+    def get_text(self) -> str:
+        return "".join(self.chunks)
+
+    def close(self):
+        """
+        :return: the parsed result of the whole text. It falls back to `Parse` if any item failed to parse.
+        """
+        if self.finished and self.items_complete:
+            return self.items
+        if self.parse == "dict":
+            return Parse.dict(self.get_text())
+        else:
+            return Parse.list(self.get_text())
+
+
 def parse_json_by_cheap_model(json_src):
     """
     Correct a JSON dict with semantic errors using a model that support JSON model
@@ -0,0 +1,134 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import threading
+import time
+from typing import Dict, Optional
+
+"""
+# Rate limit
+"""
+
+
+class TokenBucket:
+    """
+    A token bucket refilled at `rate_per_minute` and holding at most `capacity` tokens.
+    A reservation takes the tokens immediately, which may make the bucket negative.
+    The caller should wait for the returned time before making the call.
+    """
+
+    def __init__(self, rate_per_minute: float, capacity: float = None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def reserve(self, amount: float) -> float:
+        """
+        :return: the seconds to wait before the tokens are available
+        """
+        self.refill()
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    def give_back(self, amount: float):
+        self.refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class RateLimiter:
+    """
+    Client-side limits of requests per minute (rpm) and tokens per minute (tpm) for each model.
+    It is shared by all the threads and asyncio tasks in the process.
+    Usage: `rate_limiter.set_limit("gpt-4o-mini", rpm=500, tpm=200000)`
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.request_buckets: Dict[str, TokenBucket] = {}
+        self.token_buckets: Dict[str, TokenBucket] = {}
+        # Number of rate limit errors received from the providers
+        self.n_rate_limited = 0
+
+    def set_limit(self, model: str, rpm: float = None, tpm: float = None):
+        with self.lock:
+            self.request_buckets.pop(model, None)
+            self.token_buckets.pop(model, None)
+            if rpm is not None:
+                self.request_buckets[model] = TokenBucket(rpm)
+            if tpm is not None:
+                self.token_buckets[model] = TokenBucket(tpm)
+
+    def remove_limit(self, model: str):
+        self.set_limit(model)
+
+    def is_limited(self, model: str) -> bool:
+        return model in self.request_buckets or model in self.token_buckets
+
+    def needs_tokens(self, model: str) -> bool:
+        return model in self.token_buckets
+
+    def reserve(self, model: str, n_tokens: int = 0) -> float:
+        """
+        :return: the seconds to wait before making the call
+        """
+        wait = 0.0
+        with self.lock:
+            if model in self.request_buckets:
+                wait = max(wait, self.request_buckets[model].reserve(1))
+            if model in self.token_buckets:
+                wait = max(wait, self.token_buckets[model].reserve(n_tokens))
+        return wait
+
+    def acquire(self, model: str, n_tokens: int = 0):
+        wait = self.reserve(model, n_tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def aacquire(self, model: str, n_tokens: int = 0):
+        wait = self.reserve(model, n_tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def correct(self, model: str, estimated_tokens: int, actual_tokens: int):
+        """
+        Correct the reserved tokens by the actual usage
+        """
+        with self.lock:
+            bucket = self.token_buckets.get(model)
+            if bucket is None:
+                return
+            if actual_tokens > estimated_tokens:
+                bucket.reserve(actual_tokens - estimated_tokens)
+            else:
+                bucket.give_back(estimated_tokens - actual_tokens)
+
+    def on_rate_limited(self, model: str):
+        with self.lock:
+            self.n_rate_limited += 1
+
+
+rate_limiter = RateLimiter()
+
+
+def estimate_tokens(model: str, messages: list, options: Optional[Dict] = None) -> int:
+    """
+    Estimate the tokens a chat completion takes before making the call
+    :return: the number of prompt tokens plus `max_tokens` in options if it is set
+    """
+    try:
+        from litellm import token_counter
+        n_tokens = token_counter(model=model, messages=messages)
+    except Exception:
+        n_tokens = len(json.dumps(messages)) // 4
+    if options is not None and options.get("max_tokens") is not None:
+        n_tokens += options["max_tokens"]
+    return n_tokens
@@ -0,0 +1,85 @@
+import asyncio
+
+import litellm
+
+import mllm.chat
+from mllm import Chat, caching
+
+
+def mock_acompletion(mock_response):
+    async def acompletion(model, messages, **options):
+        if options.get("mock_response") is None:
+            options["mock_response"] = mock_response
+        return await litellm.acompletion(model, messages=messages, **options)
+    return acompletion
+
+
+def test_acomplete(monkeypatch):
+    monkeypatch.setattr(mllm.chat, "acompletion", mock_acompletion('{"a": 1, "b": 2}'))
+
+    async def main():
+        chats = [Chat(f"Give a json dict with keys 'a' and 'b'. {i}") for i in range(20)]
+        return await asyncio.gather(*[chat.acomplete(parse="dict") for chat in chats])
+
+    res = asyncio.run(main())
+    assert res == [{"a": 1, "b": 2}] * 20
+
+
+def test_acomplete_cache(monkeypatch):
+    monkeypatch.setattr(mllm.chat, "acompletion", mock_acompletion("1234"))
+    chat = Chat("Output the number 1234. async")
+    with caching.refresh_cache():
+        assert asyncio.run(chat.acomplete(cache=True)) == "1234"
+    monkeypatch.setattr(mllm.chat, "acompletion", mock_acompletion("5678"))
+    chat = Chat("Output the number 1234. async")
+    assert asyncio.run(chat.acomplete(cache=True)) == "1234"
+    assert chat.additional_res["cache_hit"]
+
+
+def test_cancelled_leader(monkeypatch):
+    n_calls = []
+
+    async def acompletion(model, messages, **options):
+        if options.get("mock_response") is None:
+            n_calls.append(messages[-1]["content"])
+            await asyncio.sleep(0.3)
+            options["mock_response"] = "taken over"
+        return await litellm.acompletion(model, messages=messages, **options)
+
+    monkeypatch.setattr(mllm.chat, "acompletion", acompletion)
+
+    async def main():
+        # The leader times out while the follower is waiting for it
+        leader = asyncio.ensure_future(asyncio.wait_for(Chat("cancelled leader").acomplete(cache=True), 0.1))
+        await asyncio.sleep(0.02)
+        follower = Chat("cancelled leader").acomplete(cache=True)
+        return await asyncio.gather(leader, follower, return_exceptions=True)
+
+    with caching.refresh_cache():
+        res = asyncio.run(main())
+    assert isinstance(res[0], asyncio.TimeoutError)
+    # The follower takes over instead of getting the cancellation
+    assert res[1] == "taken over"
+    assert len(n_calls) == 2
+
+
+def test_cancelled_follower(monkeypatch):
+    async def acompletion(model, messages, **options):
+        if options.get("mock_response") is None:
+            await asyncio.sleep(0.3)
+            options["mock_response"] = "leader result"
+        return await litellm.acompletion(model, messages=messages, **options)
+
+    monkeypatch.setattr(mllm.chat, "acompletion", acompletion)
+
+    async def main():
+        leader = Chat("cancelled follower").acomplete(cache=True)
+        # One follower times out while the other keeps waiting
+        cancelled = asyncio.wait_for(Chat("cancelled follower").acomplete(cache=True), 0.1)
+        follower = Chat("cancelled follower").acomplete(cache=True)
+        return await asyncio.gather(leader, cancelled, follower, return_exceptions=True)
+
+    with caching.refresh_cache():
+        res = asyncio.run(main())
+    assert res[0] == "leader result" and res[2] == "leader result"
+    assert isinstance(res[1], asyncio.TimeoutError)
@@ -0,0 +1,43 @@
+import litellm
+
+import mllm.chat
+from mllm import Chat, caching, complete_many
+
+
+def mock_completion(model, messages, **options):
+    if options.get("mock_response") is None:
+        text = messages[-1]["content"]
+        if "fail" in text:
+            options["mock_response"] = "not a dict"
+        else:
+            options["mock_response"] = '{"echo": "%s"}' % text
+    return litellm.completion(model, messages=messages, **options)
+
+
+def test_complete_many(monkeypatch):
+    monkeypatch.setattr(mllm.chat, "completion", mock_completion)
+    monkeypatch.setattr(mllm.chat, "chat_retry_wait", 0)
+    chats = [Chat(f"batch {i % 5}") for i in range(10)] + [Chat("fail")]
+    with caching.refresh_cache():
+        res = complete_many(chats, parse="dict", cache=True)
+    assert [r["echo"] for r in res[:10]] == [f"batch {i % 5}" for i in range(10)]
+    assert isinstance(res[10], Exception)
+
+    chats = [Chat(f"batch {i}") for i in range(5)]
+    res = complete_many(chats, parse="dict", cache=True)
+    assert all(chat.additional_res["cache_hit"] for chat in chats)
+    assert [r["echo"] for r in res] == [f"batch {i}" for i in range(5)]
+
+
+def test_complete_many_writes_only_the_batch(monkeypatch):
+    monkeypatch.setattr(mllm.chat, "completion", mock_completion)
+    cache_kv = caching._cache_kv
+    with caching.refresh_cache():
+        caching.read_kv_cache("other", "test").set_cache("value")
+        complete_many([Chat("write batch")], parse="dict", cache=True)
+        with cache_kv.pending_lock:
+            pending_types = {type for _, type in cache_kv.pending_cache}
+    # The other pending cache is left to the next save
+    assert "test" in pending_types
+    assert not any(type.startswith("chat_") for type in pending_types)
+    caching.save()
@@ -1,7 +1,24 @@
+import sqlite3
+import threading
+import time
+
+import litellm
+import pytest
+
+import mllm.chat
 from mllm import caching
+from mllm.cache import schema
+from mllm.cache.cache_kv import CacheTableKV, get_hash
+from mllm.cache.compression import CompressionOptions, get_codec
+from mllm.cache.conn_pool import sqlite_options, write_transaction
+from mllm.cache.eviction import EvictionPolicy, day
+from mllm.cache.hashing import get_image_digest, get_legacy_hash, has_legacy_table, image_digests
+from mllm.cache.recompress import recompress
+from mllm.cache.schema import get_primary_key
 from mllm.chat import Chat
 from mllm.utils import p_map
 
+
 def test_cached_chat():
     def get_random_response():
         chat = Chat()
@@ -22,4 +39,367 @@ def test_multi_thread_cache():
         return res
 
     res = p_map(get_the_same_number, range(10))
-    caching.close()
\ No newline at end of file
+    caching.close()
+
+
+def test_coalesce_identical_chats(monkeypatch):
+    n_calls = []
+    lock = threading.Lock()
+
+    def mock_completion(model, messages, mock_response=None, **options):
+        if mock_response is None:
+            with lock:
+                n_calls.append(messages[-1]["content"])
+            time.sleep(0.5)
+            mock_response = "response to " + messages[-1]["content"]
+        return litellm.completion(model, messages=messages, mock_response=mock_response, **options)
+
+    monkeypatch.setattr(mllm.chat, "completion", mock_completion)
+
+    def get_response(i):
+        return Chat(f"coalesce {i % 3}").complete(cache=True)
+
+    with caching.refresh_cache():
+        res = list(p_map(get_response, range(12), n_workers=12))
+    assert sorted(n_calls) == ["coalesce 0", "coalesce 1", "coalesce 2"]
+    assert all(r == f"response to coalesce {i % 3}" for i, r in res)
+
+
+def test_background_flush():
+    caching.flusher.start()
+    with caching.refresh_cache():
+        cache = caching.read_kv_cache("flush", "test")
+        cache.set_cache("value")
+        caching.flush()
+        assert not caching.has_pending_update()
+    assert caching.read_kv_cache("flush", "test").value == "value"
+
+
+def test_switch_postfix_while_saving(tmp_path):
+    base_path = caching.base_path
+    caching.set_root_path(str(tmp_path))
+    errors = []
+    stop = threading.Event()
+
+    def save_loop():
+        while not stop.is_set():
+            try:
+                caching.save()
+            except RuntimeError as e:
+                errors.append(e)
+
+    thread = threading.Thread(target=save_loop)
+    thread.start()
+    try:
+        for i in range(50):
+            with caching.cache_env(f"switch {i}"):
+                caching.read_kv_cache("switch", "test").set_cache(i)
+    finally:
+        stop.set()
+        thread.join()
+        caching.set_root_path(base_path)
+    assert errors == []
+
+
+def test_memory_cache():
+    with caching.refresh_cache():
+        caching.read_kv_cache("memory", "test").set_cache("value")
+    cache_kv = caching._cache_kv
+    # Served from memory even if the row is gone
+    db_conn = cache_kv.conn_pool.get_conn()
+    db_conn.execute("DELETE FROM cache_table WHERE type = 'test'")
+    db_conn.commit()
+    assert caching.read_kv_cache("memory", "test").value == "value"
+    with caching.refresh_cache():
+        assert not caching.read_kv_cache("memory", "test").is_valid()
+    with caching.disable_cache():
+        assert caching.read_kv_cache("memory", "test") is None
+
+
+def test_migrate_cache_table(tmp_path):
+    db_path = str(tmp_path / "old_cache.db")
+    # The table of an older version is keyed by hash only
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE cache_table (hash TEXT PRIMARY KEY, type text, value text, date text, meta text)")
+    conn.execute("INSERT INTO cache_table VALUES (?, ?, ?, ?, ?)", (get_hash("old input"), "chat", "old value", "2024-01-01", "None"))
+    conn.commit()
+    conn.close()
+
+    cache_kv = CacheTableKV(db_path)
+    db_conn = cache_kv.conn_pool.get_conn()
+    assert get_primary_key(db_conn, "cache_table") == ["hash", "type"]
+    assert db_conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    # The last access time is filled by the date of the old rows, which are kept in the legacy table
+    assert db_conn.execute("SELECT last_access FROM cache_table_legacy").fetchone()[0] is not None
+    assert cache_kv.read_cache("old input", "chat").value == "old value"
+    # The same input can be cached for different types
+    cache_kv.read_cache("old input", "other").set_cache("other value")
+    cache_kv.apply_cache_update()
+    cache_kv.lru.clear()
+    assert cache_kv.read_cache("old input", "chat").value == "old value"
+    assert cache_kv.read_cache("old input", "other").value == "other value"
+    cache_kv.close()
+
+
+def test_add_last_access_race(tmp_path, monkeypatch):
+    db_path = str(tmp_path / "old_cache.db")
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE cache_table (hash TEXT, type text, value text, date text, meta text, "
+                 "PRIMARY KEY (hash, type))")
+    conn.commit()
+    other_conn = sqlite3.connect(db_path)
+    get_columns = schema.get_columns
+
+    def get_columns_then_race(conn, table):
+        columns = get_columns(conn, table)
+        # Another process adds the column right after the first check
+        monkeypatch.setattr(schema, "get_columns", get_columns)
+        schema.ensure_last_access(other_conn, table)
+        return columns
+
+    monkeypatch.setattr(schema, "get_columns", get_columns_then_race)
+    schema.ensure_last_access(conn, "cache_table")
+    assert get_columns(conn, "cache_table").count("last_access") == 1
+    conn.close()
+    other_conn.close()
+
+
+def test_multi_process_flight(tmp_path):
+    db_path = str(tmp_path / "shared.db")
+    # Two cache tables on the same file act as two processes
+    cache_kv_1 = CacheTableKV(db_path)
+    cache_kv_2 = CacheTableKV(db_path)
+    cache_kv_1.set_multi_process(poll_interval=0.05)
+    cache_kv_2.set_multi_process(poll_interval=0.05)
+
+    cache_1 = cache_kv_1.read_cache("shared input", "chat")
+    flight_1 = cache_kv_1.join_flight(cache_1)
+    assert flight_1.is_leader
+
+    results = []
+
+    def follow():
+        cache_2 = cache_kv_2.read_cache("shared input", "chat")
+        flight_2 = cache_kv_2.join_flight(cache_2)
+        results.append((flight_2.is_leader, flight_2.wait()))
+
+    thread = threading.Thread(target=follow)
+    thread.start()
+    time.sleep(0.3)
+    # The other process waits for the leader instead of making the call
+    assert len(results) == 0
+    cache_1.set_cache("shared value")
+    flight_1.finish("shared value")
+    thread.join()
+    assert results == [(False, "shared value")]
+    # The leased result is written immediately and the lease is released
+    assert not cache_kv_1.has_pending_update()
+    db_conn = cache_kv_2.conn_pool.get_conn()
+    assert db_conn.execute("SELECT COUNT(*) FROM cache_lease").fetchone()[0] == 0
+    cache_kv_1.close()
+    cache_kv_2.close()
+
+
+def test_multi_process_kept_on_enable_cache_kv():
+    caching.enable_multi_process()
+    try:
+        caching.disable_cache_kv()
+        caching.enable_cache_kv()
+        assert caching.multi_process_config is not None
+        assert caching._cache_kv.lease is not None
+    finally:
+        caching.disable_multi_process()
+
+
+def test_save_used_in_multi_process(tmp_path):
+    base_path = caching.base_path
+    caching.set_root_path(str(tmp_path))
+    caching.enable_multi_process()
+    try:
+        # Another process writes to the same file
+        other_process = CacheTableKV(caching._cache_kv.cache_path)
+        other_process.read_cache("other process", "test").set_cache("value")
+        other_process.apply_cache_update()
+        with pytest.warns(UserWarning):
+            caching.save_used()
+        other_process.lru.clear()
+        assert other_process.read_cache("other process", "test").value == "value"
+        other_process.close()
+    finally:
+        caching.disable_multi_process()
+        caching.set_root_path(base_path)
+
+
+def test_multi_process_on_shared_volume(tmp_path):
+    base_path = caching.base_path
+    caching.set_root_path(str(tmp_path))
+    caching.read_kv_cache("shared volume", "test")
+    try:
+        caching.enable_multi_process(shared_volume=True)
+        db_conn = caching._cache_kv.conn_pool.get_conn()
+        assert db_conn.execute("PRAGMA journal_mode").fetchone()[0] == "delete"
+    finally:
+        caching.disable_multi_process()
+        sqlite_options["journal_mode"] = "WAL"
+        caching.set_root_path(base_path)
+
+
+def test_write_retry_on_busy(tmp_path):
+    db_path = str(tmp_path / "busy.db")
+    conn = sqlite3.connect(db_path, timeout=0, check_same_thread=False)
+    conn.execute("CREATE TABLE t (x int)")
+    conn.commit()
+    locker = sqlite3.connect(db_path, check_same_thread=False)
+    locker.execute("BEGIN IMMEDIATE")
+
+    def unlock():
+        time.sleep(0.3)
+        locker.rollback()
+
+    thread = threading.Thread(target=unlock)
+    thread.start()
+    write_transaction(conn, lambda cursor: cursor.execute("INSERT INTO t VALUES (1)"))
+    thread.join()
+    assert conn.execute("SELECT COUNT(*) FROM t").fetchone()[0] == 1
+
+
+def test_eviction(tmp_path):
+    cache_kv = CacheTableKV(str(tmp_path / "evict.db"))
+    db_conn = cache_kv.conn_pool.get_conn()
+    assert db_conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    for i in range(5):
+        cache_kv.read_cache(f"chat {i}", "chat_model").set_cache("x" * 1000)
+        cache_kv.read_cache(f"other {i}", "other").set_cache("y")
+    cache_kv.apply_cache_update()
+    # The chats were last accessed long ago, and chat 1 is read again now
+    db_conn.execute("UPDATE cache_table SET last_access = ? WHERE type = 'chat_model'", (time.time() - 10 * day,))
+    db_conn.commit()
+    cache_kv.lru.clear()
+    assert cache_kv.read_cache("chat 1", "chat_model").is_valid()
+    cache_kv.apply_cache_update()
+
+    assert cache_kv.evict(EvictionPolicy(ttl={"chat_": 5 * day})) == 4
+    assert cache_kv.read_cache("chat 0", "chat_model", create_cache=False) is None
+    assert cache_kv.read_cache("chat 1", "chat_model").is_valid()
+    assert cache_kv.evict(EvictionPolicy(max_rows={"other": 2})) == 3
+    assert db_conn.execute("SELECT COUNT(*) FROM cache_table").fetchone()[0] == 3
+    assert cache_kv.evict(EvictionPolicy(max_bytes=cache_kv.backend.get_size() // 2)) > 0
+    assert db_conn.execute("SELECT COUNT(*) FROM cache_table").fetchone()[0] < 3
+    cache_kv.close()
+
+
+def test_filter_unused_cache(tmp_path):
+    db_path = str(tmp_path / "gc.db")
+    cache_kv = CacheTableKV(db_path)
+    for i in range(3000):
+        cache_kv.read_cache(f"input {i}", "test").set_cache(f"value {i}")
+    cache_kv.apply_cache_update()
+    cache_kv.close()
+
+    # A new run using more inputs than the limit of SQL variables
+    cache_kv = CacheTableKV(db_path)
+    cache_kv.backend.write_batch_size = 100
+    caches = cache_kv.read_many([f"input {i}" for i in range(0, 3000, 2)], ["test"] * 1500)
+    assert all(cache.is_valid() for cache in caches)
+    progress = []
+    assert cache_kv.backend.delete_unused(set(cache_kv.active_cache_hash),
+                                          lambda n_done, n_total: progress.append((n_done, n_total))) == 1500
+    assert progress[-1] == (3000, 3000)
+    assert cache_kv.read_cache("input 2", "test").value == "value 2"
+    assert cache_kv.read_cache("input 1", "test", create_cache=False) is None
+    cache_kv.close()
+
+
+def test_compressed_values(tmp_path):
+    db_path = str(tmp_path / "compress.db")
+    long_value = "A long structured output. " * 200
+    cache_kv = CacheTableKV(db_path)
+    cache_kv.read_cache("long", "test").set_cache(long_value)
+    cache_kv.read_cache("short", "test").set_cache("short value")
+    cache_kv.apply_cache_update()
+    db_conn = cache_kv.conn_pool.get_conn()
+
+    def get_stored():
+        return [row[0] for row in db_conn.execute("SELECT value FROM cache_table").fetchall()]
+
+    stored = sorted(get_stored(), key=lambda v: isinstance(v, bytes))
+    assert stored[0] == "short value"
+    assert get_codec(stored[1]) == "zlib" and len(stored[1]) < len(long_value)
+    cache_kv.lru.clear()
+    assert cache_kv.read_cache("long", "test").value == long_value
+    assert cache_kv.read_many(["long", "short"], ["test", "test"])[0].value == long_value
+
+    assert recompress(db_path, CompressionOptions(codec="lzma")) == 1
+    assert sorted(get_codec(v) for v in get_stored() if isinstance(v, bytes)) == ["lzma"]
+    assert recompress(db_path, CompressionOptions(codec=None)) == 1
+    assert sorted(get_stored(), key=len) == ["short value", long_value]
+    cache_kv.lru.clear()
+    assert cache_kv.read_cache("long", "test").value == long_value
+    cache_kv.close()
+
+
+def test_canonical_hash(tmp_path):
+    image = "data:image/png;base64," + "iVBORw0KGgo" * 10000
+    messages = [{"role": "user", "content": [{"type": "text", "text": "Describe"},
+                                             {"type": "image_url", "image_url": {"url": image}}]}]
+    reordered = [{"content": [{"text": "Describe", "type": "text"},
+                              {"image_url": {"url": image}, "type": "image_url"}], "role": "user"}]
+    assert get_hash(messages) == get_hash(reordered)
+    assert get_hash(messages) != get_hash([{"role": "user", "content": "Describe"}])
+    assert get_hash([1, "1"]) != get_hash(["1", 1])
+
+    # The rows of an older version are found by their legacy hash and rekeyed
+    db_path = str(tmp_path / "legacy.db")
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE cache_table (hash TEXT PRIMARY KEY, type text, value text, date text, meta text)")
+    conn.execute("INSERT INTO cache_table VALUES (?, ?, ?, ?, ?)",
+                 (get_legacy_hash(messages), "chat", "legacy value", "2024-01-01", "{}"))
+    conn.commit()
+    conn.close()
+    cache_kv = CacheTableKV(db_path)
+    assert cache_kv.legacy_hash
+    assert cache_kv.read_cache(messages, "chat").value == "legacy value"
+    db_conn = cache_kv.conn_pool.get_conn()
+    assert db_conn.execute("SELECT value FROM cache_table WHERE hash = ?", (get_hash(messages),)).fetchone()[0] \
+           == "legacy value"
+    # The legacy table is dropped once all its rows are moved, which turns off the fallback
+    assert not cache_kv.legacy_hash
+    assert not has_legacy_table(db_conn, "cache_table")
+    cache_kv.close()
+    cache_kv = CacheTableKV(db_path)
+    assert not cache_kv.legacy_hash
+    assert cache_kv.read_cache(messages, "chat").value == "legacy value"
+    cache_kv.close()
+
+    # The legacy rows not read are removed as unused
+    db_path = str(tmp_path / "legacy_unused.db")
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE cache_table (hash TEXT PRIMARY KEY, type text, value text, date text, meta text)")
+    conn.executemany("INSERT INTO cache_table VALUES (?, ?, ?, ?, ?)",
+                     [(get_legacy_hash(text), "chat", "legacy value", "2024-01-01", "{}") for text in ["a", "b"]])
+    conn.commit()
+    conn.close()
+    cache_kv = CacheTableKV(db_path)
+    assert cache_kv.read_cache("a", "chat").value == "legacy value"
+    assert cache_kv.legacy_hash
+    assert cache_kv.filter_unused_cache() == 1
+    assert not cache_kv.legacy_hash
+    assert cache_kv.read_cache("a", "chat").value == "legacy value"
+    cache_kv.close()
+    # A new database is recorded with the current format
+    cache_kv = CacheTableKV(str(tmp_path / "new.db"))
+    assert not cache_kv.legacy_hash
+    cache_kv.close()
+
+
+def test_image_digests_bounded():
+    image_digests.clear()
+    images = ["data:image/png;base64," + str(i) * 1024 * 1024 for i in range(10)]
+    for image in images:
+        get_image_digest(image)
+    # The data URLs kept as keys are counted toward the memory bound
+    assert image_digests.n_bytes <= image_digests.max_bytes
+    assert image_digests.n_bytes >= sum(len(image) for image in images)
+    image_digests.resize(max_bytes=3 * 1024 * 1024)
+    assert len(image_digests.entries) <= 2
+    image_digests.resize(max_bytes=64 * 1024 * 1024)
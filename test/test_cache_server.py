@@ -0,0 +1,53 @@
+import numpy as np
+
+from mllm import caching
+from mllm.cache.cache_embedding import CacheTableEmbed
+from mllm.cache.cache_kv import CacheTableKV
+from mllm.cache.backend_http import HTTPBackend
+from mllm.cache.server import CacheServer
+
+
+def test_kv_cache_on_server(tmp_path):
+    server = CacheServer(str(tmp_path / "server"), port=0)
+    server.start()
+    try:
+        # Two clients on different machines
+        cache_kv_1 = CacheTableKV("client_1.db", HTTPBackend(server.url, "kv", "script.py"))
+        cache_kv_2 = CacheTableKV("client_2.db", HTTPBackend(server.url, "kv", "script.py"))
+        cache_kv_1.read_cache("shared input", "chat").set_cache("shared value")
+        cache_kv_1.apply_cache_update()
+        assert cache_kv_2.read_cache("shared input", "chat").value == "shared value"
+        caches = cache_kv_2.read_many(["shared input", "other input"], ["chat", "chat"])
+        assert caches[0].value == "shared value"
+        assert not caches[1].is_valid()
+        rows = list(cache_kv_2.backend.scan_all())
+        assert [(row[1], row[2]) for row in rows] == [("chat", "shared value")]
+        cache_kv_2.backend.delete([(rows[0][0], rows[0][1])])
+        assert cache_kv_2.backend.get((rows[0][0], rows[0][1])) is None
+        cache_kv_1.close()
+        cache_kv_2.close()
+
+        cache_embed = CacheTableEmbed(str(tmp_path), backend=HTTPBackend(server.url, "embedding", "embedding"))
+        cache_embed.add_cache("model", "text", np.arange(4, dtype=np.float32))
+        cache_embed.save_pending_cache()
+        cache_embed.pending_cache = {}
+        assert np.array_equal(cache_embed.read_many("model", ["text", "missing"])[0], np.arange(4))
+        assert cache_embed.read_cache("model", "missing") is None
+        cache_embed.close()
+    finally:
+        server.shutdown()
+
+
+def test_use_cache_server(tmp_path):
+    server = CacheServer(str(tmp_path / "server"), port=0)
+    server.start()
+    try:
+        caching.use_cache_server(server.url)
+        with caching.refresh_cache():
+            caching.read_kv_cache("served", "test").set_cache("value")
+        caching._cache_kv.lru.clear()
+        assert caching.read_kv_cache("served", "test").value == "value"
+    finally:
+        caching.use_cache_server(None)
+        server.shutdown()
+    assert caching._cache_kv.conn_pool is not None
@@ -1,6 +1,18 @@
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+import numpy as np
+from litellm import InternalServerError, Timeout
+
+import mllm.embedding.get as embedding_get
 from mllm import get_embeddings, caching
+from mllm.cache.backend_flat import FlatFileBackend, FlatMatrix, HashIndex, to_keys
+from mllm.cache.cache_embedding import CacheTableEmbed, get_hash
+from mllm.cache.precision import EmbeddingPrecision, embedding_precisions
 from mllm.config import default_models
-from mllm.embedding import get_vector_store_from_str
+from mllm.embedding import get_vector_store_from_str, EmbeddingBatcher, aget_embeddings
 
 
 def test_vector_store_basic():
@@ -12,11 +24,13 @@ def test_vector_store_basic():
     res = vector_store.get_top_k_items("Jackson")
     assert res[0] == "Mike"
 
+
 def test_vector_store_basic2():
     vector_store = get_vector_store_from_str(["banana", "headset", "Mike"])
     res = vector_store.get_top_k_items(["earphone", "PC"])
     assert res[0] == "headset"
 
+
 def test_lazy_embedding():
     get_embeddings("1")
     caching.cache_embed.clear_cache_table()
@@ -28,4 +42,300 @@ def test_lazy_embedding():
     res_2 = get_embeddings(texts_2)
 
     print(res_1)
-    print(res_2)
\ No newline at end of file
+    print(res_2)
+
+
+def test_cache_read_many(tmp_path):
+    cache_embed = CacheTableEmbed(str(tmp_path))
+    texts = [f"text {i}" for i in range(2000)]
+    for i, text in enumerate(texts[:1500]):
+        cache_embed.add_cache("model", text, np.full(4, i, dtype=np.float32))
+    cache_embed.save_pending_cache()
+    cache_embed.pending_cache = {}
+    cache_embed.add_cache("model", texts[1999], np.full(4, 1999, dtype=np.float32))
+    res = cache_embed.read_many("model", texts)
+    assert [r[0] for r in res[:1500]] == list(range(1500))
+    assert res[1500:1999] == [None] * 499
+    assert res[1999][0] == 1999
+    assert cache_embed.read_many("other_model", texts[:1]) == [None]
+    cache_embed.close()
+
+
+def test_filter_unused_embeddings(tmp_path):
+    cache_embed = CacheTableEmbed(str(tmp_path))
+    for i in range(10):
+        cache_embed.add_cache("model", f"text {i}", np.full(4, i, dtype=np.float32))
+    cache_embed.save_pending_cache()
+    cache_embed.close()
+
+    # Only the embeddings read in a new run are kept
+    cache_embed = CacheTableEmbed(str(tmp_path))
+    assert cache_embed.read_many("model", ["text 1", "text 2"])[0][0] == 1
+    assert cache_embed.read_cache("model", "text 3")[0] == 3
+    assert cache_embed.filter_unused_cache() == 7
+    assert cache_embed.read_many("model", ["text 0", "text 1", "text 3"])[0] is None
+    assert cache_embed.read_cache("model", "text 3")[0] == 3
+    cache_embed.close()
+
+
+def test_bounded_embedding_flush(tmp_path):
+    cache_embed = CacheTableEmbed(str(tmp_path))
+    cache_embed.max_pending_bytes = 160
+    cache_embed.flush_batch_size = 3
+    requests = []
+    cache_embed.on_pending = lambda: requests.append(len(cache_embed.pending_cache))
+    for i in range(30):
+        cache_embed.add_cache("model", f"text {i}", np.full(4, i, dtype=np.float32))
+        # Each embedding takes 16 bytes, so the adding thread flushes by itself beyond 20 of them
+        assert cache_embed.pending_bytes <= 2 * cache_embed.max_pending_bytes
+    assert requests[0] == 11
+    cache_embed.save_pending_cache()
+    assert cache_embed.pending_cache == {} and cache_embed.pending_bytes == 0
+    res = cache_embed.read_many("model", [f"text {i}" for i in range(30)])
+    assert [r[0] for r in res] == list(range(30))
+    cache_embed.close()
+
+
+def test_embedding_precision(tmp_path):
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(20, 64)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    cache_embed = CacheTableEmbed(str(tmp_path))
+    for i in range(10):
+        cache_embed.add_cache("model", f"text {i}", vectors[i])
+    cache_embed.save_pending_cache()
+    try:
+        embedding_precisions["model"] = EmbeddingPrecision("int8", dim=32)
+        fresh = [cache_embed.add_cache("model", f"text {i}", vectors[i]) for i in range(10, 20)]
+        cache_embed.save_pending_cache()
+        # The float32 embeddings stored before are converted when they are read
+        res = cache_embed.read_many("model", [f"text {i}" for i in range(20)])
+        assert all(r.shape == (32,) for r in res)
+        assert all(np.array_equal(a, b) for a, b in zip(res[10:], fresh))
+        truncated = vectors[:, :32] / np.linalg.norm(vectors[:, :32], axis=1, keepdims=True)
+        assert np.allclose(np.stack(res), truncated, atol=0.01)
+        rows = cache_embed.backend.get_many([(get_hash("text 15"), "model#int8-32")])
+        assert len(next(iter(rows.values()))[0]) == 4 + 32
+
+        precision = embedding_precisions["model"]
+        values, scales = precision.pack(vectors)
+        assert values.dtype == np.int8
+        scores = precision.dot(values, scales, vectors[:2])
+        assert np.allclose(scores, truncated.dot(truncated[:2].T), atol=0.02)
+    finally:
+        embedding_precisions.pop("model", None)
+    cache_embed.close()
+
+
+def test_flat_embedding_store(tmp_path):
+    store_dir = str(tmp_path / "flat")
+    cache_embed = CacheTableEmbed(str(tmp_path), backend=FlatFileBackend(store_dir))
+    for i in range(10):
+        cache_embed.add_cache("org/model", f"text {i}", np.full(4, i, dtype=np.float32))
+    cache_embed.save_pending_cache()
+    # Another instance, as in another process, sees the rows appended later
+    other = CacheTableEmbed(str(tmp_path), backend=FlatFileBackend(store_dir))
+    assert other.read_cache("org/model", "text 3")[0] == 3
+    cache_embed.add_cache("org/model", "text 3", np.full(4, 30, dtype=np.float32))
+    cache_embed.add_cache("org/model", "text 10", np.full(4, 10, dtype=np.float32))
+    cache_embed.save_pending_cache()
+    res = other.read_many("org/model", ["text 3", "text 10", "missing"])
+    assert res[0][0] == 30 and res[1][0] == 10 and res[2] is None
+
+    matrix = other.get_matrix("org/model")
+    assert len(matrix) == 11 and isinstance(matrix.values.base, np.memmap)
+    assert np.array_equal(matrix.get_embeddings(matrix.get_rows(["text 10", "text 3"]))[:, 0], [10, 30])
+    assert np.allclose(matrix.dot(np.ones(4))[matrix.get_rows(["text 2"]), 0], 8)
+
+    # Only the used rows are kept after filtering
+    other.close()
+    cache_embed.close()
+    cache_embed = CacheTableEmbed(str(tmp_path), backend=FlatFileBackend(store_dir))
+    cache_embed.read_many("org/model", ["text 1", "text 10"])
+    assert cache_embed.filter_unused_cache() == 9
+    assert [r is not None for r in cache_embed.read_many("org/model", ["text 1", "text 2", "text 10"])] \
+           == [True, False, True]
+
+    try:
+        embedding_precisions["org/model"] = EmbeddingPrecision("int8")
+        cache_embed.add_cache("org/model", "text 1", np.arange(4, dtype=np.float32))
+        matrix = cache_embed.get_matrix("org/model")
+        assert matrix.values.dtype == np.int8 and matrix.scales.shape == (1, 1)
+        assert np.allclose(matrix.dot(np.arange(4)), 14, atol=0.1)
+    finally:
+        embedding_precisions.pop("org/model", None)
+    cache_embed.close()
+
+
+def test_flat_hash_index(tmp_path):
+    # Two hashes with the same first 8 bytes
+    index = HashIndex(to_keys(["00" * 8 + "11" * 8, "00" * 8 + "22" * 8, "ff" * 16]))
+    assert list(index.find(to_keys(["00" * 8 + "22" * 8, "ff" * 16, "00" * 8 + "33" * 8, "ee" * 16]))) \
+           == [1, 2, -1, -1]
+
+    paths = str(tmp_path / "model.bin"), str(tmp_path / "model.index")
+    matrix = FlatMatrix(*paths)
+    matrix.write({get_hash(f"text {i}"): bytes([i % 256]) * 4 for i in range(3000)})
+    other = FlatMatrix(*paths)
+    other.refresh()
+    assert other.read([get_hash("text 5"), get_hash("missing")]) == {get_hash("text 5"): b"\x05" * 4}
+    # The rows appended after the index is built are looked up in the tail, also in the other instance
+    matrix.write({get_hash("text 5"): b"five", get_hash("new"): b"new!"})
+    assert matrix.hash_index is not None and list(matrix.tail) == [get_hash("new")]
+    other.refresh()
+    assert other.read([get_hash("new"), get_hash("text 5")]) == {get_hash("new"): b"new!", get_hash("text 5"): b"five"}
+    assert other.n_rows == 3001 and len(other.get_hashes()) == 3001
+
+
+def test_parallel_embedding_batches(monkeypatch):
+    calls = []
+    lock = threading.Lock()
+
+    def mock_embedding(model, input, **kwargs):
+        with lock:
+            calls.append(list(input))
+            # The first request of "text 7" fails once
+            if "text 7" in input and sum("text 7" in call for call in calls) == 1:
+                raise InternalServerError("mock failure", "mock", model)
+        return SimpleNamespace(data=[{"embedding": [float(text.split()[1]), 1.0]} for text in input])
+
+    monkeypatch.setattr(embedding_get, "embedding", mock_embedding)
+    monkeypatch.setattr(embedding_get, "embedding_retry_wait", 0)
+    monkeypatch.setitem(embedding_get.default_embedding_batch_config, "max_batch_size", 4)
+    texts = [f"text {i}" for i in range(10)] + ["text 3", "text 7"]
+    res = embedding_get._get_embeddings("mock-model", texts)
+    assert [r[0] for r in res] == list(range(10)) + [3, 7]
+    # The repeated texts are sent once, and only the failed batch is sent again
+    assert sorted(len(call) for call in calls) == [2, 4, 4, 4]
+    assert sum(len(call) for call in calls) == 14
+
+    batches = embedding_get.get_embedding_batches(["a" * 30, "b" * 30, "c" * 300, "d"], 10, 40)
+    assert batches == [(0, 2), (2, 3), (3, 4)]
+
+
+def test_retry_embedding_on_timeout(monkeypatch):
+    calls = []
+
+    def mock_embedding(model, input, **kwargs):
+        calls.append(list(input))
+        if len(calls) == 1:
+            raise Timeout("mock timeout", model, "mock")
+        return SimpleNamespace(data=[{"embedding": [1.0, 2.0]} for _ in input])
+
+    monkeypatch.setattr(embedding_get, "embedding", mock_embedding)
+    monkeypatch.setattr(embedding_get, "embedding_retry_wait", 0)
+    res = embedding_get._get_embeddings("mock-model", ["timeout"])
+    assert len(calls) == 2 and list(res[0]) == [1.0, 2.0]
+
+
+def test_embedding_batcher(monkeypatch, tmp_path):
+    calls = []
+
+    def mock_get_embeddings(model, texts):
+        calls.append(list(texts))
+        # Let the other threads add their texts while this batch is in flight
+        time.sleep(0.05)
+        return [np.full(2, int(text.split()[1]), dtype=np.float32) for text in texts]
+
+    monkeypatch.setattr(embedding_get, "_get_embeddings", mock_get_embeddings)
+    cache_embed = CacheTableEmbed(str(tmp_path))
+    monkeypatch.setattr(embedding_get.caching, "cache_embed", cache_embed)
+
+    with EmbeddingBatcher(max_pending=50) as batcher:
+        results = [None] * 8
+
+        def embed(i):
+            # Threads do not inherit the scope, so they share the batcher explicitly
+            lazy = batcher.add_many("model", [f"text {j}" for j in range(i * 10, i * 10 + 20)], cache_embed)
+            results[i] = [lazy_embedding.__array__()[0] for lazy_embedding in lazy]
+
+        threads = [threading.Thread(target=embed, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    for i in range(8):
+        assert results[i] == list(range(i * 10, i * 10 + 20))
+    # Every text is embedded exactly once, in fewer calls than the threads
+    sent = [text for call in calls for text in call]
+    assert sorted(sent) == sorted(set(sent)) and len(sent) == 90
+    assert len(calls) < 8
+
+    calls.clear()
+    with EmbeddingBatcher(max_delay=0.05):
+        lazy = embedding_get.get_embeddings(["text 100", "text 101", "text 100"])
+        assert lazy[0] is lazy[2]
+        time.sleep(0.5)
+        # Embedded in the background after the deadline
+        assert calls == [["text 100", "text 101"]] and lazy[1].embedding[0] == 101
+    cache_embed.close()
+
+
+def test_aget_embeddings(monkeypatch, tmp_path):
+    calls = []
+    in_flight = [0, 0]
+
+    async def mock_aembedding(model, input, **kwargs):
+        calls.append(list(input))
+        in_flight[0] += 1
+        in_flight[1] = max(in_flight)
+        await asyncio.sleep(0.01 if "slow" not in input[0] else 10)
+        in_flight[0] -= 1
+        return SimpleNamespace(data=[{"embedding": [float(len(text)), 1.0]} for text in input])
+
+    monkeypatch.setattr(embedding_get, "aembedding", mock_aembedding)
+    monkeypatch.setitem(embedding_get.default_embedding_batch_config, "max_batch_size", 3)
+    cache_embed = CacheTableEmbed(str(tmp_path))
+    monkeypatch.setattr(embedding_get.caching, "cache_embed", cache_embed)
+
+    texts = ["a" * i for i in range(1, 11)] + ["a"]
+    res = asyncio.run(aget_embeddings(texts, model="model"))
+    assert [r[0] for r in res] == list(range(1, 11)) + [1]
+    assert len(calls) == 4 and in_flight[1] > 1
+    # The second call is served by the cache
+    assert [r[0] for r in asyncio.run(aget_embeddings(texts[:5], model="model"))] == list(range(1, 6))
+    assert len(calls) == 4
+
+    async def cancel():
+        task = asyncio.ensure_future(aget_embeddings(["slow", "fast 1", "fast 2", "fast 3"], model="model"))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            return True
+
+    assert asyncio.run(cancel())
+    # The finished batch was cached before the call was cancelled
+    assert cache_embed.read_many("model", ["fast 3", "slow"])[0][0] == 6
+    assert cache_embed.read_many("model", ["fast 3", "slow"])[1] is None
+    cache_embed.close()
+
+
+def test_aget_embeddings_off_loop(monkeypatch, tmp_path):
+    async def mock_aembedding(model, input, **kwargs):
+        return SimpleNamespace(data=[{"embedding": [1.0, 2.0]} for _ in input])
+
+    monkeypatch.setattr(embedding_get, "aembedding", mock_aembedding)
+    cache_embed = CacheTableEmbed(str(tmp_path))
+    monkeypatch.setattr(embedding_get.caching, "cache_embed", cache_embed)
+    cache_threads = []
+    read_many, add_cache = cache_embed.read_many, cache_embed.add_cache
+
+    def record(func):
+        def wrapped(*args):
+            cache_threads.append(threading.get_ident())
+            return func(*args)
+        return wrapped
+
+    monkeypatch.setattr(cache_embed, "read_many", record(read_many))
+    monkeypatch.setattr(cache_embed, "add_cache", record(add_cache))
+
+    async def main():
+        await aget_embeddings(["off", "loop"], model="model")
+        return threading.get_ident()
+
+    loop_thread = asyncio.run(main())
+    # The cache is read and written in the executor, not on the event loop
+    assert len(cache_threads) == 3 and loop_thread not in cache_threads
+    cache_embed.close()
@@ -1,5 +1,15 @@
-from mllm.utils.maps import parallel_map, p_map
+import asyncio
+import os
+import subprocess
+import sys
+import threading
 import time
+
+import pytest
+
+from mllm.utils.maps import parallel_map, p_map, p_imap, a_map, AdaptiveConcurrency
+
+
 def test_parallel_map():
     def wait_for_1_second(x):
         time.sleep(0.2)
@@ -15,3 +25,100 @@ def test_p_map():
     for arg, res in p_map(wait_for_1_second, [1, 2, 3], n_workers=1, title="test"):
         print(arg, res)
         assert arg**2 == res
+
+
+def test_p_map_adaptive():
+    controller = AdaptiveConcurrency(initial=2, max_limit=8)
+
+    def wait_for_a_while(x):
+        time.sleep(0.05)
+        return x ** 2
+
+    for arg, res in p_map(wait_for_a_while, range(40), adaptive=controller):
+        assert arg ** 2 == res
+    assert controller.concurrency > 2
+    assert controller.in_flight == 0
+
+
+def test_a_map():
+    async def wait_for_a_while(x):
+        await asyncio.sleep(0.05)
+        return x ** 2
+
+    for arg, res in asyncio.run(a_map(wait_for_a_while, range(100), n_workers=50)):
+        assert arg ** 2 == res
+    for arg, res in asyncio.run(a_map(wait_for_a_while, range(40), adaptive=True)):
+        assert arg ** 2 == res
+
+
+def test_adaptive_cancelled_waiter():
+    controller = AdaptiveConcurrency(initial=1, max_limit=1)
+
+    async def main():
+        await controller.aacquire()
+        waiter_1 = asyncio.ensure_future(controller.aacquire())
+        waiter_2 = asyncio.ensure_future(controller.aacquire())
+        await asyncio.sleep(0.01)
+        controller.release(0.01)
+        # The woken waiter is cancelled before it takes the free slot
+        waiter_1.cancel()
+        await asyncio.wait_for(waiter_2, 1)
+
+    asyncio.run(main())
+    assert controller.in_flight == 1
+    assert len(controller.async_waiters) == 0
+
+
+def test_p_imap():
+    def wait_for_a_while(x):
+        time.sleep(0.5 if x == 0 else 0.01)
+        return x ** 2
+
+    def lazy_args():
+        yield from range(20)
+
+    res = list(p_imap(wait_for_a_while, lazy_args(), n_workers=4, max_pending=8))
+    assert sorted(res) == [(x, x ** 2) for x in range(20)]
+    # The slow item does not block the others
+    assert res[0] != (0, 0)
+
+    res = list(p_imap(wait_for_a_while, lazy_args(), n_workers=4, ordered=True))
+    assert res == [(x, x ** 2) for x in range(20)]
+
+
+def test_p_map_checkpoint(tmp_path):
+    checkpoint = str(tmp_path / "job.db")
+    n_calls = []
+    crash = [True]
+
+    def square(x):
+        n_calls.append(x)
+        if x == 7 and crash[0]:
+            raise ValueError("crash")
+        return x ** 2
+
+    try:
+        p_map(square, range(10), n_workers=1, checkpoint=checkpoint)
+    except ValueError:
+        pass
+    crash[0] = False
+    n_calls.clear()
+    res = list(p_map(square, range(10), n_workers=1, checkpoint=checkpoint))
+    assert res == [(x, x ** 2) for x in range(10)]
+    # The finished items are not run again
+    assert 7 in n_calls
+    assert set(n_calls) <= {7, 8, 9}
+
+
+def test_checkpoint_key(tmp_path):
+    code = "from mllm.utils.checkpoint import get_arg_key; print(get_arg_key({'words': {'a', 'b', 'c', 'd'}}))"
+    keys = {subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                           env={**os.environ, "PYTHONHASHSEED": str(seed)}).stdout for seed in range(4)}
+    # The same in the restarted processes
+    assert len(keys) == 1
+
+    args = [threading.Lock() for _ in range(3)]
+    with pytest.raises(TypeError):
+        p_map(lambda lock: 1, args, checkpoint=str(tmp_path / "job.db"))
+    res = p_map(lambda lock: 1, args, checkpoint=str(tmp_path / "job.db"), checkpoint_key=lambda lock: str(id(lock)))
+    assert [r for _, r in res] == [1, 1, 1]
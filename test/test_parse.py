@@ -1,6 +1,6 @@
 from mllm import Chat
 from mllm.provider_switch import set_default_to_deepseek
-from mllm.utils.parser import Parse, parse_json_by_cheap_model
+from mllm.utils.parser import Parse, IncrementalJsonParser, parse_json_by_cheap_model
 
 
 def test_parse_quotes():
@@ -45,6 +45,23 @@ def test_parse_list():
     res = Parse.list(src)
     assert res == ['1', 2, 3, 4]
 
+def test_incremental_dict():
+    src = """```json
+{"a": 1, "b": {"c": [1, 2, "x,}"]}, "d": "q\\"uote", 'e': None}
+```"""
+    parser = IncrementalJsonParser("dict")
+    items = []
+    for i in range(0, len(src), 3):
+        items.extend(parser.feed(src[i:i + 3]))
+    assert items == [("a", 1), ("b", {"c": [1, 2, "x,}"]}), ("d", 'q"uote'), ("e", None)]
+    assert parser.close() == Parse.dict(src)
+
+def test_incremental_list():
+    parser = IncrementalJsonParser("list")
+    assert parser.feed("[1, [2, 3], 'a]'") == [1, [2, 3]]
+    assert parser.feed(', {"x": 1}]') == ["a]", {"x": 1}]
+    assert parser.close() == [1, [2, 3], "a]", {"x": 1}]
+
 def test_code_gen():
     prompt = """
 Generate a code for bubble sort.
@@ -0,0 +1,42 @@
+import time
+
+import litellm
+
+import mllm.chat
+from mllm import Chat
+from mllm.utils.rate_limit import RateLimiter, TokenBucket, rate_limiter
+
+
+def test_token_bucket():
+    bucket = TokenBucket(60, capacity=1)
+    assert bucket.reserve(1) == 0
+    assert 0.9 < bucket.reserve(1) <= 1.0
+
+
+def test_rate_limiter():
+    limiter = RateLimiter()
+    limiter.set_limit("model", rpm=600, tpm=6000)
+    start = time.time()
+    for i in range(6):
+        limiter.acquire("model", 1000)
+    # 6000 tokens at first and 100 tokens per second after
+    assert limiter.reserve("model", 1000) > 9
+    limiter.correct("model", 3000, 0)
+    assert limiter.reserve("model", 0) < 0.1
+    assert time.time() - start < 1
+
+
+def test_retry_on_rate_limit(monkeypatch):
+    n_calls = []
+
+    def mock_completion(model, messages, mock_response=None, **options):
+        n_calls.append(1)
+        if len(n_calls) == 1:
+            raise litellm.RateLimitError("Too many requests", llm_provider="openai", model=model)
+        return litellm.completion(model, messages=messages, mock_response="ok", **options)
+
+    monkeypatch.setattr(mllm.chat, "completion", mock_completion)
+    monkeypatch.setattr(mllm.chat, "chat_retry_wait", 0)
+    n_rate_limited = rate_limiter.n_rate_limited
+    assert Chat("Say ok").complete() == "ok"
+    assert rate_limiter.n_rate_limited == n_rate_limited + 1
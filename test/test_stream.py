@@ -0,0 +1,72 @@
+import asyncio
+
+import litellm
+
+import mllm.chat
+from mllm import Chat, caching
+from mllm.structured_chat import SChat
+
+
+def mock_completion(model, messages, **options):
+    return litellm.completion(model, messages=messages, mock_response="one two three", **options)
+
+
+async def mock_acompletion(model, messages, **options):
+    return await litellm.acompletion(model, messages=messages, mock_response="one two three", **options)
+
+
+def test_stream_cache(monkeypatch):
+    monkeypatch.setattr(mllm.chat, "completion", mock_completion)
+    chat = Chat("Count to three. stream")
+    with caching.refresh_cache():
+        chunks = list(chat.complete(stream=True, cache=True))
+    assert "".join(chunks) == "one two three"
+    assert chat.messages[-1]["content"]["text"] == "one two three"
+
+    chat = Chat("Count to three. stream")
+    chunks = list(chat.complete(stream=True, cache=True))
+    assert chunks == ["one two three"]
+    assert chat.additional_res["cache_hit"]
+
+
+def test_astream(monkeypatch):
+    monkeypatch.setattr(mllm.chat, "acompletion", mock_acompletion)
+
+    async def main():
+        chat = Chat("Count to three. astream")
+        chunks = [chunk async for chunk in await chat.acomplete(stream=True)]
+        return chat, chunks
+
+    chat, chunks = asyncio.run(main())
+    assert "".join(chunks) == "one two three"
+    assert str(chat).endswith("one two three")
+
+
+def test_stream_parsed(monkeypatch):
+    def mock_dict_completion(model, messages, **options):
+        return litellm.completion(model, messages=messages, mock_response='{"a": 1, "b": [2, 3], "c": "d"}', **options)
+    monkeypatch.setattr(mllm.chat, "completion", mock_dict_completion)
+
+    chat = Chat("Give a json dict. stream")
+    assert list(chat.complete(stream=True, parse="dict")) == [("a", 1), ("b", [2, 3]), ("c", "d")]
+
+    schat = SChat()
+    schat.add_output_key("a", "int", "")
+    schat.add_output_key("b", "list", "")
+    assert list(schat.complete(stream=True)) == [("a", 1), ("b", [2, 3])]
+
+
+def test_stream_usage(monkeypatch):
+    monkeypatch.setattr(mllm.chat, "completion", mock_completion)
+    monkeypatch.setattr(mllm.chat, "acompletion", mock_acompletion)
+    chat = Chat("Count to three. usage")
+    list(chat.complete(stream=True))
+    assert chat.additional_res["prompt_tokens"] > 0
+
+    async def main():
+        chat = Chat("Count to three. ausage")
+        [chunk async for chunk in await chat.acomplete(stream=True)]
+        return chat
+
+    chat = asyncio.run(main())
+    assert chat.additional_res["prompt_tokens"] > 0